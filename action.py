@@ -4,8 +4,10 @@ Grid actions.
 Should be used in replay and undo features.
 """
 
-from dataclasses import dataclass, field
-from layer_util import Layer
+from array import array
+from dataclasses import dataclass
+import numpy as np
+from layer_util import Layer, LAYERS
 from grid import Grid
 
 @dataclass
@@ -23,25 +25,161 @@ class PaintStep:
         sq.add(self.affected_layer)
 
 
-@dataclass
 class PaintAction:
+    """
+    A paint action, or a special action if is_special.
+
+    Squares are stored compactly as runs: each run is a span of consecutive y in one column painted with one layer,
+    kept in parallel typed arrays (x, first y, length, layer index). A stroke over a region takes a few runs per
+    column rather than a PaintStep object per square. `steps` still gives the PaintSteps, built on demand, and
+    undo_apply / redo_apply apply the action to the grid in bulk.
+    """
+
+    __slots__ = ("run_xs", "run_ys", "run_lengths", "run_layers", "is_special")
+
+    def __init__(self, steps: list[PaintStep] | None = None, is_special: bool = False) -> None:
+        self.run_xs = array("i")
+        self.run_ys = array("i")
+        self.run_lengths = array("i")
+        self.run_layers = array("b")
+        self.is_special = is_special
+        for step in steps or []:
+            self.add_step(step)
+
+    def __len__(self) -> int:
+        """Number of steps."""
+        return sum(self.run_lengths)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, PaintAction):
+            return NotImplemented
+        return self.is_special == other.is_special and self.steps == other.steps
+
+    def __repr__(self) -> str:
+        return f"PaintAction({len(self)} steps in {len(self.run_xs)} runs, is_special={self.is_special})"
+
+    def nbytes(self) -> int:
+        """Approximate memory held by the action, in bytes."""
+        return 64 + sum(
+            column.itemsize * len(column) for column in (self.run_xs, self.run_ys, self.run_lengths, self.run_layers)
+        )
+
+    def keys(self, height: int) -> np.ndarray:
+        """The squares of every step as x * height + y, in order."""
+        xs, ys, _ = self.squares()
+        return xs * height + ys
+
+    @classmethod
+    def from_squares(cls, xs: np.ndarray, ys: np.ndarray, layer_indices: np.ndarray) -> PaintAction:
+        """
+        The action painting layer index layer_indices[k] on (xs[k], ys[k]), in order, one run per square.
+        Complexity: O(number of squares) vectorised work.
+        """
+        action = cls()
+        for column, values in zip((action.run_xs, action.run_ys, action.run_lengths, action.run_layers),
+                                  (xs, ys, np.ones(len(xs)), layer_indices)):
+            column.frombytes(np.asarray(values, dtype=np.dtype(column.typecode)).tobytes())
+        return action
+
+    def add_step(self, step: PaintStep):
+        self.add_square(step.affected_grid_square[0], step.affected_grid_square[1], step.affected_layer)
+
+    def add_square(self, x: int, y: int, layer: Layer) -> None:
+        """
+        Add a step painting `layer` on (x, y), extending the last run when the square follows on from it.
+        Complexity: amortised O(1)
+        """
+        if self.run_xs and self.run_xs[-1] == x and self.run_layers[-1] == layer.index \
+                and self.run_ys[-1] + self.run_lengths[-1] == y:
+            self.run_lengths[-1] += 1
+            return
+        self.run_xs.append(x)
+        self.run_ys.append(y)
+        self.run_lengths.append(1)
+        self.run_layers.append(layer.index)
+
+    def add_squares(self, squares: list[tuple[int, int]], layer: Layer) -> None:
+        """Add a step painting `layer` on each square, in order."""
+        for x, y in squares:
+            self.add_square(x, y, layer)
 
-    steps: list[PaintStep] = field(default_factory=list)
-    is_special: bool = False
+    @property
+    def steps(self) -> tuple[PaintStep, ...]:
+        """
+        The steps of the action, in order. They are built from the runs, so the tuple is read-only:
+        use add_step or add_square to add a step.
+        Complexity: O(number of steps)
+        """
+        return tuple(
+            PaintStep((x, y + k), LAYERS[index])
+            for x, y, length, index in zip(self.run_xs, self.run_ys, self.run_lengths, self.run_layers)
+            for k in range(length)
+        )
+
+    def squares(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Every step as arrays (xs, ys, layer indices), in order.
+        Complexity: O(number of steps) vectorised work.
+        """
+        lengths = np.frombuffer(self.run_lengths, dtype=np.int32)
+        starts = np.cumsum(lengths) - lengths
+        offsets = np.arange(lengths.sum()) - np.repeat(starts, lengths)
+        xs = np.repeat(np.frombuffer(self.run_xs, dtype=np.int32), lengths).astype(np.intp)
+        ys = (np.repeat(np.frombuffer(self.run_ys, dtype=np.int32), lengths) + offsets).astype(np.intp)
+        layers = np.repeat(np.frombuffer(self.run_layers, dtype=np.int8), lengths)
+        return xs, ys, layers
 
     def undo_apply(self, grid: Grid):
         if self.is_special:
             grid.special()
             return
-        for step in self.steps:
-            step.undo_apply(grid)
+        self._apply(grid, undo=True)
 
     def redo_apply(self, grid: Grid):
         if self.is_special:
             grid.special()
             return
-        for step in self.steps:
-            step.redo_apply(grid)
+        self._apply(grid, undo=False)
 
-    def add_step(self, step: PaintStep):
-        self.steps.append(step)
+    def _apply(self, grid: Grid, undo: bool) -> None:
+        """
+        Applies every step at once, one bulk add or erase per layer (see Grid.add_many).
+        The order of steps only matters when a square is painted more than once, so such actions
+        are applied one step at a time instead.
+        """
+        if not self.run_xs:
+            return
+        xs, ys, layers = self.squares()
+        if len(np.unique(xs * grid.y + ys)) < len(xs):
+            for step in self.steps:
+                step.undo_apply(grid) if undo else step.redo_apply(grid)
+            return
+        for index in np.unique(layers).tolist():
+            group = layers == index
+            if undo:
+                grid.erase_many(LAYERS[index], xs[group], ys[group])
+            else:
+                grid.add_many(LAYERS[index], xs[group], ys[group])
+
+
+class RestoreAction:
+    """
+    Sets squares to recorded signatures (see LayerStore.signature), e.g. the result of an undo worked out in advance.
+    Has the redo_apply interface of PaintAction, so replay can apply it like any other action.
+    """
+
+    __slots__ = ("keys", "ids", "signatures", "is_special")
+
+    def __init__(self, keys: np.ndarray, ids: np.ndarray, signatures: list) -> None:
+        """keys[k] is the square x * grid.y + y that gets signatures[ids[k]]."""
+        self.keys = keys
+        self.ids = ids
+        self.signatures = signatures
+        self.is_special = False
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def redo_apply(self, grid: Grid):
+        """Complexity: please refer to Grid.set_signatures, the squares are set in one go."""
+        grid.set_signatures(self.signatures, self.ids, self.keys // grid.y, self.keys % grid.y)
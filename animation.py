@@ -0,0 +1,240 @@
+"""
+Streaming animated export of replays.
+
+replay_frames plays a replay the way the window does (a few actions per frame, with the timestamp advancing by
+1 / fps every frame) and yields the frames one at a time, so only the current and previous frame are ever held.
+The writers consume that generator:
+- write_frame_files: one PNG or PPM file per frame.
+- write_raw: raw RGB24 frames, e.g. piped to `ffmpeg -f rawvideo -pix_fmt rgb24 -s WxH -r FPS -i -`.
+- write_gif: an animated GIF, with the colours rounded to a fixed 252 colour palette.
+A frame that shows the same picture as the one before it is flagged as repeated, and the writers reuse the previous
+frame's encoding instead of encoding it again (the GIF writer lengthens the previous frame instead).
+
+Usage:  python -m animation JOURNAL OUT [--format gif|png|ppm|raw] [--fps F] [--actions-per-frame N] [--scale S]
+
+Exports the session saved in JOURNAL (see journal.py). OUT is a file for gif, a directory for png and ppm,
+and "-" (standard output) for raw.
+"""
+
+from __future__ import annotations
+import argparse
+import itertools
+import os
+import struct
+import sys
+import numpy as np
+import layers # registers every layer, so the layer indices in a journal resolve
+from grid import Grid
+from headless import BACKGROUND, encode_png, encode_ppm, scale_frame
+from journal import Journal
+from replay import ReplayTracker
+
+ANIMATION_FORMATS = ("gif", "png", "ppm", "raw")
+FPS = 20
+
+
+def replay_frames(replay: ReplayTracker, grid: Grid, fps: float = FPS, actions_per_frame: int = 1,
+                  scale: int = 1, background=BACKGROUND, reuse: bool = True):
+    """
+    Plays the replay on an empty grid and yields (pixels, repeated) for every frame: the grid before any action,
+    then one frame after every actions_per_frame actions, the timestamp advancing by 1 / fps each frame.
+    pixels is as for headless.render_image, and is reused by the next frame, so copy it to keep it.
+    repeated is True when the frame shows the same picture as the one before (always False without reuse).
+
+    INPUTS: replay, grid (empty), fps (frames per second), actions_per_frame (integer), scale and background
+    (as for headless.render_image), reuse (boolean value)
+    RAISE: ValueError if fps is not positive, actions_per_frame is less than 1 or scale is less than 1
+    OUTPUTS: generator of (H x W x 3 uint8 array, boolean value)
+
+    Complexity: the cost of each action once (see ReplayTracker.play_forward), plus one render per frame (see
+    Grid.render_frame), plus O(pixels) per frame to scale it (see headless.scale_frame), which a repeated frame skips.
+    """
+    if fps <= 0 or actions_per_frame < 1:
+        raise ValueError(f"Need a positive frame rate and at least 1 action per frame, not {fps} and {actions_per_frame}.")
+    if scale < 1:
+        raise ValueError(f"The scale must be at least 1, not {scale}.")
+    steps = replay.play_forward(grid)
+    previous = pixels = None
+    for frame in itertools.count():
+        if frame > 0 and not sum(1 for _ in itertools.islice(steps, actions_per_frame)):
+            return # every action has been shown
+        current = grid.render_frame(frame / fps, background)
+        repeated = reuse and previous is not None and (grid.recomputed_cells == 0 or np.array_equal(current, previous))
+        if not repeated:
+            pixels = scale_frame(current, scale)
+            if reuse:
+                previous = current.copy()
+        yield pixels, repeated
+
+
+def write_frame_files(frames, directory: str, image_format: str = "png") -> int:
+    """
+    Writes each frame to directory/frame_000000.<image_format>, ... A repeated frame is written from the previous
+    frame's encoding. Returns the number of frames written.
+    """
+    os.makedirs(directory, exist_ok=True)
+    encode = encode_png if image_format == "png" else encode_ppm
+    data = None
+    count = 0
+    for count, (pixels, repeated) in enumerate(frames, 1):
+        if not repeated:
+            data = encode(pixels)
+        with open(os.path.join(directory, f"frame_{count - 1:06d}.{image_format}"), "wb") as f:
+            f.write(data)
+    return count
+
+
+def write_raw(frames, stream) -> int:
+    """Writes each frame's RGB24 bytes, top row first, to a binary stream. Returns the number of frames written."""
+    data = None
+    count = 0
+    for count, (pixels, repeated) in enumerate(frames, 1):
+        if not repeated:
+            data = pixels.tobytes()
+        stream.write(data)
+    stream.flush()
+    return count
+
+
+# GIF palette: a 6 x 7 x 6 cube of red, green and blue levels (green gets the extra level, the eye being most
+# sensitive to it), padded to 256 entries.
+GIF_LEVELS = (6, 7, 6)
+GIF_PALETTE = np.zeros((256, 3), dtype=np.uint8)
+GIF_PALETTE[:252] = np.stack(np.meshgrid(
+    *(np.round(np.arange(n) * 255 / (n - 1)) for n in GIF_LEVELS), indexing="ij",
+), axis=-1).reshape(-1, 3)
+
+
+def gif_indices(pixels: np.ndarray) -> np.ndarray:
+    """The palette index of the nearest cube colour to each pixel. Complexity: O(pixels) vectorised work."""
+    levels = np.array(GIF_LEVELS) - 1
+    channels = (pixels.astype(np.int32) * levels + 127) // 255
+    return (channels[..., 0] * GIF_LEVELS[1] + channels[..., 1]) * GIF_LEVELS[2] + channels[..., 2]
+
+
+def lzw_encode(indices: bytes, min_code_size: int = 8) -> bytes:
+    """
+    GIF's variable code length LZW, with a clear code whenever the 4096 entry table fills up.
+    Complexity: O(len(indices)) dictionary lookups.
+    """
+    clear, end = 1 << min_code_size, (1 << min_code_size) + 1
+    out = bytearray()
+    bits = buffered = 0
+
+    def emit(code: int, size: int) -> None:
+        nonlocal bits, buffered
+        buffered |= code << bits
+        bits += size
+        while bits >= 8:
+            out.append(buffered & 0xFF)
+            buffered >>= 8
+            bits -= 8
+
+    code_size = min_code_size + 1
+    table = {}
+    next_code = end + 1
+    emit(clear, code_size)
+    prefix = None
+    for index in indices:
+        if prefix is None:
+            prefix = index
+            continue
+        code = table.get((prefix, index))
+        if code is not None:
+            prefix = code
+            continue
+        emit(prefix, code_size)
+        if next_code == 4096:
+            emit(clear, code_size)
+            table.clear()
+            next_code = end + 1
+            code_size = min_code_size + 1
+        else:
+            table[(prefix, index)] = next_code
+            next_code += 1
+            if next_code > 1 << code_size and code_size < 12:
+                code_size += 1
+        prefix = index
+    if prefix is not None:
+        emit(prefix, code_size)
+    emit(end, code_size)
+    if bits:
+        out.append(buffered & 0xFF)
+    return bytes(out)
+
+
+def gif_sub_blocks(data: bytes) -> bytes:
+    """Splits data into GIF sub-blocks of at most 255 bytes, ended by an empty one."""
+    return b"".join(bytes([len(data[i:i + 255])]) + data[i:i + 255] for i in range(0, len(data), 255)) + b"\x00"
+
+
+def write_gif(frames, path: str, fps: float = FPS, loop: bool = True) -> int:
+    """
+    Writes the frames as an animated GIF. A frame is only written once the next one is known, so that repeated
+    frames can lengthen it instead. GIF delays are in hundredths of a second, so each frame's delay is rounded such
+    that the total time never drifts from the frame rate. Returns the number of frames written.
+
+    Complexity: O(pixels) per frame that isn't repeated, mostly LZW.
+    """
+    count = 0
+    with open(path, "wb") as f:
+        pending = None # (image data, first frame, frames shown)
+
+        def flush() -> None:
+            data, first, shown = pending
+            delay = round(100 * (first + shown) / fps) - round(100 * first / fps)
+            f.write(b"\x21\xF9\x04\x04" + struct.pack("<H", delay) + b"\x00\x00") # graphic control, no disposal
+            f.write(data)
+
+        for frame, (pixels, repeated) in enumerate(frames):
+            if frame == 0:
+                height, width, _ = pixels.shape
+                f.write(b"GIF89a" + struct.pack("<HHBBB", width, height, 0xF7, 0, 0) + GIF_PALETTE.tobytes())
+                if loop:
+                    f.write(b"\x21\xFF\x0BNETSCAPE2.0\x03\x01\x00\x00\x00")
+            count = frame + 1
+            if repeated:
+                pending = (pending[0], pending[1], pending[2] + 1)
+                continue
+            if pending is not None:
+                flush()
+            height, width, _ = pixels.shape
+            descriptor = b"\x2C" + struct.pack("<HHHHB", 0, 0, width, height, 0)
+            pending = (descriptor + b"\x08" + gif_sub_blocks(lzw_encode(gif_indices(pixels).astype(np.uint8).tobytes())),
+                       frame, 1)
+        if pending is not None:
+            flush()
+        f.write(b"\x3B")
+    return count
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Export a saved painting session as an animation.")
+    parser.add_argument("journal", help="the saved session (journal)")
+    parser.add_argument("out", help="GIF file, directory of frames, or - for raw frames on standard output")
+    parser.add_argument("--format", choices=ANIMATION_FORMATS, default="gif")
+    parser.add_argument("--fps", type=float, default=FPS)
+    parser.add_argument("--actions-per-frame", type=int, default=1)
+    parser.add_argument("--scale", type=int, default=1, help="pixels per square side")
+    parser.add_argument("--no-reuse", action="store_true", help="encode every frame, even unchanged ones")
+    args = parser.parse_args(argv)
+
+    with Journal(args.journal) as journal:
+        grid = Grid(journal.draw_style, journal.x, journal.y, storage=Grid.STORAGE_COMPACT)
+        frames = replay_frames(ReplayTracker.from_journal(journal), grid, args.fps, args.actions_per_frame,
+                               args.scale, BACKGROUND, not args.no_reuse)
+        if args.format == "gif":
+            count = write_gif(frames, args.out, args.fps)
+        elif args.format == "raw" and args.out == "-":
+            count = write_raw(frames, sys.stdout.buffer)
+        elif args.format == "raw":
+            with open(args.out, "wb") as stream:
+                count = write_raw(frames, stream)
+        else:
+            count = write_frame_files(frames, args.out, args.format)
+    print(f"{count} frames of {grid.x * args.scale}x{grid.y * args.scale}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,48 @@
+"""
+Memory and construction time of the grid storage backends.
+
+Usage:  python -m benchmarks.grid_storage [max_size]
+
+Builds a SET grid with every storage backend at each size up to max_size (default 1024),
+reporting construction time and the memory allocated while building it (via tracemalloc).
+Dense storage is skipped above 1024, where it takes minutes and gigabytes.
+"""
+
+import sys
+import time
+import tracemalloc
+from grid import Grid
+
+SIZES = (64, 256, 1024, 2048)
+DENSE_LIMIT = 1024
+
+
+def measure(storage: str, size: int) -> tuple[float, int]:
+    """Returns (seconds, bytes) to construct a size x size SET grid with this storage."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    grid = Grid(Grid.DRAW_STYLE_SET, size, size, storage=storage)
+    try:
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        grid.close() # removes the tiled storage's temporary file
+    return elapsed, peak
+
+
+def main(max_size: int = 1024) -> None:
+    print(f"{'grid':>8} {'storage':>8} {'build (s)':>10} {'memory (MB)':>12}")
+    for size in SIZES:
+        if size > max_size:
+            break
+        for storage in Grid.STORAGE_CLASSES:
+            if storage == Grid.STORAGE_DENSE and size > DENSE_LIMIT:
+                print(f"{size:>5}^2 {storage:>8} {'skipped':>10}")
+                continue
+            elapsed, peak = measure(storage, size)
+            print(f"{size:>5}^2 {storage:>8} {elapsed:>10.3f} {peak / 2**20:>12.2f}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1024)
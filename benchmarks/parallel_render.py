@@ -0,0 +1,59 @@
+"""
+Speedup of parallel band rendering (see parallel_render.py) over Grid.render_frame.
+
+Usage:  python -m benchmarks.parallel_render [size] [frames]
+
+Paints a size x size compact SET grid (default 2048) with the time-varying rainbow and sparkle layers, so every
+square is evaluated again every frame, then times Grid.render_frame and a BandRenderer with 1, 2, 4, ... workers
+up to the number of CPUs.
+"""
+
+import os
+import sys
+import time
+import numpy as np
+from grid import Grid
+from layers import rainbow, sparkle
+from parallel_render import BandRenderer
+
+
+def animated_grid(size: int) -> Grid:
+    """A grid with rainbow on the squares where x + y is even, sparkle on the others."""
+    grid = Grid(Grid.DRAW_STYLE_SET, size, size, storage=Grid.STORAGE_COMPACT)
+    xs, ys = np.indices((size, size)).reshape(2, -1)
+    even = (xs + ys) % 2 == 0
+    grid.add_many(rainbow, xs[even], ys[even])
+    grid.add_many(sparkle, xs[~even], ys[~even])
+    return grid
+
+
+def time_frames(render, frames: int) -> float:
+    """Average seconds per frame, after one untimed frame (the first evaluates every square whatever the layers)."""
+    render(0)
+    start = time.perf_counter()
+    for frame in range(1, frames + 1):
+        render(frame / 60)
+    return (time.perf_counter() - start) / frames
+
+
+def main(size: int = 2048, frames: int = 5) -> None:
+    cpus = os.cpu_count() or 1
+    print(f"{size}^2 grid, {cpus} CPUs")
+    print(f"{'renderer':>12} {'ms / frame':>12} {'speedup':>8}")
+    background = (255, 255, 255)
+    grid = animated_grid(size)
+    serial = time_frames(lambda t: grid.render_frame(t, background), frames)
+    print(f"{'serial':>12} {1000 * serial:>12.1f} {1:>8.2f}")
+    workers = 1
+    while True:
+        grid = animated_grid(size)
+        with BandRenderer(grid, workers) as renderer:
+            elapsed = time_frames(lambda t: renderer.render_frame(t, background), frames)
+        print(f"{f'{workers} workers':>12} {1000 * elapsed:>12.1f} {serial / elapsed:>8.2f}")
+        if workers >= cpus:
+            break
+        workers = min(2 * workers, cpus)
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:3]))
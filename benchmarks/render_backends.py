@@ -0,0 +1,61 @@
+"""
+Frame time comparison of the canvas renderers.
+
+Usage:  python -m benchmarks.render_backends [frames]
+
+Opens a hidden window and, for each grid size, draws the same painted grid with every backend.
+Each timed frame clears the window, draws the canvas and waits for the GPU to finish.
+"""
+
+import sys
+import time
+import arcade
+from grid import Grid
+from layer_util import get_layers
+from renderer import RENDER_BACKENDS, RENDER_BACKEND_RECTANGLES, make_renderer
+
+GRID_SIZES = (32, 128, 512)
+WIDTH = 700
+HEIGHT = 700
+
+
+def painted_grid(size: int) -> Grid:
+    """A SET grid with every square painted, cycling through the registered layers."""
+    layers = [layer for layer in get_layers() if layer is not None]
+    grid = Grid(Grid.DRAW_STYLE_SET, size, size)
+    for x in range(size):
+        for y in range(size):
+            grid[x][y].add(layers[(x + y) % len(layers)])
+    return grid
+
+
+def time_backend(window: arcade.Window, backend: str, grid: Grid, size: int, frames: int) -> float:
+    """Average seconds per frame for `backend` drawing `grid`."""
+    renderer = make_renderer(backend, window, size, size, WIDTH, HEIGHT)
+    # One untimed frame, so texture / shader creation isn't counted.
+    renderer.draw(grid, 0, [255, 255, 255])
+    window.ctx.finish()
+    start = time.perf_counter()
+    for frame in range(frames):
+        window.clear()
+        renderer.draw(grid, frame / 60, [255, 255, 255])
+        window.ctx.finish()
+    return (time.perf_counter() - start) / frames
+
+
+def main(frames: int = 10) -> None:
+    window = arcade.Window(WIDTH, HEIGHT, "Renderer benchmark", visible=False)
+    print(f"{'grid':>8} " + " ".join(f"{backend:>12}" for backend in RENDER_BACKENDS) + "   (ms / frame)")
+    for size in GRID_SIZES:
+        grid = painted_grid(size)
+        timings = []
+        for backend in RENDER_BACKENDS:
+            # Per-rectangle drawing at 512^2 takes seconds per frame, so keep its sample small.
+            n = max(1, frames // 10) if backend == RENDER_BACKEND_RECTANGLES and size > 128 else frames
+            timings.append(time_backend(window, backend, grid, size, n))
+        print(f"{size:>5}^2 " + " ".join(f"{1000 * t:>12.2f}" for t in timings))
+    window.close()
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10)
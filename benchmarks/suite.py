@@ -0,0 +1,307 @@
+"""
+Benchmark suite of the hot paths, with a stored baseline to catch regressions.
+
+Usage:  python run_tests.py --bench [--sizes 32 128 ...] [--rounds N] [--threshold T] [--baseline PATH]
+                                     [--save-baseline]
+        (or python -m benchmarks.suite with the same options)
+
+Times, over grid sizes from 32^2 to 2048^2 and stack depths from 1 to 100:
+- get_color/STYLE/depth=D: one LayerStore.get_color call on a square holding D layers (SEQUENCE holds each layer at
+  most once, so its depth stops at the number of layers).
+- grid/STORAGE/SIZE: constructing a SET grid (dense storage only up to DENSE_LIMIT).
+- paint/STORAGE/SIZE: one brush stamp, as on_paint does it.
+- undo/SIZE and redo/SIZE: undoing or redoing one stroke, with the exact undo history of the window.
+- replay/SIZE: headless replay of a recorded session of strokes, specials and undos.
+Each is the best of ROUNDS runs of the suite, with REPEATS samples per round, and each sample repeats the work for at
+least MIN_SAMPLE_TIME seconds.
+
+Results are printed as JSON in the layout of the unit test runner's --for_ed output: a "testcases" list with a name,
+passed and feedback per benchmark, plus the seconds measured and the baseline they were compared with.
+A benchmark fails when it takes more than (1 + threshold) times its baseline, still after up to RETRIES more rounds.
+Benchmarks with no baseline pass.
+
+The baseline is stored relative to calibrate(), a fixed workload timed at the start of every round, rather than in
+seconds, so one saved on another machine still compares like with like. To regenerate it, after an intended change
+or when the workload of a benchmark changes, run on an otherwise idle machine:
+
+    python run_tests.py --bench --save-baseline
+
+which stores this run's results as the baseline, keeping the entries of sizes that weren't run.
+"""
+
+from __future__ import annotations
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import time
+import numpy as np
+import layers # registers every layer
+from action import PaintAction
+from grid import Grid
+from layer_util import get_layers
+from replay import ReplayTracker
+from stroke import Stroke
+from undo import UndoTracker
+
+SIZES = (32, 128, 512, 2048)
+DEPTHS = (1, 10, 100)
+DENSE_LIMIT = 512
+STROKES = 100
+THRESHOLD = 0.25
+ROUNDS = 3
+RETRIES = 2
+REPEATS = 2
+MIN_SAMPLE_TIME = 0.1
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+
+def best_time(run, repeats: int = REPEATS, setup=None, min_time: float = MIN_SAMPLE_TIME) -> float:
+    """
+    Seconds per run(), the best of `repeats` samples, with setup() (untimed) before every run() call.
+    Each sample calls run() until the calls add up to at least min_time seconds, so a benchmark of a few
+    microseconds is averaged over many calls rather than left to timer resolution and scheduling noise.
+    As in timeit, the garbage collector is off while timing, so a collection of earlier benchmarks' objects
+    isn't charged to this one.
+    """
+    best = float("inf")
+    gc.collect()
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeats):
+            total, calls = 0.0, 0
+            while calls == 0 or total < min_time:
+                if setup is not None:
+                    setup()
+                start = time.perf_counter()
+                run()
+                total += time.perf_counter() - start
+                calls += 1
+            best = min(best, total / calls)
+    finally:
+        if enabled:
+            gc.enable()
+    return best
+
+
+def calibrate() -> float:
+    """
+    Seconds for a fixed mix of interpreter and numpy work, like that of the benchmarks: the unit the baseline is
+    stored in, so the baseline scales with the speed of the machine it is compared on.
+    """
+    data = np.arange(1 << 18)
+
+    def work() -> None:
+        total = 0
+        for k in range(50000):
+            total += k * k % 7
+        np.sort(data[::-1] % 1009)
+
+    return best_time(work)
+
+
+def all_layers() -> list:
+    return [layer for layer in get_layers() if layer is not None]
+
+
+def bench_get_color() -> dict:
+    results = {}
+    for style in Grid.DRAW_STYLE_OPTIONS:
+        if style == Grid.DRAW_STYLE_SET:
+            depths = (1,)
+        elif style == Grid.DRAW_STYLE_SEQUENCE:
+            depths = sorted({min(depth, len(all_layers())) for depth in DEPTHS})
+        else:
+            depths = DEPTHS
+        for depth in depths:
+            store = Grid(style, 1, 1, storage=Grid.STORAGE_DENSE)[0][0]
+            for k in range(depth):
+                store.add(all_layers()[k % len(all_layers())])
+            calls = 2000
+            # Every call is at another position and time, so the store's memoised colour is never reused.
+            seconds = best_time(lambda: [store.get_color((255, 255, 255), k / 60, k, 0) for k in range(calls)])
+            results[f"get_color/{style}/depth={depth}"] = seconds / calls
+    return results
+
+
+def bench_grid(sizes) -> dict:
+    results = {}
+    for storage in Grid.STORAGE_CLASSES:
+        for size in sizes:
+            if storage == Grid.STORAGE_DENSE and size > DENSE_LIMIT:
+                continue
+            grids = []
+
+            def close_grids() -> None:
+                while grids:
+                    grids.pop().close() # removes the tiled storage's temporary file
+
+            seconds = best_time(lambda: grids.append(Grid(Grid.DRAW_STYLE_SET, size, size, storage=storage)),
+                                setup=close_grids)
+            close_grids()
+            results[f"grid/{storage}/{size}"] = seconds
+    return results
+
+
+def bench_paint(sizes) -> dict:
+    results = {}
+    stamps = 500
+    for storage in (Grid.STORAGE_DENSE, Grid.STORAGE_COMPACT):
+        for size in sizes:
+            if storage == Grid.STORAGE_DENSE and size > DENSE_LIMIT:
+                continue
+            rng = random.Random(size)
+            spots = [(rng.choice(all_layers()), rng.randrange(size), rng.randrange(size)) for _ in range(stamps)]
+            grids = []
+
+            def new_grid() -> None:
+                # Each run stamps a fresh grid, so the stacks are as deep in every run.
+                grids[:] = [Grid(Grid.DRAW_STYLE_ADD, size, size, storage=storage)]
+
+            seconds = best_time(lambda: [grids[0].stamp(layer, x, y) for layer, x, y in spots], setup=new_grid)
+            results[f"paint/{storage}/{size}"] = seconds / stamps
+    return results
+
+
+def record_session(grid: Grid, undo: UndoTracker | None, replay: ReplayTracker | None, seed: int) -> None:
+    """Paints STROKES random strokes on the grid, with a special every 10 and an undo every 7, recording them."""
+    rng = random.Random(seed)
+    for k in range(STROKES):
+        stroke = Stroke(grid, rng.choice(all_layers()), Grid.BRUSH_STENCILS[rng.randrange(Grid.MAX_BRUSH + 1)])
+        points = [(rng.uniform(0, grid.x), rng.uniform(0, grid.y)) for _ in range(4)]
+        stroke.paint_segment(points[0], points[0])
+        for start, end in zip(points, points[1:]):
+            stroke.paint_segment(start, end)
+        actions = [(stroke.action, False)]
+        if k % 10 == 9:
+            grid.special()
+            actions.append((PaintAction([], is_special=True), False))
+        for action, is_undo in actions:
+            if undo is not None:
+                undo.add_action(action)
+            if replay is not None:
+                replay.add_action(action, is_undo)
+        if k % 7 == 6 and undo is not None:
+            undone = undo.undo(grid)
+            if undone is not None and replay is not None:
+                replay.add_action(undone, is_undo=True)
+
+
+def bench_history(sizes) -> dict:
+    results = {}
+    for size in sizes:
+        grid = Grid(Grid.DRAW_STYLE_ADD, size, size, storage=Grid.STORAGE_COMPACT)
+        undo = UndoTracker(grid)
+        replay = ReplayTracker()
+        record_session(grid, undo, replay, seed=size)
+        while undo.redo(grid) is not None:
+            pass
+        count = len(undo.undoTracker)
+
+        def undo_all() -> None:
+            for _ in range(count):
+                undo.undo(grid)
+
+        def redo_all() -> None:
+            for _ in range(count):
+                undo.redo(grid)
+
+        # Each run starts from the state the other one leaves, which its setup restores untimed.
+        results[f"undo/{size}"] = best_time(undo_all, setup=redo_all) / count
+        results[f"redo/{size}"] = best_time(redo_all, setup=undo_all) / count
+        results[f"replay/{size}"] = best_time(
+            lambda: replay.replay_all(Grid(Grid.DRAW_STYLE_ADD, size, size, storage=Grid.STORAGE_COMPACT)),
+        )
+    return results
+
+
+def run(sizes=SIZES, rounds: int = ROUNDS) -> tuple[float, dict]:
+    """
+    Runs every benchmark `rounds` times, each round after a calibrate(). Returns the unit and name -> seconds, the
+    fastest of all rounds. The rounds spread each benchmark's samples over the whole run, so a slow spell of the
+    machine, which can outlast every sample of one benchmark, is unlikely to cover all of them.
+    """
+    unit, results = float("inf"), {}
+    benches = (bench_get_color, lambda: bench_grid(sizes), lambda: bench_paint(sizes), lambda: bench_history(sizes))
+    for _ in range(rounds):
+        unit = min(unit, calibrate())
+        for bench in benches:
+            for name, seconds in bench().items():
+                results[name] = min(results.get(name, seconds), seconds)
+    return unit, results
+
+
+def compare(results: dict, baseline: dict, threshold: float = THRESHOLD, unit: float = 1.0) -> list[dict]:
+    """
+    The JSON test cases: each result passes unless it is more than (1 + threshold) times its baseline.
+    Results are in seconds, the baseline in units of calibrate(), which took `unit` seconds in this run.
+    """
+    testcases = []
+    for name, seconds in results.items():
+        expected = baseline[name] * unit if name in baseline else None
+        case = {"name": name, "seconds": seconds, "baseline": expected}
+        if expected is None:
+            case["passed"] = True
+            case["feedback"] = f"{format_seconds(seconds)}, no baseline"
+        else:
+            change = seconds / expected - 1
+            case["passed"] = change <= threshold
+            case["feedback"] = f"{format_seconds(seconds)}, {change:+.0%} against {format_seconds(expected)}"
+            if not case["passed"]:
+                case["feedback"] += f", more than the {threshold:.0%} allowed"
+        testcases.append(case)
+    return testcases
+
+
+def format_seconds(seconds: float) -> str:
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:.3g} {unit}"
+    return f"{seconds / 1e-9:.3g} ns"
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(SIZES), help="grid sizes to benchmark")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                        help="fraction slower than the baseline that fails (default 0.25)")
+    parser.add_argument("--rounds", type=int, default=ROUNDS,
+                        help="times to run the suite, keeping each benchmark's fastest (default 3)")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="baseline JSON file")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="store this run as the baseline, e.g. after an intended change")
+
+
+def main(args) -> int:
+    """Runs the suite and prints the JSON results. Returns the exit status: 1 if a benchmark regressed."""
+    unit, results = run(args.sizes, args.rounds)
+    relative = {name: seconds / unit for name, seconds in results.items()}
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    if args.save_baseline:
+        baseline.update(relative)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+        baseline = relative
+    testcases = compare(results, baseline, args.threshold, unit)
+    for _ in range(RETRIES):
+        if all(case["passed"] for case in testcases):
+            break
+        # Best times only fall with more samples, so another round confirms a regression or clears a slow spell.
+        more_unit, more = run(args.sizes, rounds=1)
+        unit = min(unit, more_unit)
+        results = {name: min(seconds, more[name]) for name, seconds in results.items()}
+        testcases = compare(results, baseline, args.threshold, unit)
+    print(json.dumps({"testcases": testcases}, indent=2))
+    return 0 if all(case["passed"] for case in testcases) else 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the hot paths against a stored baseline.")
+    add_arguments(parser)
+    sys.exit(main(parser.parse_args()))
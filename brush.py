@@ -0,0 +1,51 @@
+"""
+Brush stencils.
+
+A Stencil is the set of squares a brush paints, as offsets from the square under the cursor.
+Stencils are built once (the diamond of every brush size is precomputed, see Grid.BRUSH_STENCILS), and placing one
+on the grid is a vectorised offset and clip, so a brush costs O(its number of squares) whatever its shape.
+"""
+
+from __future__ import annotations
+import numpy as np
+
+
+class Stencil:
+
+    def __init__(self, offsets) -> None:
+        """
+        offsets: iterable of (dx, dy) pairs, each painted once.
+        Complexity: O(n log n) for n offsets, since duplicates are removed.
+        """
+        offsets = np.unique(np.array(list(offsets), dtype=np.intp).reshape(-1, 2), axis=0)
+        self.dxs = offsets[:, 0]
+        self.dys = offsets[:, 1]
+
+    def __len__(self) -> int:
+        return len(self.dxs)
+
+    @classmethod
+    def diamond(cls, size: int) -> Stencil:
+        """Every square within Manhattan distance `size` of the centre, as the original brush painted."""
+        return cls(
+            (dx, dy)
+            for dx in range(-size, size + 1)
+            for dy in range(-(size - abs(dx)), size - abs(dx) + 1)
+        )
+
+    @classmethod
+    def from_mask(cls, mask) -> Stencil:
+        """A custom shape from a 2D boolean array indexed [dx][dy], centred on the middle of the array."""
+        mask = np.asarray(mask, dtype=bool)
+        dxs, dys = np.nonzero(mask)
+        return cls(zip(dxs - mask.shape[0] // 2, dys - mask.shape[1] // 2))
+
+    def place(self, px: int, py: int, width: int, height: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        The squares painted with the stencil centred on (px, py), clipped to a width x height grid.
+        Complexity: O(len(self)) vectorised work.
+        """
+        xs = self.dxs + px
+        ys = self.dys + py
+        inside = (0 <= xs) & (xs < width) & (0 <= ys) & (ys < height)
+        return xs[inside], ys[inside]
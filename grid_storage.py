@@ -0,0 +1,710 @@
+"""
+Grid storage backends.
+
+A Grid keeps its squares in one of these. Every backend supports:
+- storage[x][y]: a LayerStore for the square (x, y), so PaintStep and main.py work unchanged.
+Backends may also provide add_many(layer, xs, ys) and erase_many(layer, xs, ys), adding or erasing a layer on many
+distinct squares in one vectorised step (see Grid.add_many). They return a boolean array of which squares changed,
+and mark them dirty.
+Grid-wide specials are only counted (GridState.specials, see Grid.special), and every backend folds them in
+when its squares are next read or changed.
+- group_cells(xs, ys): group the squares (xs[k], ys[k]) by signature, for Grid.render_frame.
+- written_squares(): arrays (xs, ys) of every square that may differ from one that was never written, so snapshots
+  (see Grid.snapshot) scale with what has been painted rather than with the grid.
+Backends may also provide set_signatures(signatures, ids, xs, ys), giving each of many distinct squares one of a table
+of signatures (see LayerStore.signature) in one step (see Grid.set_signatures), with the same return value as add_many.
+
+DenseStorage holds one LayerStore object per square (an ArrayR of ArrayRs).
+CompactSetStorage holds the SET draw style as flat arrays: a layer index per square and one special bitplane.
+CompactSequenceStorage holds the SEQUENCE draw style as one uint32 bitmask per square.
+CompactAdditiveStorage holds the ADD draw style as one uint32 interned stack id per square (see layer_stacks.py).
+SparseStorage only creates a LayerStore when a square is first written, in fixed size chunks.
+"""
+
+from __future__ import annotations
+import numpy as np
+from layer_store import *
+from layer_util import LAYERS, Layer
+from layer_stacks import STACKS, StackNode
+from data_structures.referential_array import ArrayR
+
+
+class DenseStorage:
+    """One LayerStore object per square."""
+
+    def __init__(self, store_class, grid_state, x: int, y: int) -> None:
+        """
+        The grid is created as an array of arrays. Since each square is a layer store, it will add a square down y, which will
+        create column. Then the columns are added into the array, creating rows x columns.
+
+        Complexity: O(x*y), since every square gets its own store.
+        """
+        self.x = x
+        self.y = y
+        self.grid_state = grid_state
+        grid_state.written_keys = set() # the stores report every change there, see written_squares
+        self.columns = ArrayR(x)
+        for i in range(len(self.columns)):
+            yList = ArrayR(y)
+            for j in range(len(yList)):
+                yList[j] = store_class()
+                yList[j].watch(grid_state, i, j)
+            self.columns[i] = yList
+
+    def __getitem__(self, index):
+        return self.columns[index]
+
+    def written_squares(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Squares whose store has changed, as recorded by GridState.mark_dirty.
+        Complexity: O(w) for the w squares written.
+        """
+        keys = np.fromiter(self.grid_state.written_keys, dtype=np.int64, count=len(self.grid_state.written_keys))
+        xs, ys = np.divmod(keys, self.y)
+        return xs.astype(np.intp), ys.astype(np.intp)
+
+    def group_cells(self, xs: np.ndarray, ys: np.ndarray) -> dict:
+        """Complexity: O(len(xs)) signature lookups."""
+        groups = {}
+        for i, j in zip(xs.tolist(), ys.tolist()):
+            key = self.columns[i][j].signature()
+            if key not in groups:
+                groups[key] = ([], [])
+            groups[key][0].append(i)
+            groups[key][1].append(j)
+        return {
+            key: (np.array(gx, dtype=np.intp), np.array(gy, dtype=np.intp))
+            for key, (gx, gy) in groups.items()
+        }
+
+
+class CompactSetStorage:
+    """
+    SET draw style stored as arrays:
+    - layers: int8 index of the square's layer, -1 for none.
+    - special: bitplane of the squares' own special flags, 8 squares of a column per byte.
+      An odd number of grid-wide specials flips the meaning of every bit, so the bitplane is never rewritten.
+    At one byte and one bit per square, a 2048 x 2048 grid is under 5MB.
+    """
+
+    def __init__(self, store_class, grid_state, x: int, y: int) -> None:
+        if store_class is not SetLayerStore:
+            raise ValueError(f"Compact storage doesn't support {store_class.__name__}.")
+        self.x = x
+        self.y = y
+        self.grid_state = grid_state
+        self.layers = np.full((x, y), -1, dtype=np.int8)
+        self.special_bits = np.zeros((x, (y + 7) // 8), dtype=np.uint8)
+
+    def __getitem__(self, index) -> CompactColumn:
+        if not 0 <= index < self.x:
+            raise IndexError(index)
+        return CompactColumn(self, index)
+
+    def cell(self, x: int, y: int) -> CompactSetCell:
+        return CompactSetCell(self, x, y)
+
+    def is_special(self, x: int, y: int) -> bool:
+        return bool(self.special_bits[x, y >> 3] >> (7 - (y & 7)) & 1) != (self.grid_state.specials % 2 == 1)
+
+    def toggle_special(self, x: int, y: int) -> None:
+        self.special_bits[x, y >> 3] ^= 1 << (7 - (y & 7))
+
+    def is_special_many(self, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        """is_special of each square (xs[k], ys[k]). Complexity: O(len(xs)) vectorised work."""
+        bits = self.special_bits[xs, ys >> 3] >> (7 - (ys & 7)) & 1
+        return bits.astype(bool) != (self.grid_state.specials % 2 == 1)
+
+    def written_squares(self) -> tuple[np.ndarray, np.ndarray]:
+        """Squares with a layer or their own special flag. Complexity: O(x*y) vectorised work."""
+        special = np.unpackbits(self.special_bits, axis=1)[:, :self.y]
+        return np.nonzero((self.layers >= 0) | special.astype(bool))
+
+    def add_many(self, layer: Layer, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        """Complexity: O(len(xs)) vectorised work."""
+        changed = self.layers[xs, ys] != layer.index
+        self.layers[xs[changed], ys[changed]] = layer.index
+        self.grid_state.mark_dirty_many(xs[changed], ys[changed])
+        return changed
+
+    def erase_many(self, layer: Layer, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        """Complexity: O(len(xs)) vectorised work."""
+        changed = self.layers[xs, ys] >= 0
+        self.layers[xs[changed], ys[changed]] = -1
+        self.grid_state.mark_dirty_many(xs[changed], ys[changed])
+        return changed
+
+    def set_signatures(self, signatures: list, ids: np.ndarray, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        """
+        Square (xs[k], ys[k]) gets signatures[ids[k]]: the layer index is written directly, and the special bit
+        flipped on the squares whose flag differs.
+        Complexity: O(len(xs) + len(signatures)) vectorised work.
+        """
+        indices = np.array([layers[0] if layers else -1 for layers, _ in signatures], dtype=np.int8)[ids]
+        flip = self.is_special_many(xs, ys) != np.array([inverted for _, inverted in signatures], dtype=bool)[ids]
+        changed = (self.layers[xs, ys] != indices) | flip
+        self.layers[xs, ys] = indices
+        # Squares of one column can share a byte of the bitplane, so flip with an unbuffered xor.
+        np.bitwise_xor.at(self.special_bits, (xs[flip], ys[flip] >> 3), (1 << (7 - (ys[flip] & 7))).astype(np.uint8))
+        self.grid_state.mark_dirty_many(xs[changed], ys[changed])
+        return changed
+
+    def group_cells(self, xs: np.ndarray, ys: np.ndarray) -> dict:
+        """Complexity: O(len(xs) log len(xs)), all squares are grouped with one vectorised sort."""
+        keys = (self.layers[xs, ys].astype(np.int64) + 1) * 2 + self.is_special_many(xs, ys)
+        return group_by_key(keys, xs, ys, lambda key: (
+            () if key // 2 == 0 else (int(key // 2 - 1),),
+            bool(key % 2),
+        ))
+
+
+class CompactSequenceStorage:
+    """
+    SEQUENCE draw style stored as one uint32 array: bit i of a square's mask is set when the layer with index i is
+    applied. There are at most 20 layers (see layer_util.LAYERS), so a mask always fits, and add and erase are a single
+    bit operation. Applied layers come out in index order by walking the set bits.
+    """
+
+    def __init__(self, store_class, grid_state, x: int, y: int) -> None:
+        if store_class is not SequenceLayerStore:
+            raise ValueError("Compact sequence storage only supports the SEQUENCE draw style.")
+        self.x = x
+        self.y = y
+        self.grid_state = grid_state
+        self.masks = np.zeros((x, y), dtype=np.uint32)
+        # Grid-wide specials already applied to self.masks.
+        self.specials_applied = 0
+
+    def __getitem__(self, index) -> CompactColumn:
+        if not 0 <= index < self.x:
+            raise IndexError(index)
+        return CompactColumn(self, index)
+
+    def cell(self, x: int, y: int) -> CompactSequenceCell:
+        return CompactSequenceCell(self, x, y)
+
+    def sync(self) -> None:
+        """
+        Applies the grid-wide specials made since the last sync, all at once. Squares with the same mask lose the
+        same layers, so the specials are worked out once per distinct mask and written back with one remap.
+        Complexity: O(1) if there are none, otherwise O(x*y log(x*y)) vectorised work plus O(m * L^2 log L)
+        for m distinct masks of at most L layers.
+        """
+        pending = self.grid_state.specials - self.specials_applied
+        if not pending:
+            return
+        self.specials_applied = self.grid_state.specials
+        masks, inverse = np.unique(self.masks, return_inverse=True)
+        specials = np.array([mask_after_specials(int(mask), pending) for mask in masks], dtype=np.uint32)
+        if (specials != masks).any():
+            self.masks = specials[inverse].reshape(self.x, self.y)
+
+    def add_many(self, layer: Layer, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        """Complexity: O(len(xs)) vectorised work."""
+        self.sync()
+        bit = np.uint32(1 << layer.index)
+        changed = self.masks[xs, ys] & bit == 0
+        self.masks[xs[changed], ys[changed]] |= bit
+        self.grid_state.mark_dirty_many(xs[changed], ys[changed])
+        return changed
+
+    def erase_many(self, layer: Layer, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        """Complexity: O(len(xs)) vectorised work."""
+        self.sync()
+        bit = np.uint32(1 << layer.index)
+        changed = self.masks[xs, ys] & bit != 0
+        self.masks[xs[changed], ys[changed]] &= ~bit
+        self.grid_state.mark_dirty_many(xs[changed], ys[changed])
+        return changed
+
+    def set_signatures(self, signatures: list, ids: np.ndarray, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        """Complexity: O(len(xs) + len(signatures) * L) vectorised work, the masks are written directly."""
+        self.sync()
+        masks = np.array([layers_mask(layers) for layers, _ in signatures], dtype=np.uint32)[ids]
+        changed = self.masks[xs, ys] != masks
+        self.masks[xs[changed], ys[changed]] = masks[changed]
+        self.grid_state.mark_dirty_many(xs[changed], ys[changed])
+        return changed
+
+    def written_squares(self) -> tuple[np.ndarray, np.ndarray]:
+        """Squares with a layer. Complexity: O(x*y) vectorised work."""
+        self.sync()
+        return np.nonzero(self.masks)
+
+    def group_cells(self, xs: np.ndarray, ys: np.ndarray) -> dict:
+        """Complexity: O(len(xs) log len(xs)), masks are compared directly as integers."""
+        self.sync()
+        return group_by_key(self.masks[xs, ys].astype(np.int64), xs, ys, lambda mask: (mask_layers(mask), False))
+
+
+_MASK_LAYERS: dict[int, tuple[int, ...]] = {}
+
+
+def mask_layers(mask: int) -> tuple[int, ...]:
+    """
+    Returns the indices of the layers set in a SEQUENCE bitmask, lowest index first.
+    Complexity: O(1) for a mask seen before, otherwise O(number of set bits).
+    """
+    indices = _MASK_LAYERS.get(mask)
+    if indices is None:
+        indices = []
+        rest = mask
+        while rest:
+            lowest = rest & -rest
+            indices.append(lowest.bit_length() - 1)
+            rest ^= lowest
+        indices = _MASK_LAYERS[mask] = tuple(indices)
+    return indices
+
+
+def layers_mask(indices: tuple[int, ...]) -> int:
+    """The SEQUENCE bitmask of a set of layer indices, the inverse of mask_layers."""
+    mask = 0
+    for index in indices:
+        mask |= 1 << index
+    return mask
+
+
+def mask_after_special(mask: int) -> int:
+    """Returns a SEQUENCE bitmask with the layer of median name removed, as SequenceLayerStore.special does."""
+    layers = [LAYERS[i] for i in mask_layers(mask)]
+    if not layers:
+        return mask
+    return mask & ~(1 << layers[median_name_position(layers)].index)
+
+
+class CompactAdditiveStorage:
+    """
+    ADD draw style stored as one uint32 array of stack ids, indexing the shared table of interned stacks (STACKS).
+    A brushed region holds one stack, so its squares share one node instead of a queue each, and painting it
+    again moves every square to the same next node.
+    An odd number of grid-wide specials reverses every stack, so the stored id is of the reversed stack until then.
+    """
+
+    def __init__(self, store_class, grid_state, x: int, y: int) -> None:
+        if store_class is not AdditiveLayerStore:
+            raise ValueError(f"Compact additive storage doesn't support {store_class.__name__}.")
+        self.x = x
+        self.y = y
+        self.grid_state = grid_state
+        self.table = STACKS
+        self.stack_ids = np.full((x, y), self.table.empty.id, dtype=np.uint32)
+
+    def __getitem__(self, index) -> CompactColumn:
+        if not 0 <= index < self.x:
+            raise IndexError(index)
+        return CompactColumn(self, index)
+
+    def cell(self, x: int, y: int) -> CompactAdditiveCell:
+        return CompactAdditiveCell(self, x, y)
+
+    def node_of(self, stack_id: int) -> StackNode:
+        """The stack a square with this stored id holds, after grid-wide specials."""
+        node = self.table[stack_id]
+        return node.reversed() if self.grid_state.specials % 2 == 1 else node
+
+    def id_of(self, node: StackNode) -> int:
+        """The id to store for a square holding this stack, the inverse of node_of."""
+        return (node.reversed() if self.grid_state.specials % 2 == 1 else node).id
+
+    def add_many(self, layer: Layer, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        """
+        Squares holding the same stack all move to the same pushed stack, found once per distinct stack.
+        Complexity: O(len(xs) log len(xs)) vectorised work plus O(1) per distinct stack pushed before.
+        """
+        return self._move_many(xs, ys, lambda node: (
+            node if len(node) >= AdditiveLayerStore.MAX_LAYERS else node.push(layer.index)
+        ))
+
+    def erase_many(self, layer: Layer, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        """
+        The first layer added is erased, whatever the layer, as AdditiveLayerStore.erase does.
+        Complexity: O(len(xs) log len(xs)) vectorised work plus O(1) per distinct stack erased before.
+        """
+        return self._move_many(xs, ys, lambda node: node.erase_first())
+
+    def set_signatures(self, signatures: list, ids: np.ndarray, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        """Complexity: O(len(xs)) vectorised work, plus interning each stack of the table once."""
+        stack_ids = np.array([self.id_of(self.table.intern(layers)) for layers, _ in signatures], dtype=np.uint32)[ids]
+        changed = self.stack_ids[xs, ys] != stack_ids
+        self.stack_ids[xs[changed], ys[changed]] = stack_ids[changed]
+        self.grid_state.mark_dirty_many(xs[changed], ys[changed])
+        return changed
+
+    def _move_many(self, xs: np.ndarray, ys: np.ndarray, move) -> np.ndarray:
+        """Moves each square (xs[k], ys[k]) from its stack to move(stack), calling move once per distinct stack."""
+        ids, inverse = np.unique(self.stack_ids[xs, ys], return_inverse=True)
+        moved = np.array([self.id_of(move(self.node_of(int(stack_id)))) for stack_id in ids], dtype=np.uint32)
+        changed = (moved != ids)[inverse]
+        self.stack_ids[xs[changed], ys[changed]] = moved[inverse][changed]
+        self.grid_state.mark_dirty_many(xs[changed], ys[changed])
+        return changed
+
+    def written_squares(self) -> tuple[np.ndarray, np.ndarray]:
+        """Squares with a layer. Complexity: O(x*y) vectorised work."""
+        return np.nonzero(self.stack_ids != self.table.empty.id)
+
+    def group_cells(self, xs: np.ndarray, ys: np.ndarray) -> dict:
+        """Complexity: O(len(xs) log len(xs)), squares are grouped by stack id."""
+        return group_by_key(self.stack_ids[xs, ys].astype(np.int64), xs, ys, lambda i: (self.node_of(i).layers, False))
+
+
+def mask_after_specials(mask: int, count: int) -> int:
+    """Returns a SEQUENCE bitmask after `count` specials, each removing a layer (so at most popcount of them matter)."""
+    for _ in range(min(count, len(mask_layers(mask)))):
+        mask = mask_after_special(mask)
+    return mask
+
+
+def compact_storage(store_class, grid_state, x: int, y: int):
+    """
+    Grid.STORAGE_COMPACT: the array backed storage for the draw style.
+    RAISE: ValueError if the draw style has no compact storage.
+    """
+    if store_class is SequenceLayerStore:
+        return CompactSequenceStorage(store_class, grid_state, x, y)
+    if store_class is AdditiveLayerStore:
+        return CompactAdditiveStorage(store_class, grid_state, x, y)
+    return CompactSetStorage(store_class, grid_state, x, y)
+
+
+def group_by_key(keys: np.ndarray, xs: np.ndarray, ys: np.ndarray, decode) -> dict:
+    """Group (xs, ys) by integer key, with decode turning each distinct key into a signature."""
+    order = np.argsort(keys, kind="stable")
+    keys, xs, ys = keys[order], xs[order], ys[order]
+    unique, starts = np.unique(keys, return_index=True)
+    ends = np.append(starts[1:], len(keys))
+    return {
+        decode(int(key)): (xs[start:end], ys[start:end])
+        for key, start, end in zip(unique, starts, ends)
+    }
+
+
+class CompactColumn:
+    """grid[x] for compact storage, so grid[x][y] gives a view of one square."""
+
+    def __init__(self, storage, x: int) -> None:
+        self.storage = storage
+        self.x = x
+
+    def __len__(self) -> int:
+        return self.storage.y
+
+    def __getitem__(self, index) -> LayerStore:
+        if not 0 <= index < self.storage.y:
+            raise IndexError(index)
+        return self.storage.cell(self.x, index)
+
+
+class CompactSetCell(LayerStore):
+    """
+    A SetLayerStore view of one square of CompactSetStorage.
+    Views are created on access and hold no state of their own.
+    """
+
+    def __init__(self, storage: CompactSetStorage, x: int, y: int) -> None:
+        self.storage = storage
+        self.watch(storage.grid_state, x, y)
+
+    @property
+    def layer(self) -> Layer | None:
+        index = self.storage.layers[self._position]
+        return None if index < 0 else LAYERS[int(index)]
+
+    def add(self, layer: Layer) -> bool:
+        if self.storage.layers[self._position] == layer.index:
+            return False
+        self.storage.layers[self._position] = layer.index
+        self._changed()
+        return True
+
+    def erase(self, layer: Layer) -> bool:
+        if self.storage.layers[self._position] < 0:
+            return False
+        self.storage.layers[self._position] = -1
+        self._changed()
+        return True
+
+    def special(self):
+        self.storage.toggle_special(*self._position)
+        self._changed()
+
+    def set_signature(self, signature: tuple[tuple[int, ...], bool]) -> bool:
+        """Writes the layer index and special flag directly. Complexity: O(1)"""
+        layers, inverted = signature
+        index = layers[0] if layers else -1
+        flip = self.is_inverted() != inverted
+        if self.storage.layers[self._position] == index and not flip:
+            return False
+        self.storage.layers[self._position] = index
+        if flip:
+            self.storage.toggle_special(*self._position)
+        self._changed()
+        return True
+
+    def applied_layers(self) -> list[Layer]:
+        layer = self.layer
+        return [] if layer is None else [layer]
+
+    def is_inverted(self) -> bool:
+        return self.storage.is_special(*self._position)
+
+    def get_color(self, start, timestamp, x, y) -> tuple[int, int, int]:
+        color = self.compiled().apply(start, timestamp, x, y)
+        if self.is_inverted():
+            color = (255-color[0], 255-color[1], 255-color[2])
+        return tuple(color)
+
+
+class CompactSequenceCell(LayerStore):
+    """
+    A SequenceLayerStore view of one square of CompactSequenceStorage.
+    Views are created on access and hold no state of their own.
+    """
+
+    def __init__(self, storage: CompactSequenceStorage, x: int, y: int) -> None:
+        self.storage = storage
+        self.watch(storage.grid_state, x, y)
+
+    @property
+    def mask(self) -> int:
+        self.storage.sync()
+        return int(self.storage.masks[self._position])
+
+    def _set_mask(self, mask: int) -> None:
+        self.storage.masks[self._position] = mask
+        self._changed()
+
+    def add(self, layer: Layer) -> bool:
+        if self.mask >> layer.index & 1:
+            return False # already applied
+        self._set_mask(self.mask | 1 << layer.index)
+        return True
+
+    def erase(self, layer: Layer) -> bool:
+        if not self.mask >> layer.index & 1:
+            return False
+        self._set_mask(self.mask & ~(1 << layer.index))
+        return True
+
+    def special(self):
+        mask = mask_after_special(self.mask)
+        if mask != self.mask:
+            self._set_mask(mask)
+
+    def set_signature(self, signature: tuple[tuple[int, ...], bool]) -> bool:
+        """Writes the mask directly. Complexity: O(number of layers)"""
+        mask = layers_mask(signature[0])
+        if mask == self.mask:
+            return False
+        self._set_mask(mask)
+        return True
+
+    def applied_layers(self) -> list[Layer]:
+        return [LAYERS[i] for i in mask_layers(self.mask)]
+
+    def signature(self) -> tuple[tuple[int, ...], bool]:
+        return mask_layers(self.mask), False
+
+    def get_color(self, start, timestamp, x, y) -> tuple[int, int, int]:
+        return tuple(self.compiled().apply(start, timestamp, x, y))
+
+
+class CompactAdditiveCell(LayerStore):
+    """
+    An AdditiveLayerStore view of one square of CompactAdditiveStorage.
+    Views are created on access and hold no state of their own.
+    """
+
+    def __init__(self, storage: CompactAdditiveStorage, x: int, y: int) -> None:
+        self.storage = storage
+        self.watch(storage.grid_state, x, y)
+
+    @property
+    def node(self) -> StackNode:
+        return self.storage.node_of(int(self.storage.stack_ids[self._position]))
+
+    def _set_node(self, node: StackNode) -> None:
+        self.storage.stack_ids[self._position] = self.storage.id_of(node)
+        self._changed()
+
+    def add(self, layer: Layer) -> bool:
+        node = self.node
+        if len(node) >= AdditiveLayerStore.MAX_LAYERS:
+            return False # maximum layers reached
+        self._set_node(node.push(layer.index))
+        return True
+
+    def erase(self, layer: Layer) -> bool:
+        node = self.node
+        if not len(node):
+            return False # no layers to erase
+        self._set_node(node.erase_first())
+        return True
+
+    def special(self):
+        node = self.node
+        if len(node) > 1:
+            self._set_node(node.reversed())
+
+    def set_signature(self, signature: tuple[tuple[int, ...], bool]) -> bool:
+        """Writes the interned stack id directly. Complexity: O(number of layers) to intern the stack."""
+        node = self.storage.table.intern(signature[0])
+        if self.node is node:
+            return False
+        self._set_node(node)
+        return True
+
+    def applied_layers(self) -> list[Layer]:
+        return [LAYERS[i] for i in self.node.layers]
+
+    def signature(self) -> tuple[tuple[int, ...], bool]:
+        return self.node.layers, False
+
+    def compiled(self):
+        return self.node.compiled
+
+    def get_color(self, start, timestamp, x, y) -> tuple[int, int, int]:
+        return self.node.color(start, timestamp, x, y)
+
+
+class SparseStorage:
+    """
+    LayerStores are only created for squares that have been written to.
+    Squares are grouped into CHUNK x CHUNK chunks, and a chunk's array is only allocated when one of its squares is.
+    A square that was never written shows the starting colour (inverted if the grid has an odd number of specials
+    and the SET style is used), so construction time and memory scale with the painted area.
+    """
+
+    CHUNK = 32
+
+    def __init__(self, store_class, grid_state, x: int, y: int) -> None:
+        self.store_class = store_class
+        self.grid_state = grid_state
+        self.x = x
+        self.y = y
+        self.chunks = {}
+
+    def __getitem__(self, index) -> SparseColumn:
+        if not 0 <= index < self.x:
+            raise IndexError(index)
+        return SparseColumn(self, index)
+
+    def get(self, x: int, y: int) -> LayerStore | None:
+        """The store of square (x, y), or None if it hasn't been allocated."""
+        chunk = self.chunks.get((x // SparseStorage.CHUNK, y // SparseStorage.CHUNK))
+        if chunk is None:
+            return None
+        return chunk[(x % SparseStorage.CHUNK) * SparseStorage.CHUNK + y % SparseStorage.CHUNK]
+
+    def allocate(self, x: int, y: int) -> LayerStore:
+        """
+        Returns the store of square (x, y), creating it (and its chunk) if needed.
+        Complexity: O(1), or O(CHUNK^2) the first time a chunk is used.
+        """
+        key = (x // SparseStorage.CHUNK, y // SparseStorage.CHUNK)
+        chunk = self.chunks.get(key)
+        if chunk is None:
+            chunk = self.chunks[key] = ArrayR(SparseStorage.CHUNK * SparseStorage.CHUNK)
+        offset = (x % SparseStorage.CHUNK) * SparseStorage.CHUNK + y % SparseStorage.CHUNK
+        store = chunk[offset]
+        if store is None:
+            store = chunk[offset] = self.store_class()
+            store.watch(self.grid_state, x, y) # the new store catches up with grid-wide specials itself
+        return store
+
+    def vacant_inverted(self) -> bool:
+        return self.store_class is SetLayerStore and self.grid_state.specials % 2 == 1
+
+    def written_squares(self) -> tuple[np.ndarray, np.ndarray]:
+        """Squares with a store. Complexity: O(CHUNK^2) per allocated chunk."""
+        xs, ys = [], []
+        for (cx, cy), chunk in self.chunks.items():
+            for offset in range(len(chunk)):
+                if chunk[offset] is not None:
+                    xs.append(cx * SparseStorage.CHUNK + offset // SparseStorage.CHUNK)
+                    ys.append(cy * SparseStorage.CHUNK + offset % SparseStorage.CHUNK)
+        return np.array(xs, dtype=np.intp), np.array(ys, dtype=np.intp)
+
+    def group_cells(self, xs: np.ndarray, ys: np.ndarray) -> dict:
+        """
+        Squares in chunks that were never allocated are grouped with one vectorised test, only squares in allocated
+        chunks are looked up one at a time.
+        Complexity: O(len(xs)) vectorised work plus O(number of those squares in allocated chunks) lookups.
+        """
+        groups = {}
+        vacant_key = ((), self.vacant_inverted())
+        if self.chunks:
+            columns = (self.y + SparseStorage.CHUNK - 1) // SparseStorage.CHUNK
+            chunk_ids = (xs // SparseStorage.CHUNK) * columns + ys // SparseStorage.CHUNK
+            allocated = np.isin(chunk_ids, [cx * columns + cy for (cx, cy) in self.chunks])
+        else:
+            allocated = np.zeros(len(xs), dtype=bool)
+        for i, j in zip(xs[allocated].tolist(), ys[allocated].tolist()):
+            store = self.get(i, j)
+            key = vacant_key if store is None else store.signature()
+            if key not in groups:
+                groups[key] = ([], [])
+            groups[key][0].append(i)
+            groups[key][1].append(j)
+        groups = {
+            key: (np.array(gx, dtype=np.intp), np.array(gy, dtype=np.intp))
+            for key, (gx, gy) in groups.items()
+        }
+        if not allocated.all():
+            gx, gy = groups.get(vacant_key, ((), ()))
+            groups[vacant_key] = (
+                np.concatenate([xs[~allocated], gx]).astype(np.intp), np.concatenate([ys[~allocated], gy]).astype(np.intp),
+            )
+        return groups
+
+
+class SparseColumn:
+    """grid[x] for sparse storage."""
+
+    def __init__(self, storage: SparseStorage, x: int) -> None:
+        self.storage = storage
+        self.x = x
+
+    def __len__(self) -> int:
+        return self.storage.y
+
+    def __getitem__(self, index) -> LayerStore:
+        if not 0 <= index < self.storage.y:
+            raise IndexError(index)
+        store = self.storage.get(self.x, index)
+        if store is None:
+            return VacantCell(self.storage, self.x, index)
+        return store
+
+
+class VacantCell(LayerStore):
+    """
+    Stands in for a square of SparseStorage that hasn't been allocated.
+    Reading it allocates nothing, the first change allocates the real store and hands over to it.
+    """
+
+    def __init__(self, storage: SparseStorage, x: int, y: int) -> None:
+        self.storage = storage
+        self.x = x
+        self.y = y
+
+    def add(self, layer: Layer) -> bool:
+        return self.storage.allocate(self.x, self.y).add(layer)
+
+    def erase(self, layer: Layer) -> bool:
+        return False # nothing to erase
+
+    def special(self):
+        self.storage.allocate(self.x, self.y).special()
+
+    def applied_layers(self) -> list[Layer]:
+        return []
+
+    def is_inverted(self) -> bool:
+        return self.storage.vacant_inverted()
+
+    def get_color(self, start, timestamp, x, y) -> tuple[int, int, int]:
+        if self.is_inverted():
+            return (255-start[0], 255-start[1], 255-start[2])
+        return tuple(start)
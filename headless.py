@@ -0,0 +1,159 @@
+"""
+Headless rendering and image export, with no arcade window (e.g. thumbnails on a server without a display).
+
+Images come from Grid.render_frame, so they show exactly what the window shows: each square is scale x scale pixels,
+and the top row of the image is the top row of the canvas (the largest y). PNG and binary PPM are written with the
+standard library only.
+
+Usage:  python -m headless SESSIONS OUT [--scale S] [--timestamp T] [--format png|ppm] [--workers N] [--glob PATTERN]
+
+Renders the final state of every saved session (journal, see journal.py) in the directory SESSIONS into OUT,
+one image per session named after its journal, across a pool of N worker processes (default: one per CPU).
+"""
+
+from __future__ import annotations
+import argparse
+import os
+import struct
+import sys
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import numpy as np
+import layers # registers every layer, so the layer indices in a journal resolve
+from grid import Grid
+from journal import Journal
+from replay import ReplayTracker
+
+IMAGE_FORMATS = ("png", "ppm")
+BACKGROUND = (255, 255, 255)
+
+
+def render_image(grid: Grid, timestamp=0, background=BACKGROUND, scale: int = 1) -> np.ndarray:
+    """
+    INPUTS: grid, timestamp and background (as for Grid.render_frame), scale (pixels per square side)
+    RAISE: ValueError if scale is less than 1
+    OUTPUTS: (grid.y * scale) x (grid.x * scale) x 3 uint8 array, top row first
+
+    Complexity: please refer to Grid.render_frame, plus O(pixels) to scale the frame.
+    """
+    if scale < 1:
+        raise ValueError(f"The scale must be at least 1, not {scale}.")
+    return scale_frame(grid.render_frame(timestamp, background), scale)
+
+
+def scale_frame(frame: np.ndarray, scale: int = 1) -> np.ndarray:
+    """
+    The image of a frame from Grid.render_frame (bottom row first): flipped to put the top row first, and each square
+    made scale x scale pixels. Complexity: O(pixels)
+    """
+    frame = frame[::-1]
+    if scale > 1:
+        frame = frame.repeat(scale, axis=0).repeat(scale, axis=1)
+    return np.ascontiguousarray(frame)
+
+
+def encode_ppm(pixels: np.ndarray) -> bytes:
+    """Binary (P6) PPM of an H x W x 3 uint8 array."""
+    height, width, _ = pixels.shape
+    return b"P6\n%d %d\n255\n" % (width, height) + pixels.tobytes()
+
+
+def png_chunk(kind: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+
+def encode_png(pixels: np.ndarray, level: int = 6) -> bytes:
+    """
+    8-bit RGB PNG of an H x W x 3 uint8 array, with no row filter (filter type 0 in front of every row).
+    Complexity: O(pixels), mostly zlib.
+    """
+    height, width, _ = pixels.shape
+    rows = np.zeros((height, width * 3 + 1), dtype=np.uint8)
+    rows[:, 1:] = pixels.reshape(height, width * 3)
+    return b"".join([
+        b"\x89PNG\r\n\x1a\n",
+        png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)),
+        png_chunk(b"IDAT", zlib.compress(rows.tobytes(), level)),
+        png_chunk(b"IEND", b""),
+    ])
+
+
+def write_image(path, grid: Grid, timestamp=0, background=BACKGROUND, scale: int = 1) -> None:
+    """
+    Writes the grid to `path` as PNG or PPM, picked by the file extension.
+
+    RAISE: ValueError if the extension isn't one of IMAGE_FORMATS, or scale is less than 1
+    """
+    image_format = Path(path).suffix.lower().lstrip(".")
+    if image_format not in IMAGE_FORMATS:
+        raise ValueError(f"Can only write {', '.join(IMAGE_FORMATS)} images, not {path}.")
+    pixels = render_image(grid, timestamp, background, scale)
+    with open(path, "wb") as f:
+        f.write(encode_png(pixels) if image_format == "png" else encode_ppm(pixels))
+
+
+def render_session(journal_path, image_path, timestamp=0, background=BACKGROUND, scale: int = 1) -> None:
+    """
+    Replays a saved session on a compact grid and writes its final state as an image.
+
+    RAISE: ValueError if journal_path isn't a journal (see Journal)
+    Complexity: please refer to ReplayTracker.replay_all and render_image.
+    """
+    with Journal(journal_path) as journal:
+        grid = Grid(journal.draw_style, journal.x, journal.y, storage=Grid.STORAGE_COMPACT)
+        ReplayTracker.from_journal(journal).replay_all(grid)
+    write_image(image_path, grid, timestamp, background, scale)
+
+
+def render_sessions(sessions: list, out_dir, image_format: str = "png", workers: int | None = None,
+                    timestamp=0, background=BACKGROUND, scale: int = 1) -> dict:
+    """
+    Renders every session to out_dir/<session name>.<image_format>, each in its own worker process.
+
+    INPUTS: sessions (journal paths), out_dir, image_format, workers (None for one per CPU), and the render
+    settings of render_session
+    RAISE: None, a session that fails is reported in the result
+    OUTPUTS: dictionary of journal path -> image path, or the error it failed with
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for session in sessions:
+            image = os.path.join(out_dir, f"{Path(session).stem}.{image_format}")
+            futures[session] = (image, pool.submit(render_session, session, image, timestamp, background, scale))
+        for session, (image, future) in futures.items():
+            try:
+                future.result()
+                results[session] = image
+            except Exception as e: # any failure, e.g. a journal painting outside its grid, stays with its session
+                results[session] = e
+    return results
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Render saved painting sessions to images, with no window.")
+    parser.add_argument("sessions", help="directory of saved sessions (journals)")
+    parser.add_argument("out", help="directory to write the images to")
+    parser.add_argument("--scale", type=int, default=1, help="pixels per square side")
+    parser.add_argument("--timestamp", type=float, default=0, help="time to render animated layers at")
+    parser.add_argument("--format", choices=IMAGE_FORMATS, default="png")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: one per CPU)")
+    parser.add_argument("--glob", default="*", help="pattern of the session files in the directory")
+    args = parser.parse_args(argv)
+
+    sessions = sorted(str(path) for path in Path(args.sessions).glob(args.glob) if path.is_file())
+    results = render_sessions(sessions, args.out, args.format, args.workers, args.timestamp, BACKGROUND, args.scale)
+    failed = 0
+    for session, result in results.items():
+        if isinstance(result, Exception):
+            failed += 1
+            print(f"{session}: {result}", file=sys.stderr)
+        else:
+            print(f"{session} -> {result}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
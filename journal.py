@@ -0,0 +1,229 @@
+"""
+Append-only binary journal of a session's actions, so a session survives the process that painted it.
+
+File layout (all integers are unsigned LEB128 varints unless noted):
+- Header: the magic b"PJNL", a version byte, the draw style (length, then ASCII), the grid width and height,
+  then a CRC-32 of everything before it (4 bytes, little-endian).
+- Records, one per action: the payload length, the payload, then a CRC-32 of the payload (4 bytes, little-endian).
+  The payload is a flags byte (FLAG_SPECIAL, FLAG_UNDO) followed by the action's runs (see PaintAction): the number
+  of runs, then x, first y, length and layer index of each run. Undo records have no runs.
+
+Records are only ever appended, through a buffered file. A crash can leave at most the last record torn: Journal
+stops at the first record that is incomplete or fails its checksum, so it always reads the last consistent prefix,
+and JournalWriter cuts such a tail off before it appends to an existing journal.
+"""
+
+from __future__ import annotations
+import mmap
+import os
+import struct
+import zlib
+from action import PaintAction
+
+MAGIC = b"PJNL"
+VERSION = 1
+
+FLAG_SPECIAL = 1
+FLAG_UNDO = 2
+
+CRC = struct.Struct("<I")
+
+
+def encode_varint(value: int, out: bytearray) -> None:
+    """Appends `value` (>= 0) to `out`, 7 bits per byte, lowest first. Complexity: O(log value)"""
+    while value >= 0x80:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decode_varint(data, offset: int) -> tuple[int, int]:
+    """
+    Reads a varint of `data` at `offset`.
+
+    RAISE: IndexError if the data ends inside the varint
+    OUTPUTS: the value, and the offset just after it
+    """
+    value = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def encode_header(draw_style: str, x: int, y: int) -> bytes:
+    out = bytearray(MAGIC)
+    out.append(VERSION)
+    style = draw_style.encode("ascii")
+    encode_varint(len(style), out)
+    out += style
+    encode_varint(x, out)
+    encode_varint(y, out)
+    out += CRC.pack(zlib.crc32(out))
+    return bytes(out)
+
+
+def decode_header(data) -> tuple[str, int, int, int]:
+    """
+    RAISE: ValueError if `data` doesn't start with a valid journal header
+    OUTPUTS: draw style, x, y, and the offset of the first record
+    """
+    try:
+        if bytes(data[:len(MAGIC)]) != MAGIC or data[len(MAGIC)] != VERSION:
+            raise ValueError("Not a version 1 paint journal.")
+        length, offset = decode_varint(data, len(MAGIC) + 1)
+        draw_style = bytes(data[offset:offset + length]).decode("ascii")
+        x, offset = decode_varint(data, offset + length)
+        y, offset = decode_varint(data, offset)
+        checksum, = CRC.unpack_from(data, offset)
+    except (IndexError, struct.error, UnicodeDecodeError):
+        raise ValueError("The paint journal's header is incomplete.")
+    if checksum != zlib.crc32(data[:offset]):
+        raise ValueError("The paint journal's header is corrupt.")
+    return draw_style, x, y, offset + CRC.size
+
+
+def encode_record(action: PaintAction, is_undo: bool) -> bytes:
+    """Complexity: O(number of runs in the action)"""
+    payload = bytearray([(FLAG_SPECIAL if action.is_special else 0) | (FLAG_UNDO if is_undo else 0)])
+    runs = [] if is_undo else zip(action.run_xs, action.run_ys, action.run_lengths, action.run_layers)
+    encode_varint(0 if is_undo else len(action.run_xs), payload) # an undo is replayed from the history, not its squares
+    for run in runs:
+        for value in run:
+            encode_varint(value, payload)
+    out = bytearray()
+    encode_varint(len(payload), out)
+    out += payload
+    out += CRC.pack(zlib.crc32(payload))
+    return bytes(out)
+
+
+def decode_payload(payload) -> tuple[PaintAction, bool]:
+    """Complexity: O(number of runs in the action)"""
+    flags = payload[0]
+    action = PaintAction(is_special=bool(flags & FLAG_SPECIAL))
+    runs, offset = decode_varint(payload, 1)
+    for _ in range(runs):
+        for column in (action.run_xs, action.run_ys, action.run_lengths, action.run_layers):
+            value, offset = decode_varint(payload, offset)
+            column.append(value)
+    return action, bool(flags & FLAG_UNDO)
+
+
+class Journal:
+    """
+    Reads a journal through a read-only memory map, so records are decoded from the file as they are needed rather
+    than loaded up front. Only the offset of each record is kept in memory, found by one pass over the file when the
+    journal is opened. That pass stops at the first torn or corrupt record: `end` is where the consistent prefix ends.
+
+    Works as a sequence of (action, is_undo), the entries a ReplayTracker plays (see ReplayTracker.from_journal).
+    """
+
+    def __init__(self, path: str) -> None:
+        """
+        RAISE: ValueError if the file isn't a journal
+        Complexity: O(size of the file), each record is checked once.
+        """
+        self.path = path
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        self.draw_style, self.x, self.y, offset = decode_header(self.data)
+        self.offsets = []
+        while True:
+            try:
+                length, start = decode_varint(self.data, offset)
+                checksum, = CRC.unpack_from(self.data, start + length)
+            except (IndexError, struct.error):
+                break
+            if checksum != zlib.crc32(self.data[start:start + length]):
+                break
+            self.offsets.append(offset)
+            offset = start + length + CRC.size
+        self.end = offset
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def __getitem__(self, index: int) -> tuple[PaintAction, bool]:
+        """Complexity: O(size of the record)"""
+        length, start = decode_varint(self.data, self.offsets[index])
+        return decode_payload(self.data[start:start + length])
+
+    def __iter__(self):
+        for index in range(len(self.offsets)):
+            yield self[index]
+
+    def is_complete(self) -> bool:
+        """False if the file ends with a torn or corrupt record, e.g. after a crash."""
+        return self.end == len(self.data)
+
+    def close(self) -> None:
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+    def __enter__(self) -> Journal:
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class JournalWriter:
+    """
+    Appends actions to a journal through a buffered file, so painting only pays for a memory copy per action and
+    the file is written a buffer at a time. Records still in the buffer are lost if the process dies, but the file
+    never holds more than one torn record.
+    """
+
+    BUFFER_SIZE = 64 * 1024
+
+    def __init__(self, path: str, draw_style: str, x: int, y: int, buffer_size: int = BUFFER_SIZE) -> None:
+        """
+        Continues the journal at `path` if there is one for the same draw style and size, after cutting off any torn
+        record at its end. Otherwise a new journal is started.
+
+        RAISE: ValueError if `path` is a journal of a different draw style or size
+        Complexity: O(size of an existing journal), which is checked once.
+        """
+        self.path = path
+        if os.path.exists(path) and os.path.getsize(path):
+            with Journal(path) as journal:
+                if (journal.draw_style, journal.x, journal.y) != (draw_style, x, y):
+                    raise ValueError(
+                        f"{path} is a journal of a {journal.x}x{journal.y} {journal.draw_style} grid, "
+                        f"not a {x}x{y} {draw_style} one."
+                    )
+                end = journal.end
+            self.file = open(path, "r+b", buffering=buffer_size)
+            self.file.truncate(end)
+            self.file.seek(end)
+        else:
+            self.file = open(path, "wb", buffering=buffer_size)
+            self.file.write(encode_header(draw_style, x, y))
+
+    def write(self, action: PaintAction, is_undo: bool = False) -> None:
+        """
+        Appends an action, or with is_undo an undo of it (only the flags of an undo are kept).
+        Complexity: O(number of runs in the action)
+        """
+        self.file.write(encode_record(action, is_undo))
+
+    def flush(self, sync: bool = False) -> None:
+        """Writes out the buffer, and with `sync` waits for it to reach the disk."""
+        self.file.flush()
+        if sync:
+            os.fsync(self.file.fileno())
+
+    def close(self) -> None:
+        if not self.file.closed:
+            self.file.close()
+
+    def __enter__(self) -> JournalWriter:
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
@@ -0,0 +1,113 @@
+"""
+LayerDeque: a growable ring buffer, used by AdditiveLayerStore and the undo history.
+
+Unlike a CircularQueue, it allocates nothing until the first item is added and then doubles its capacity as needed,
+so an empty square costs a few attributes and a square with n layers costs O(n) slots rather than a fixed 100.
+Reversing only flips a direction flag: items are then appended at the physical front and served from the physical back.
+"""
+
+from __future__ import annotations
+from data_structures.referential_array import ArrayR
+
+
+class LayerDeque:
+
+    MIN_CAPACITY = 2
+
+    def __init__(self) -> None:
+        """
+        Complexity: O(1), no array is allocated until the first append.
+        """
+        self.array = None
+        self.front = 0
+        self.length = 0
+        self.is_reversed = False
+
+    def __len__(self) -> int:
+        return self.length
+
+    def is_empty(self) -> bool:
+        return self.length == 0
+
+    def _slot(self, position: int) -> int:
+        """Physical index of the item at `position` in logical (oldest first) order."""
+        if self.is_reversed:
+            position = self.length - 1 - position
+        return (self.front + position) % len(self.array)
+
+    def _grow(self) -> None:
+        """
+        Doubles the capacity, copying the items to the start of the new array in physical order.
+        Complexity: O(len(self)), amortised O(1) per append.
+        """
+        if self.array is None:
+            self.array = ArrayR(LayerDeque.MIN_CAPACITY)
+            return
+        array = ArrayR(2 * len(self.array))
+        for i in range(self.length):
+            array[i] = self.array[(self.front + i) % len(self.array)]
+        self.array = array
+        self.front = 0
+
+    def append(self, item) -> None:
+        """
+        Adds item last.
+        Complexity: amortised O(1), O(len(self)) when the array has to grow.
+        """
+        if self.array is None or self.length == len(self.array):
+            self._grow()
+        if self.is_reversed:
+            self.front = (self.front - 1) % len(self.array)
+            self.array[self.front] = item
+        else:
+            self.array[(self.front + self.length) % len(self.array)] = item
+        self.length += 1
+
+    def serve(self):
+        """
+        Removes and returns the first (oldest) item.
+        RAISE: IndexError if the deque is empty.
+        Complexity: O(1)
+        """
+        if self.is_empty():
+            raise IndexError("Deque is empty")
+        slot = self._slot(0)
+        item = self.array[slot]
+        self.array[slot] = None
+        if not self.is_reversed:
+            self.front = (self.front + 1) % len(self.array)
+        self.length -= 1
+        return item
+
+    def pop(self):
+        """
+        Removes and returns the last (newest) item.
+        RAISE: IndexError if the deque is empty.
+        Complexity: O(1)
+        """
+        if self.is_empty():
+            raise IndexError("Deque is empty")
+        slot = self._slot(self.length - 1)
+        item = self.array[slot]
+        self.array[slot] = None
+        if self.is_reversed:
+            self.front = (self.front + 1) % len(self.array)
+        self.length -= 1
+        return item
+
+    def reverse(self) -> None:
+        """
+        Reverses the order of the items (first becomes last, etc.)
+        Complexity: O(1), only the direction flag changes.
+        """
+        self.is_reversed = not self.is_reversed
+
+    def __getitem__(self, position: int):
+        if not 0 <= position < self.length:
+            raise IndexError(position)
+        return self.array[self._slot(position)]
+
+    def __iter__(self):
+        """Iterates the items oldest first, without removing them."""
+        for position in range(self.length):
+            yield self.array[self._slot(position)]
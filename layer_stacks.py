@@ -0,0 +1,112 @@
+"""
+Interned (hash-consed) layer stacks.
+
+A stack is an immutable tuple of layer indices, applied first to last. A StackTable gives every distinct stack one
+StackNode with a small integer id, so squares holding the same stack share one node and storage only has to keep the id.
+Pushing a layer, erasing the first one or reversing the stack gives another interned node, and each node remembers the
+node it led to, so painting a region that already shares a stack finds the result with one lookup.
+
+Nodes compile their stack once (see stack_compiler.py), and stacks that only depend on the input colour memoise their
+colour per input colour.
+"""
+
+from __future__ import annotations
+from stack_compiler import CompiledStack, compile_stack
+
+
+class StackNode:
+
+    def __init__(self, table: StackTable, stack_id: int, layers: tuple[int, ...]) -> None:
+        self.table = table
+        self.id = stack_id
+        self.layers = layers
+        self._compiled = None
+        # Nodes reached from this one: by layer index pushed, by erasing the first layer and by reversing.
+        self._pushed = {}
+        self._erased = None
+        self._reversed = None
+        self._colors = {}
+
+    def __len__(self) -> int:
+        return len(self.layers)
+
+    @property
+    def compiled(self) -> CompiledStack:
+        if self._compiled is None:
+            self._compiled = compile_stack(self.layers)
+        return self._compiled
+
+    def push(self, index: int) -> StackNode:
+        """
+        The stack with layer `index` added last.
+        Complexity: O(1) if this push was done before, otherwise O(len(self)) to build and intern the new stack.
+        """
+        node = self._pushed.get(index)
+        if node is None:
+            node = self._pushed[index] = self.table.intern(self.layers + (index,))
+        return node
+
+    def erase_first(self) -> StackNode:
+        """
+        The stack without its first (oldest) layer, or this node if it is empty.
+        Complexity: O(1) if done before, otherwise O(len(self)).
+        """
+        if self._erased is None:
+            self._erased = self.table.intern(self.layers[1:])
+        return self._erased
+
+    def reversed(self) -> StackNode:
+        """
+        The stack in reverse order.
+        Complexity: O(1) if done before, otherwise O(len(self)).
+        """
+        if self._reversed is None:
+            self._reversed = self.table.intern(self.layers[::-1])
+            self._reversed._reversed = self
+        return self._reversed
+
+    def color(self, start, timestamp, x, y) -> tuple[int, int, int]:
+        """
+        The colour of a square holding this stack, given its starting colour.
+        Complexity: O(1) for a colour only stack seen with this start before, otherwise that of the compiled stack.
+        """
+        compiled = self.compiled
+        if not compiled.pure_in_color:
+            return tuple(compiled.apply(start, timestamp, x, y))
+        start = tuple(start)
+        color = self._colors.get(start)
+        if color is None:
+            color = self._colors[start] = tuple(compiled.apply(start, timestamp, x, y))
+        return color
+
+
+class StackTable:
+    """
+    Every distinct stack interned so far, by id. The empty stack always has id 0.
+    """
+
+    def __init__(self) -> None:
+        self.nodes = []
+        self.ids = {}
+        self.empty = self.intern(())
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def __getitem__(self, stack_id: int) -> StackNode:
+        return self.nodes[stack_id]
+
+    def intern(self, layers: tuple[int, ...]) -> StackNode:
+        """
+        The node of this stack, created (with the next id) if it is new.
+        Complexity: O(len(layers)) to hash the stack.
+        """
+        stack_id = self.ids.get(layers)
+        if stack_id is None:
+            stack_id = self.ids[layers] = len(self.nodes)
+            self.nodes.append(StackNode(self, stack_id, layers))
+        return self.nodes[stack_id]
+
+
+# The table shared by every in-memory grid.
+STACKS = StackTable()
@@ -1,15 +1,65 @@
 from __future__ import annotations
 from abc import ABC, abstractmethod
-from layer_util import Layer
-from data_structures.stack_adt import ArrayStack
-from data_structures.queue_adt import CircularQueue
+from layer_util import Layer, LAYERS
+from stack_compiler import compile_stack
+from layer_deque import LayerDeque
 from data_structures.array_sorted_list import *
 
 class LayerStore(ABC):
 
+    # Set by watch() when the store belongs to a grid, so changes can be reported to it.
+    _grid_state = None
+    _position = None
+
+    # Memo of the last colour returned by get_color, cleared whenever the store changes.
+    _memo_key = None
+    _memo_color = None
+    _time_invariant = None
+    # Compiled form of the applied layers, see stack_compiler.py. Also cleared whenever the store changes.
+    _compiled = None
+    # Number of grid-wide specials (GridState.specials) already applied to this store.
+    _specials_seen = 0
+
     def __init__(self) -> None:
         pass
 
+    def watch(self, grid_state, x: int, y: int) -> None:
+        """
+        Report every change of this store to `grid_state` as a change of square (x, y).
+        """
+        self._grid_state = grid_state
+        self._position = (x, y)
+
+    def _changed(self) -> None:
+        """
+        Called by add, erase and special whenever the store was actually changed.
+        """
+        self._memo_key = None
+        self._time_invariant = None
+        self._compiled = None
+        if self._grid_state is not None:
+            self._grid_state.mark_dirty(self._position)
+
+    def _catch_up(self) -> None:
+        """
+        Grid.special only counts grid-wide specials, each store applies the ones it hasn't seen yet when it is next used.
+        The grid already treats every square as changed, so catching up doesn't mark the square dirty again.
+        """
+        if self._grid_state is None or self._specials_seen == self._grid_state.specials:
+            return
+        pending = self._grid_state.specials - self._specials_seen
+        self._specials_seen = self._grid_state.specials
+        grid_state, self._grid_state = self._grid_state, None
+        for _ in range(self._specials_needed(pending)):
+            self.special()
+        self._grid_state = grid_state
+
+    def _specials_needed(self, pending: int) -> int:
+        """
+        How many calls to special have the same effect as `pending` of them.
+        """
+        return pending
+
     @abstractmethod
     def add(self, layer: Layer) -> bool:
         """
@@ -40,6 +90,71 @@ class LayerStore(ABC):
         """
         pass
 
+    @abstractmethod
+    def applied_layers(self) -> list[Layer]:
+        """
+        Returns the layers in the order get_color applies them.
+        """
+        pass
+
+    def is_inverted(self) -> bool:
+        """
+        Returns true if the final colour is inverted after all layers are applied.
+        """
+        return False
+
+    def _memo_key_for(self, start, timestamp, x, y) -> tuple:
+        """
+        Returns the key the memoised colour is stored under.
+        The timestamp is left out when the compiled stack is time invariant, so a static square keeps
+        its memo across frames until it is changed.
+        """
+        if self._time_invariant is None:
+            self._time_invariant = self.compiled().time_invariant
+        return (tuple(start), x, y, None if self._time_invariant else timestamp)
+
+    def compiled(self):
+        """
+        Returns the applied layers compiled into a single callable (see stack_compiler.py).
+        The compiled stack is shared with every other store applying the same layers.
+        """
+        if self._compiled is None:
+            self._compiled = compile_stack(tuple(layer.index for layer in self.applied_layers()))
+        return self._compiled
+
+    def signature(self) -> tuple[tuple[int, ...], bool]:
+        """
+        Returns a hashable description of how this square turns a starting colour into its output.
+        Two squares with the same signature show the same colour for the same start, timestamp and position.
+        """
+        return tuple(layer.index for layer in self.applied_layers()), self.is_inverted()
+
+    def set_signature(self, signature: tuple[tuple[int, ...], bool]) -> bool:
+        """
+        Changes the store so that signature() returns `signature`, using only add, erase and special.
+        Returns true if the LayerStore was actually changed.
+        """
+        if self.signature() == signature:
+            return False
+        layers, inverted = signature
+        for layer in self.applied_layers(): # erasing each applied layer once empties the store, for every style
+            self.erase(layer)
+        for index in layers:
+            self.add(LAYERS[index])
+        if self.is_inverted() != inverted:
+            self.special()
+        return True
+
+def median_name_position(layers: list[Layer]) -> int:
+    """
+    Returns the position in `layers` of the layer with the median `name`.
+    In the event of two layers being the median names, the lexicographically smaller one is picked.
+
+    Complexity: best = worst = O(n log n), where n is len(layers), since the layers are sorted by name.
+    """
+    names = sorted((layer.name, i) for i, layer in enumerate(layers))
+    return names[(len(names) - 1) // 2][1] # lower median when there is an even number of layers
+
 class SetLayerStore(LayerStore): # only one layer so no ADTs used
     """
     Set layer store. A single layer can be stored at a time (or nothing at all)
@@ -58,6 +173,9 @@ class SetLayerStore(LayerStore): # only one layer so no ADTs used
         self.layer = None
         self.is_special = False # special() func. won't be called
 
+    def _specials_needed(self, pending: int) -> int:
+        return pending % 2 # inverting twice changes nothing
+
     def add(self, layer: Layer) -> bool:
         """
         Add a layer to the store.
@@ -70,8 +188,10 @@ class SetLayerStore(LayerStore): # only one layer so no ADTs used
         Complexity: best = worst = O(1) in this case because only one layer is added, and any new layers will override the previous
         layer store. These operations are always constant.
         """
+        self._catch_up()
         if self.layer != layer: 
             self.layer = layer # add layer if there isn't one
+            self._changed()
             return True
         else:
             return False 
@@ -86,7 +206,11 @@ class SetLayerStore(LayerStore): # only one layer so no ADTs used
 
         Complexity: best = worst = O(1) because the input will tell the function which square to check the colour of. 
         """        
-        # Complexity: O()
+        self._catch_up()
+        key = self._memo_key_for(start, timestamp, x, y)
+        if key == self._memo_key:
+            return self._memo_color # unchanged since the last call
+
         if self.layer == None:
             color = start
         else:
@@ -96,7 +220,8 @@ class SetLayerStore(LayerStore): # only one layer so no ADTs used
         if self.is_special:
             color = (255-color[0],255-color[1],255-color[2])
         
-        return color
+        self._memo_key, self._memo_color = key, tuple(color)
+        return self._memo_color
     
     def erase(self,layer: Layer) -> bool:
         """
@@ -111,8 +236,10 @@ class SetLayerStore(LayerStore): # only one layer so no ADTs used
         Complexity: best = worst = O(1), because there is only one layer to remove/only need to check once if there is a layer.
         The check and the removal of the layer are both constant.
         """
+        self._catch_up()
         if self.layer != None:
             self.layer = None # removes if there is an existing layer
+            self._changed()
             return True
         else:
             return False
@@ -127,66 +254,99 @@ class SetLayerStore(LayerStore): # only one layer so no ADTs used
 
         Complexity: best = worst = O(1), since inverting the colour only requires subtracting the integers in the tuple.
         """
+        self._catch_up()
         self.is_special = not self.is_special
+        self._changed()
 
-class AdditiveLayerStore(LayerStore): # using CircularQueue ADTs for this class
+    def applied_layers(self) -> list[Layer]:
+        """
+        Returns the layers in the order get_color applies them.
+
+        INPUTS: None
+        RAISE: None
+        OUTPUTS: list of layers (empty or a single layer)
+
+        Complexity: best = worst = O(1), since there is at most one layer.
+        """
+        self._catch_up()
+        if self.layer is None:
+            return []
+        return [self.layer]
+
+    def is_inverted(self) -> bool:
+        """
+        Returns true if special has inverted the colour output.
+
+        Complexity: best = worst = O(1)
+        """
+        self._catch_up()
+        return self.is_special
+
+class AdditiveLayerStore(LayerStore): # using a growable ring buffer (LayerDeque) for this class
     """
     Additive layer store. Each added layer applies after all previous ones.
     - add: Add a new layer to be added last.
     - erase: Remove the first layer that was added. Ignore what is currently selected.
     - special: Reverse the order of current layers (first becomes last, etc.)
     """
+    MAX_LAYERS = 100
+
     def __init__(self) -> None:
         """   
         INPUTS:  None
         RAISE: None
         OUTPUTS: None
 
-        Complexity: best = worst = O(1), each time a layer is initialised is constant
+        Complexity: best = worst = O(1), the deque only allocates space once a layer is added
         """
-        self.layerstore = CircularQueue(100)
+        self.layerstore = LayerDeque()
         self.is_special = False
 
+    def _specials_needed(self, pending: int) -> int:
+        return pending % 2 # reversing twice changes nothing
+
     def add(self, layer: Layer) -> bool:
         """
-        Add a layer to the store, which will place it in the Circular Queue.
+        Add a layer to the store, which will place it at the back of the deque.
         Returns true if the LayerStore was actually changed.
 
         INPUTS: Layer
         RAISE: None
         OUTPUTS: Boolean value
 
-        Complexity: best = worst = O(1), since checking if the queue is full and appending to a queue is always constant.
+        Complexity: amortised O(1), since the deque only grows (doubling) when it is full, and checking the
+        length is constant.
         """
-        if self.layerstore.is_full:
-            return("Maximum layers reached.")
+        self._catch_up()
+        if len(self.layerstore) >= AdditiveLayerStore.MAX_LAYERS:
+            return False # maximum layers reached
         else:
             self.layerstore.append(layer)
+            self._changed()
             return True
 
     def get_color(self, start: tuple, timestamp: int, x: int, y: int) -> tuple[int, int, int]:
         """
-        Returns the colour this square should show, given the current layers. If the layer isn't empty, the top layer is served
-        and we get the colour of the layer. We then append it back to the Circular Queue so that the layer is not deleted.
+        Returns the colour this square should show, given the current layers. The queue is compiled into a single fused
+        callable (see stack_compiler.py) the first time it is needed after a change, and that callable gives the colour.
 
         INPUTS: Starting color (tuple), timestamp (integer), x (integer), y(integer)
         RAISE: None
         OUTPUTS: color (tuple)
 
-        Complexity: best-case is O(1), if the square is the first in the queue, worst-case is O(len(self.layerstore)) if it has to
-        run through each layer.
+        Complexity: best-case is O(1), if the colour is memoised or the stack is already compiled and fuses down to a constant
+        or a single lookup. Worst-case is O(len(self.layerstore)) if the stack has to be (re)compiled, or if none of its layers
+        can be fused.
         """        
-        if self.layerstore.is_empty():
-            color = start
+        self._catch_up()
+        key = self._memo_key_for(start, timestamp, x, y)
+        if key == self._memo_key:
+            return self._memo_color # unchanged since the last call
 
-        else: 
-            color = start
-            for i in range(len(self.layerstore)): # each item is a LayerStore of the layer
-                layer = self.layerstore.serve()
-                color = layer.apply(start,timestamp,x,y) # get colour of layer input
-                self.layerstore.append(layer) # returning the layer to queue after serving
+        color = self.compiled().apply(start, timestamp, x, y)
         
-        return color
+        self._memo_key, self._memo_color = key, tuple(color)
+        return self._memo_color
 
     
     def erase(self,layer: Layer) -> bool:
@@ -198,12 +358,14 @@ class AdditiveLayerStore(LayerStore): # using CircularQueue ADTs for this class
         RAISE: None
         OUTPUTS: Boolean value
 
-        Complexity: best = worst = O(1), since checking if the queue is empty and serving from a queue is always constant.
+        Complexity: best = worst = O(1), since checking if the deque is empty and serving from it is always constant.
         """
+        self._catch_up()
         if self.layerstore.is_empty():
-            return("No layers to erase")
+            return False # no layers to erase
         else:
-            self.layerstore.serve(layer)
+            self.layerstore.serve()
+            self._changed()
             return True
 
     def special(self):
@@ -215,20 +377,26 @@ class AdditiveLayerStore(LayerStore): # using CircularQueue ADTs for this class
         RAISE: None
         OUTPUTS: None
 
-        Complexity: The best-case complexity is O(1) if there is already a layer in the temporary stack which can be served. 
-        The worst-case complexity is O(len(store)) if there are no elements in the temporary stack and we have to keep pushing and
-        appending elements from the original layerstore.
+        Complexity: best = worst = O(1), since the deque is reversed by flipping its direction flag.
         """
-        stack = ArrayStack(self.layerstore.length)
-        new_store = CircularQueue(self.layerstore.length)
+        self._catch_up()
+        self.layerstore.reverse()
+        if len(self.layerstore) > 1:
+            self._changed()
 
-        for i in range(self.layerstore.length):
-            stack.push(self.layerstore.serve()) # pushes oldest layer to a temporary stack
-        
-        while not stack.is_empty():
-            new_store.append(stack.pop()) # pop newest layer
-        
-        self.layerstore = new_store # new layer added
+    def applied_layers(self) -> list[Layer]:
+        """
+        Returns the layers in the order get_color applies them, oldest first.
+        The deque is iterated without being changed.
+
+        INPUTS: None
+        RAISE: None
+        OUTPUTS: list of layers
+
+        Complexity: best = worst = O(len(self.layerstore)), since every layer is visited once.
+        """
+        self._catch_up()
+        return list(self.layerstore)
 
 
 class SequenceLayerStore(LayerStore):  # couldn't figure out how to use BVset, used array sorted list instead
@@ -253,43 +421,51 @@ class SequenceLayerStore(LayerStore):  # couldn't figure out how to use BVset, u
         """
         self.layerstore = ArraySortedList(20)
 
+    def _specials_needed(self, pending: int) -> int:
+        return min(pending, len(self.layerstore)) # each special removes a layer, so at most len(self.layerstore) do anything
+
     def add(self, layer: Layer) -> bool:
         """
-        add: Ensure this layer type is applied. The new layer will be added into the list but it is not sorted.
+        add: Ensure this layer type is applied. The new layer is added into the list, keyed (and so sorted) by its index.
+        If the layer is already applied, nothing changes.
         
         INPUTS: Layer
         RAISE: None
-        OUTPUTS: Boolean value
+        OUTPUTS: Boolean value (True if added)
 
-        Complexity: best = worst = O(1), since the layers are added but not sorted, so it will always be constant and add the
-        layer to the end of the list.
+        Complexity: best = worst = O(len(self.layerstore)), since the list is checked for the layer before it is added.
         """
+        self._catch_up()
+        for i in range(len(self.layerstore)):
+            if self.layerstore[i].key == layer.index:
+                return False # already applied
         item = layer.index
         tempitem = ListItem(layer,item)
         self.layerstore.add(tempitem)
+        self._changed()
         return True
 
     def get_color(self, start, timestamp, x, y) -> tuple[int, int, int]:
         """
-        Returns the colour this square should show, given the current layers. For each layer, it will check the colour of the 
-        grid square at (x,y)
+        Returns the colour this square should show, given the current layers. The list is compiled into a single fused
+        callable (see stack_compiler.py) the first time it is needed after a change, and that callable gives the colour.
         
         INPUTS: Starting color (tuple), timestamp (integer), x (integer), y(integer)
         RAISE: None
         OUTPUTS: color (tuple)
 
-        Complexity: best-case is O(1), if the square is in the first layer, so it is first in the list. The worst-case is 
-        O(len(self.layerstore)) if it has to run through the entire list.
+        Complexity: best-case is O(1), if the colour is memoised or the compiled stack fuses down to a constant or a single
+        lookup. The worst-case is O(len(self.layerstore)) if the list has to be (re)compiled, or none of its layers can be fused.
         """   
-        if self.layerstore.is_empty():
-            color = start
-        else:
-            color = start # initial layer
-            for i in range(len(self.layerstore)):
-                layer = self.layerstore.__getitem__(i)
-                color = layer.value.apply(start, timestamp, x, y)
+        self._catch_up()
+        key = self._memo_key_for(start, timestamp, x, y)
+        if key == self._memo_key:
+            return self._memo_color # unchanged since the last call
+
+        color = self.compiled().apply(start, timestamp, x, y)
         
-        return color
+        self._memo_key, self._memo_color = key, tuple(color)
+        return self._memo_color
                            
 
     def erase(self,layer: Layer) -> bool:
@@ -304,16 +480,41 @@ class SequenceLayerStore(LayerStore):  # couldn't figure out how to use BVset, u
         Complexity: best-case is O(1), if there is only one layer. The worst-case is O(len(self.layerstore)) if it has to 
         run through the entire list.
         """
+        self._catch_up()
         for i in range(len(self.layerstore)):
             item = self.layerstore.__getitem__(i)
             if item.value.name == layer.name:
                 self.layerstore.delete_at_index(i)
+                self._changed()
                 return True
+        return False
 
     def special(self):
         """
         Of all currently applied layers, remove the one with median `name`.
         In the event of two layers being the median names, pick the lexicographically smaller one.
+
+        INPUTS: None
+        RAISE: None
+        OUTPUTS: None
+
+        Complexity: best = worst = O(n log n), where n is len(self.layerstore), since the applied layers are sorted by name.
+        """
+        self._catch_up()
+        if self.layerstore.is_empty():
+            return
+        self.layerstore.delete_at_index(median_name_position(self.applied_layers()))
+        self._changed()
+
+    def applied_layers(self) -> list[Layer]:
+        """
+        Returns the layers in the order get_color applies them (ascending layer index).
+
+        INPUTS: None
+        RAISE: None
+        OUTPUTS: list of layers
+
+        Complexity: best = worst = O(len(self.layerstore)), since every item in the list is read once.
         """
-        # item = self.layer.name
-        pass
\ No newline at end of file
+        self._catch_up()
+        return [self.layerstore[i].value for i in range(len(self.layerstore))]
@@ -6,6 +6,7 @@ No need to edit unless adding new features.
 
 from __future__ import annotations
 from dataclasses import dataclass, field
+import numpy as np
 from data_structures.referential_array import ArrayR
 
 LAYERS: ArrayR[Layer] = ArrayR(20)
@@ -18,21 +19,64 @@ class Layer:
     apply: function
     name: str = field(init=False)
     bg: tuple[int, int, int] | None = None
+    # Declared with @properties. Anything undeclared is assumed to matter.
+    time_invariant: bool = False
+    position_invariant: bool = False
+    color_invariant: bool = False
+    channelwise: bool = False
+    # Optional vectorised form of apply, set with @layer.vectorized.
+    batch: function | None = None
 
     def __post_init__(self):
         if hasattr(self.apply, "__bg__"):
             self.bg = self.apply.__bg__
+        for key, value in getattr(self.apply, "__properties__", {}).items():
+            setattr(self, key, value)
         self.name = self.apply.__name__
 
+    @property
+    def pure_in_color(self) -> bool:
+        """True if the output only depends on the input colour, so it can be cached by colour."""
+        return self.time_invariant and self.position_invariant
+
+    def apply_batch(self, colors: np.ndarray, timestamp, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        """
+        Apply this layer to many squares at once.
+        colors is an N x 3 integer array, xs and ys hold the N square positions.
+        Returns a new N x 3 integer array, equal to calling apply on every row.
+
+        Layers without a vectorised form fall back to calling apply once per square.
+        """
+        if self.batch is not None:
+            return self.batch(colors, timestamp, xs, ys)
+        return np.array([
+            self.apply(tuple(int(c) for c in color), timestamp, int(x), int(y))
+            for color, x, y in zip(colors, xs, ys)
+        ], dtype=np.int64).reshape(len(xs), 3)
+
+    def vectorized(self, func: function) -> function:
+        """
+        Decorator to register the vectorised form of this layer, used by apply_batch.
+
+        Usage:  @my_special_layer.vectorized
+                def my_special_layer_batch(colors, timestamp, xs, ys):
+        """
+        self.batch = func
+        return func
+
 class background(object):
     """Simple decorator to add a __bg__ property to a layer
 
     Usage:  @register
             @background(200, 0, 120)
             def my_special_layer(...):
+
+    Layer properties can also be declared here, see `properties`:
+            @background(200, 0, 120, time_invariant=True)
     """
-    def __init__(self, r, g, b):
+    def __init__(self, r, g, b, **layer_properties):
         self.val = (r, g, b)
+        self.properties = properties(**layer_properties) if layer_properties else None
 
     def __call__(self, layer: function|Layer):
         # This could be applied before or after registration
@@ -41,18 +85,63 @@ class background(object):
         else:
             func = layer
         func.__bg__ = self.val
+        if isinstance(layer, Layer):
+            layer.bg = self.val
+        if self.properties is not None:
+            self.properties(layer)
         return layer
 
-def register(func):
+class properties(object):
+    """Decorator to declare properties of a layer.
+
+    - time_invariant: The layer output never depends on `timestamp`.
+    - position_invariant: The layer output never depends on `x` or `y`.
+    A layer that is both is pure in colour: its output only depends on the input colour.
+    - color_invariant: The layer output never depends on the input `color`.
+    - channelwise: Each output channel is the same function of the matching input channel.
+
+    Usage:  @register
+            @properties(time_invariant=True, position_invariant=True)
+            def my_special_layer(...):
+    """
+    def __init__(self, time_invariant=None, position_invariant=None, color_invariant=None, channelwise=None):
+        declared = {
+            "time_invariant": time_invariant,
+            "position_invariant": position_invariant,
+            "color_invariant": color_invariant,
+            "channelwise": channelwise,
+        }
+        self.val = {key: value for key, value in declared.items() if value is not None}
+
+    def __call__(self, layer: function|Layer):
+        # This could be applied before or after registration
+        if isinstance(layer, Layer):
+            func = layer.apply
+            for key, value in self.val.items():
+                setattr(layer, key, value)
+        else:
+            func = layer
+        func.__properties__ = {**getattr(func, "__properties__", {}), **self.val}
+        return layer
+
+def register(func=None, **layer_properties):
     """
     Layer register function.
 
     Usage:  @register
             def my_special_layer(...):
 
+    Layer properties can also be declared here, see `properties`:
+            @register(time_invariant=True)
+            def my_special_layer(...):
+
     In order to actually confirm this registration,
     you'll need to import the file containing the layer definition
     """
+    if func is None:
+        return lambda f: register(f, **layer_properties)
+    if layer_properties:
+        properties(**layer_properties)(func)
     global cur_layer_index
     LAYERS[cur_layer_index] = Layer(cur_layer_index, func)
     cur_layer_index += 1
@@ -3,72 +3,245 @@ All layers are defined here.
 """
 
 import colorsys
-from layer_util import background, register
+from collections import OrderedDict
+import numpy as np
+from layer_util import background, properties, register
+
+# Vectorised forms work on N x 3 integer colour arrays, see Layer.apply_batch.
+
+def _constant_batch(colors, value):
+    out = np.empty_like(colors)
+    out[:] = value
+    return out
+
+def _hls_channel_batch(m1, m2, hue):
+    # Same steps as colorsys._v, so results match the scalar layer exactly.
+    hue = hue % 1.0
+    return np.select(
+        [hue < colorsys.ONE_SIXTH, hue < 0.5, hue < colorsys.TWO_THIRD],
+        [m1 + (m2-m1)*hue*6.0, m2, m1 + (m2-m1)*(colorsys.TWO_THIRD-hue)*6.0],
+        m1,
+    )
+
+def _lcg_batch(other, steps):
+    # Run the sparkle LCG `steps[i]` times on other[i], all rows at once.
+    # Every value stays below 2**32, so the products fit in int64.
+    for i in range(int(steps.max(initial=0))):
+        other = np.where(i < steps, (1103515245 * other + 12345) % (1 << 31), other)
+    return other
+
+class SparkleNoise:
+    """
+    Cache of the sparkle lighten/darken decision.
+
+    The decision for square (x, y) only depends on the time bucket ts = int((timestamp + x/3 + y/5) * 3)
+    through the LCG step count 10 + (ts * 31 % 17), so it repeats every 17 buckets.
+    Each square keeps one word: bit p says phase p (= ts * 31 % 17) has been computed, bit 17 + p holds the decision.
+    Squares fill in their phases as they cross bucket boundaries, after which the LCG never runs for them again.
+
+    Words are kept in TILE x TILE tiles, allocated when one of their squares is first drawn, so memory follows the
+    squares actually drawn rather than the largest coordinate seen. At most max_tiles tiles are kept: the least
+    recently used one is dropped to make room, and its decisions are worked out again if they are needed.
+    """
+
+    PHASES = 17
+    TILE = 64
+    MAX_TILES = 1024 # 32KB a tile, so at most 32MB
+
+    def __init__(self, max_tiles: int = MAX_TILES) -> None:
+        self.tiles = OrderedDict()
+        self.max_tiles = max_tiles
+        self.misses = 0
+
+    def tile(self, key: tuple[int, int]) -> np.ndarray:
+        """The words of tile `key`, allocating it if needed. Complexity: O(1), plus O(TILE^2) to allocate."""
+        words = self.tiles.get(key)
+        if words is not None:
+            self.tiles.move_to_end(key)
+            return words
+        if len(self.tiles) >= self.max_tiles:
+            self.tiles.popitem(last=False)
+        words = self.tiles[key] = np.zeros((SparkleNoise.TILE, SparkleNoise.TILE), dtype=np.uint64)
+        return words
+
+    def by_tile(self, xs: np.ndarray, ys: np.ndarray):
+        """Yields (words of a tile, positions k of the squares (xs[k], ys[k]) in that tile), one tile at a time."""
+        txs, tys = xs // SparkleNoise.TILE, ys // SparkleNoise.TILE
+        keys = (txs - txs.min()) * (int(tys.max() - tys.min()) + 1) + (tys - tys.min())
+        order = np.argsort(keys, kind="stable")
+        _, starts = np.unique(keys[order], return_index=True)
+        for start, end in zip(starts, np.append(starts[1:], len(order))):
+            inside = order[start:end]
+            yield self.tile((int(txs[inside[0]]), int(tys[inside[0]]))), inside
+
+    @staticmethod
+    def compute(x: int, y: int, phase: int) -> bool:
+        """Run the sparkle LCG for one square and phase. True means lighten."""
+        other = x
+        for _ in range(10 + phase):
+            other = (1103515245 * other + 12345) % (1 << 31)
+        other += y
+        for _ in range(10 + phase):
+            other = (1103515245 * other + 12345) % (1 << 31)
+        other = (other & ((1 << 31)-1)) >> 16
+        return other/(1 << 15) < 0.1
+
+    def is_bright(self, x, y, ts: int) -> bool:
+        phase = ts * 31 % SparkleNoise.PHASES
+        if not (isinstance(x, int) and isinstance(y, int) and x >= 0 and y >= 0):
+            return SparkleNoise.compute(x, y, phase) # not a grid square, so don't cache it
+        words = self.tile((x // SparkleNoise.TILE, y // SparkleNoise.TILE))
+        position = (x % SparkleNoise.TILE, y % SparkleNoise.TILE)
+        word = int(words[position])
+        if word >> phase & 1:
+            return bool(word >> (SparkleNoise.PHASES + phase) & 1)
+        self.misses += 1
+        bright = SparkleNoise.compute(x, y, phase)
+        words[position] = word | 1 << phase | int(bright) << (SparkleNoise.PHASES + phase)
+        return bright
+
+    def is_bright_batch(self, xs: np.ndarray, ys: np.ndarray, ts: np.ndarray) -> np.ndarray:
+        phase = (ts * 31 % SparkleNoise.PHASES).astype(np.uint64)
+        if len(xs) == 0:
+            return np.zeros(0, dtype=bool)
+        words = np.empty(len(xs), dtype=np.uint64)
+        for tile, inside in self.by_tile(xs, ys):
+            words[inside] = tile[xs[inside] % SparkleNoise.TILE, ys[inside] % SparkleNoise.TILE]
+        known = (words >> phase) & np.uint64(1) == 1
+        bright = (words >> (phase + np.uint64(SparkleNoise.PHASES))) & np.uint64(1) == 1
+        missing = ~known
+        if missing.any():
+            self.misses += int(missing.sum())
+            mx, my, steps = xs[missing], ys[missing], 10 + phase[missing].astype(np.int64)
+            other = _lcg_batch(mx, steps)
+            other = _lcg_batch(other + my, steps)
+            other = (other & ((1 << 31)-1)) >> 16
+            computed = other/(1 << 15) < 0.1
+            bright[missing] = computed
+            # Squares can repeat within a batch, so combine bits with a bitwise-or reduction per square.
+            bits = (np.uint64(1) << phase[missing]) | (computed.astype(np.uint64) << (phase[missing] + np.uint64(SparkleNoise.PHASES)))
+            for tile, inside in self.by_tile(mx, my):
+                np.bitwise_or.at(tile, (mx[inside] % SparkleNoise.TILE, my[inside] % SparkleNoise.TILE), bits[inside])
+        return bright
+
+SPARKLE_NOISE = SparkleNoise()
 
 @register
 @background(200, 0, 120)
+@properties(color_invariant=True)
 def rainbow(color, timestamp, x, y):
     return tuple(
         int(255*x)
         for x in colorsys.hls_to_rgb((timestamp/20 + x/20 + y/20)%1, 0.6, 0.6)
     )
 
+@rainbow.vectorized
+def rainbow_batch(colors, timestamp, xs, ys):
+    h = (timestamp/20 + xs/20 + ys/20)%1
+    l, s = 0.6, 0.6
+    m2 = l+s-(l*s)
+    m1 = 2.0*l - m2
+    out = np.empty_like(colors)
+    out[:, 0] = (255*_hls_channel_batch(m1, m2, h+colorsys.ONE_THIRD)).astype(np.int64)
+    out[:, 1] = (255*_hls_channel_batch(m1, m2, h)).astype(np.int64)
+    out[:, 2] = (255*_hls_channel_batch(m1, m2, h-colorsys.ONE_THIRD)).astype(np.int64)
+    return out
+
 @register
 @background(170, 170, 170)
+@properties(time_invariant=True, position_invariant=True, color_invariant=True)
 def black(color, timestamp, x, y):
     return (0, 0, 0)
 
+@black.vectorized
+def black_batch(colors, timestamp, xs, ys):
+    return _constant_batch(colors, (0, 0, 0))
+
 @register
 @background(240, 240, 240)
+@properties(time_invariant=True, position_invariant=True, channelwise=True)
 def lighten(color, timestamp, x, y):
     return tuple(
         min(255, x + 40)
         for x in color
     )
 
+@lighten.vectorized
+def lighten_batch(colors, timestamp, xs, ys):
+    return np.minimum(255, colors + 40)
+
 @register
 @background(0, 255, 255)
+@properties(time_invariant=True, position_invariant=True, channelwise=True)
 def invert(color, timestamp, x, y):
     return tuple(
         255 - c
         for c in color
     )
 
+@invert.vectorized
+def invert_batch(colors, timestamp, xs, ys):
+    return 255 - colors
+
 @register
 @background(255, 0, 0)
+@properties(time_invariant=True, position_invariant=True, color_invariant=True)
 def red(color, timestamp, x, y):
     return (255, 0, 0)
 
+@red.vectorized
+def red_batch(colors, timestamp, xs, ys):
+    return _constant_batch(colors, (255, 0, 0))
+
 @register
 @background(0, 255, 0)
+@properties(time_invariant=True, position_invariant=True, color_invariant=True)
 def green(color, timestamp, x, y):
     return (0, 255, 0)
 
+@green.vectorized
+def green_batch(colors, timestamp, xs, ys):
+    return _constant_batch(colors, (0, 255, 0))
+
 @register
 @background(0, 0, 255)
+@properties(time_invariant=True, position_invariant=True, color_invariant=True)
 def blue(color, timestamp, x, y):
     return (0, 0, 255)
 
+@blue.vectorized
+def blue_batch(colors, timestamp, xs, ys):
+    return _constant_batch(colors, (0, 0, 255))
+
 @register
 @background(100, 170, 255)
 def sparkle(color, timestamp, x, y):
     ts = int((timestamp + x/3 + y/5) * 3)
-    other = x
-    for _ in range(10 + (ts * 31 % 17)):
-        other = (1103515245 * other + 12345) % (1 << 31)
-    other += y
-    for _ in range(10 + (ts * 31 % 17)):
-        other = (1103515245 * other + 12345) % (1 << 31)
-    ts = int((timestamp + x/10 + y/20) * 3)
-    other = (other & ((1 << 31)-1)) >> 16
-    if other/(1 << 15) < 0.1:
+    if SPARKLE_NOISE.is_bright(x, y, ts):
         return lighten.apply(color, timestamp, x, y)
     return darken.apply(color, timestamp, x, y)
 
+@sparkle.vectorized
+def sparkle_batch(colors, timestamp, xs, ys):
+    xs = np.asarray(xs, dtype=np.int64)
+    ys = np.asarray(ys, dtype=np.int64)
+    ts = np.trunc((timestamp + xs/3 + ys/5) * 3).astype(np.int64)
+    bright = SPARKLE_NOISE.is_bright_batch(xs, ys, ts)
+    return np.where(
+        bright[:, np.newaxis],
+        lighten.apply_batch(colors, timestamp, xs, ys),
+        darken.apply_batch(colors, timestamp, xs, ys),
+    )
+
 @register
 @background(30, 30, 30)
+@properties(time_invariant=True, position_invariant=True, channelwise=True)
 def darken(color, timestamp, x, y):
     return tuple(
         max(0, x - 40)
         for x in color
     )
+
+@darken.vectorized
+def darken_batch(colors, timestamp, xs, ys):
+    return np.maximum(0, colors - 40)
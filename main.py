@@ -1,11 +1,14 @@
+import os
 import arcade
 import arcade.key as keys
-import math
 from grid import Grid
 from layer_util import get_layers, Layer
 from layers import lighten
+from action import PaintAction
 from undo import *
 from replay import *
+from renderer import make_renderer, RENDER_BACKEND_TEXTURE
+from stroke import Stroke
 
 class MyWindow(arcade.Window):
     """ Painter Window """
@@ -17,9 +20,23 @@ class MyWindow(arcade.Window):
     SCREEN_TITLE = "Paint"
 
     REPLAY_TIMER_DELTA = 0.05
+    # Replay actions played every REPLAY_TIMER_DELTA. During a replay, Up/Down doubles/halves it and End skips to the end.
+    REPLAY_SPEED = 1
+
+    # One of renderer.RENDER_BACKENDS. The texture backend falls back to rectangles if it can't be created.
+    RENDER_BACKEND = RENDER_BACKEND_TEXTURE
 
     GRID_SIZE_X = 32
     GRID_SIZE_Y = 32
+    # Most squares shown at once. A larger grid is shown a viewport at a time, panned with the arrow keys, and only
+    # the squares in view are rendered.
+    VIEW_SIZE_X = 128
+    VIEW_SIZE_Y = 128
+    # One of Grid.STORAGE_CLASSES.
+    GRID_STORAGE = Grid.STORAGE_DENSE
+    # Path of the journal (see journal.py) every session is recorded to, or None to keep none.
+    # A journal left by a run that didn't finish is replayed on start-up, so painting carries on where it stopped.
+    JOURNAL_PATH = None
 
     BG = [255, 255, 255]
 
@@ -38,24 +55,33 @@ class MyWindow(arcade.Window):
         self.y_timer = 0
         self.enable_ui = True
         self.replay_timer = 0
+        self.replay_speed = self.REPLAY_SPEED
         self.on_init()
 
     def reset(self) -> None:
         """Reset the screen."""
-        self.grid = Grid(self.draw_style, self.GRID_SIZE_X, self.GRID_SIZE_Y)
+        self.grid = self.new_grid()
         self.timestamp = 0
 
         self.selected_layer_index = -1
         self.dragging = None
         self.prev_drawn = None
         self.prev_pos = None
+        self.stroke = None
         self.draw_size = 2
 
         # Visual calculations
         self.DRAW_PANEL = self.SCREEN_WIDTH - self.SIDEBAR_WIDTH
-        self.GRID_SQ_WIDTH = self.DRAW_PANEL / self.GRID_SIZE_X
-        self.GRID_SQ_HEIGHT = self.SCREEN_HEIGHT / self.GRID_SIZE_Y
+        self.VIEW_X = min(self.GRID_SIZE_X, self.VIEW_SIZE_X)
+        self.VIEW_Y = min(self.GRID_SIZE_Y, self.VIEW_SIZE_Y)
+        self.view_x0 = 0
+        self.view_y0 = 0
+        self.GRID_SQ_WIDTH = self.DRAW_PANEL / self.VIEW_X
+        self.GRID_SQ_HEIGHT = self.SCREEN_HEIGHT / self.VIEW_Y
         self.LAYER_BUTTON_SIZE = self.SIDEBAR_WIDTH / 2
+        self.canvas_renderer = make_renderer(
+            self.RENDER_BACKEND, self, self.VIEW_X, self.VIEW_Y, self.DRAW_PANEL, self.SCREEN_HEIGHT,
+        )
         # Action button sprites
         self.action_buttons = arcade.SpriteList()
         self.draw_mode_button = arcade.Sprite(
@@ -98,10 +124,25 @@ class MyWindow(arcade.Window):
 
         self.on_reset()
 
+    def new_grid(self) -> Grid:
+        """Close the current grid (if any) and create an empty one."""
+        if self.grid is not None:
+            self.grid.close()
+        return Grid(self.draw_style, self.GRID_SIZE_X, self.GRID_SIZE_Y, storage=self.GRID_STORAGE)
+
     def setup(self) -> None:
         """Set up the game and initialize the variables."""
         self.reset()
 
+    def viewport(self) -> tuple[int, int, int, int]:
+        """The squares shown, as (x0, y0, x1, y1) for Grid.render_frame."""
+        return (self.view_x0, self.view_y0, self.view_x0 + self.VIEW_X, self.view_y0 + self.VIEW_Y)
+
+    def pan(self, dx: int, dy: int) -> None:
+        """Move the viewport by half its size in each direction given (-1, 0 or 1), keeping it on the grid."""
+        self.view_x0 = min(max(0, self.view_x0 + dx * (self.VIEW_X // 2)), self.GRID_SIZE_X - self.VIEW_X)
+        self.view_y0 = min(max(0, self.view_y0 + dy * (self.VIEW_Y // 2)), self.GRID_SIZE_Y - self.VIEW_Y)
+
     def on_draw(self) -> None:
         """Draw everything"""
         self.clear()
@@ -123,15 +164,7 @@ class MyWindow(arcade.Window):
         # UI - Draw Modes / Action buttons
         self.action_buttons.draw()
         # Grid
-        for x in range(self.GRID_SIZE_X):
-            for y in range(self.GRID_SIZE_Y):
-                arcade.draw_lrtb_rectangle_filled(
-                    self.GRID_SQ_WIDTH * x,
-                    self.GRID_SQ_WIDTH * (x+1),
-                    self.GRID_SQ_HEIGHT * (y+1),
-                    self.GRID_SQ_HEIGHT * y,
-                    self.grid[x][y].get_color(self.BG[:], self.timestamp, x, y),
-                )
+        self.canvas_renderer.draw(self.grid, self.timestamp, self.BG, self.viewport())
 
     def on_mouse_press(self, x: int, y: int, button: int, modifiers: int) -> None:
         """Called when the mouse buttons are pressed."""
@@ -186,6 +219,7 @@ class MyWindow(arcade.Window):
     def on_mouse_release(self, x: int, y: int, button: int, modifiers: int):
         """Called when the mouse buttons are released."""
         self.dragging = False
+        self.end_stroke()
         self.prev_drawn = None
         self.prev_pos = None
 
@@ -202,7 +236,17 @@ class MyWindow(arcade.Window):
     def on_key_press(self, symbol: int, modifiers: int) -> None:
         """Called when a keyboard key is pressed."""
         if not self.enable_ui:
+            if symbol == keys.UP:
+                self.replay_speed *= 2
+            elif symbol == keys.DOWN:
+                self.replay_speed = max(1, self.replay_speed // 2)
+            elif symbol == keys.END:
+                self.on_replay_skip()
+                self.enable_ui = True
             return
+        pan = {keys.LEFT: (-1, 0), keys.RIGHT: (1, 0), keys.DOWN: (0, -1), keys.UP: (0, 1)}.get(symbol)
+        if pan is not None:
+            self.pan(*pan)
         self.z_pressed = keys.Z == symbol and (modifiers & keys.MOD_CTRL)
         self.y_pressed = keys.Y == symbol and (modifiers & keys.MOD_CTRL)
         if self.z_pressed:
@@ -218,39 +262,32 @@ class MyWindow(arcade.Window):
         self.y_pressed = False
 
     def try_draw(self, x, y) -> None:
-        """Attempt to draw at a position, but safely fail if an invalid square."""
+        """
+        Attempt to draw at a position, but safely fail if an invalid square.
+        The first draw of a drag starts a stroke, and every later one extends it from the previous position,
+        so each square is painted at most once per drag (see stroke.py).
+        """
         if self.selected_layer_index == -1:
             return
         layer = get_layers()[self.selected_layer_index]
-        if self.prev_pos is not None:
-            # Try draw in increments of 0.5 to avoid skipping squares.
-            mhat_dist = abs(x - self.prev_pos[0]) + abs(y - self.prev_pos[1])
-            increment = 0.5
-            points_to_draw = []
-            for d in range(1, math.ceil(mhat_dist/increment)+1):
-                distance = min(d * increment / mhat_dist, 1)
-                nx = distance * (x - self.prev_pos[0]) + self.prev_pos[0]
-                ny = distance * (y - self.prev_pos[1]) + self.prev_pos[1]
-                nx_pos = int(nx // self.GRID_SQ_WIDTH)
-                ny_pos = int(ny // self.GRID_SQ_HEIGHT)
-                points_to_draw.append((nx_pos, ny_pos))
+        pos = (self.view_x0 + x / self.GRID_SQ_WIDTH, self.view_y0 + y / self.GRID_SQ_HEIGHT)
+        if self.stroke is None:
+            self.stroke = Stroke(self.grid, layer, Grid.BRUSH_STENCILS[self.grid.brush_size])
+            self.stroke.paint_segment(pos, pos)
         else:
-            x_pos = int(x // self.GRID_SQ_WIDTH)
-            y_pos = int(y // self.GRID_SQ_HEIGHT)
-            points_to_draw = [
-                (x_pos, y_pos)
-            ]
-        for px, py in points_to_draw:
-            if self.prev_drawn is None or (px, py) != self.prev_drawn:
-                if 0 <= px < self.GRID_SIZE_X and 0 <= py < self.GRID_SIZE_Y:
-                    self.on_paint(layer, px, py)
-                    self.prev_drawn = (px, py)
-        self.prev_pos = (x, y)
+            self.stroke.paint_segment(self.prev_pos, pos)
+        self.prev_pos = pos
+
+    def end_stroke(self) -> None:
+        """Finish the current stroke, if any, handing its action to on_stroke_end."""
+        if self.stroke is not None and len(self.stroke.action):
+            self.on_stroke_end(self.stroke.action)
+        self.stroke = None
 
     def start_replay(self) -> None:
         """Begin the replay mode."""
         self.enable_ui = False
-        self.grid = Grid(self.draw_style, self.GRID_SIZE_X, self.GRID_SIZE_Y)
+        self.grid = self.new_grid()
         self.replay_timer = self.REPLAY_TIMER_DELTA
         self.on_replay_start()
 
@@ -259,9 +296,12 @@ class MyWindow(arcade.Window):
         self.timestamp += delta_time
         if self.z_pressed:
             self.z_timer -= delta_time
-            if self.z_timer <= 0:
-                self.on_undo()
+            repeats = 0
+            while self.z_timer <= 0:
+                repeats += 1
                 self.z_timer += 0.05
+            if repeats:
+                self.on_undo(repeats) # every repeat due this frame, undone in one go
         if self.y_pressed:
             self.y_timer -= delta_time
             if self.y_timer <= 0:
@@ -289,11 +329,48 @@ class MyWindow(arcade.Window):
 
     def on_init(self):
         """Initialisation that occurs after the system initialisation."""
-        pass
+        self.journal = None
 
     def on_reset(self):
         """Called when a window reset is requested."""
-        pass
+        self.undo = UndoTracker(self.grid)
+        self.replay = ReplayTracker()
+        if self.JOURNAL_PATH is None:
+            return
+        if self.journal is None:
+            self.recover_journal() # start-up
+        else:
+            self.journal.close()
+            os.remove(self.JOURNAL_PATH) # a reset starts a new session
+        self.journal = self.replay.journal = JournalWriter(
+            self.JOURNAL_PATH, self.draw_style, self.GRID_SIZE_X, self.GRID_SIZE_Y,
+        )
+
+    def recover_journal(self):
+        """
+        Replays the journal at JOURNAL_PATH, if there is one for this grid size, onto the grid and into the undo and
+        replay history. The grid takes the journal's draw style. A journal for another size is discarded.
+        """
+        if not os.path.exists(self.JOURNAL_PATH) or not os.path.getsize(self.JOURNAL_PATH):
+            return
+        with Journal(self.JOURNAL_PATH) as journal:
+            if (journal.x, journal.y) != (self.GRID_SIZE_X, self.GRID_SIZE_Y):
+                journal.close()
+                os.remove(self.JOURNAL_PATH)
+                return
+            if journal.draw_style != self.draw_style:
+                self.draw_style = journal.draw_style
+                self.grid = self.new_grid()
+                self.undo = UndoTracker(self.grid)
+            for action, is_undo in journal:
+                if is_undo:
+                    action = self.undo.undo(self.grid)
+                    if action is None:
+                        continue
+                else:
+                    action.redo_apply(self.grid)
+                    self.undo.add_action(action)
+                self.replay.add_action(action, is_undo)
 
     def on_paint(self, layer: Layer, px, py) -> None:
         """
@@ -308,31 +385,41 @@ class MyWindow(arcade.Window):
         RAISE: None
         OUTPUTS: None
 
-        Complexity: the best case complexity is O(1) if only one grid square was painted on. The worst-case camplexity is 
-        O(n*m), where n is the number of columns (y) and m is the number of rows (x)
+        Complexity: O(n), where n is the number of squares in the brush stencil (see Grid.stamp). The stencil is precomputed
+        for each brush size and clipped to the grid, so squares outside it are never visited.
+        """
+        changed = self.grid.stamp(layer, px, py)
+        if changed:
+            action = PaintAction()
+            action.add_squares(changed, layer)
+            self.undo.add_action(action)
+            self.replay.add_action(action)
+
+
+    def on_stroke_end(self, action: PaintAction) -> None:
         """
+        Called when a drag ends, with the PaintAction holding every square the drag changed.
 
-        min_x = px - self.grid.brush_size
-        max_x = px + self.grid.brush_size
-        min_y = py - self.grid.brush_size
-        max_y = py + self.grid.brush_size
-        for y_cell in range(min_y,max_y+1):
-            for x_cell in range(min_x,max_x+1):
-                manhattan_d = abs(px-x_cell) + abs(py-y_cell)
-                if manhattan_d <= self.grid.brush_size:
-                    self.grid[x_cell][y_cell].add(layer)
+        INPUTS: action (PaintAction)
+        RAISE: None
+        OUTPUTS: None
 
+        Complexity: O(1), please refer to undo.py and replay.py :)
+        """
+        self.undo.add_action(action)
+        self.replay.add_action(action)
 
-    def on_undo(self):
-        """Called when an undo is requested.
+    def on_undo(self, n: int = 1):
+        """Called when an undo is requested, or n of them at once (see UndoTracker.undo_many).
         
-        INPUTS: None
+        INPUTS: n (integer)
         RAISE: None
         OUTPUTS: None
 
         Complexity: please refer to undo.py :)
         """
-        self.undo.undo(self)
+        for action in self.undo.undo_many(n, self.grid):
+            self.replay.add_action(action, is_undo=True)
 
     def on_redo(self):
         """Called when a redo is requested.
@@ -342,22 +429,34 @@ class MyWindow(arcade.Window):
 
         Complexity: please refer to undo.py :)
         """
-        self.undo.redo(self)
+        action = self.undo.redo(self.grid)
+        if action is not None:
+            self.replay.add_action(action)
 
     def on_special(self):
         """Called when the special action is requested."""
-        pass
+        self.grid.special()
+        action = PaintAction([], is_special=True)
+        self.undo.add_action(action)
+        self.replay.add_action(action)
 
     def on_replay_start(self):
         """Called when the replay starting is requested."""
-        pass
+        if self.journal is not None:
+            self.journal.flush()
+        self.replay.start_replay()
+        self.undo.grid = self.grid # the replay ends in the same state, so the undo history carries on from it
 
     def on_replay_next_step(self) -> bool:
         """
-        Called when the next step of the replay is requested.
+        Called when the next step of the replay is requested, playing replay_speed actions.
         Returns whether the replay is finished.
         """
-        return True
+        return self.replay.play_actions(self.grid, self.replay_speed)
+
+    def on_replay_skip(self):
+        """Called when skipping to the end of the replay is requested."""
+        self.replay.skip_to_end(self.grid)
 
     def on_increase_brush_size(self):
         """Called when an increase to the brush size is requested."""
@@ -0,0 +1,172 @@
+"""
+Parallel band rendering, for grids too large to evaluate on one core every frame.
+
+The frame is split into bands of rows, and each band is evaluated by a worker process (see BandRenderer).
+Nothing per square is sent to the workers: they read and write three arrays in shared memory.
+- frame: y x x x 3 uint8, the rendered frame, indexed as frame[y][x] like Grid.render_frame.
+- ids: y x x int32, the id of each square's signature (see LayerStore.signature) in the renderer's signature table.
+- dirty: y x x bool, squares changed since the last frame.
+Each frame the workers only get the band's rows, the signature table (one entry per distinct signature, not per
+square) and which signatures are animated. Like Grid.render_frame, a worker only evaluates the squares of its band
+that are dirty or animated, grouped by signature, every group with one batched evaluate_group.
+"""
+
+from __future__ import annotations
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+import layers # registers every layer, so workers started without fork resolve layer indices too
+from grid import Grid, evaluate_group
+from grid_storage import group_by_key
+from stack_compiler import compile_stack
+
+# The shared arrays, attached once in each worker process by _attach.
+_BLOCKS = []
+_FRAME = None
+_IDS = None
+_DIRTY = None
+
+
+def _shared_array(block: shared_memory.SharedMemory, shape: tuple, dtype) -> np.ndarray:
+    return np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+
+def _attach(frame_name: str, ids_name: str, dirty_name: str, x: int, y: int) -> None:
+    """Worker initialiser: maps the renderer's shared arrays into this process."""
+    global _FRAME, _IDS, _DIRTY
+    frame, ids, dirty = (shared_memory.SharedMemory(name=name) for name in (frame_name, ids_name, dirty_name))
+    _BLOCKS.extend((frame, ids, dirty)) # keeps the blocks mapped for the life of the worker
+    _FRAME = _shared_array(frame, (y, x, 3), np.uint8)
+    _IDS = _shared_array(ids, (y, x), np.int32)
+    _DIRTY = _shared_array(dirty, (y, x), np.bool_)
+
+
+def _render_band(y0: int, y1: int, signatures: list, animated: np.ndarray, timestamp, background, full: bool) -> int:
+    """
+    Evaluates rows y0 <= y < y1 into the shared frame: every square if full, otherwise the dirty and animated ones.
+    Returns the number of squares evaluated.
+
+    Complexity: O(rows * x) vectorised mask work, plus O(k log k + sum of group size * group depth) for the k squares
+    evaluated.
+    """
+    ids = _IDS[y0:y1]
+    pending = np.ones(ids.shape, dtype=bool) if full else animated[ids] | _DIRTY[y0:y1]
+    ys, xs = np.nonzero(pending)
+    ys += y0
+    for signature_id, (group_xs, group_ys) in group_by_key(ids[ys - y0, xs].astype(np.int64), xs, ys, int).items():
+        layer_indices, inverted = signatures[signature_id]
+        _FRAME[group_ys, group_xs] = evaluate_group(layer_indices, inverted, background, timestamp, group_xs, group_ys)
+    return len(xs)
+
+
+class BandRenderer:
+    """
+    Renders a grid with a pool of worker processes, one band of rows per task.
+
+    The renderer keeps the shared signature ids up to date from the grid's dirty squares (GridState), so it takes
+    the place of Grid.render_frame for that grid: rendering the same grid with both would make each miss changes.
+    Use close (or a with block) to stop the workers and free the shared memory.
+    """
+
+    BANDS_PER_WORKER = 4
+
+    def __init__(self, grid: Grid, workers: int | None = None, bands: int | None = None) -> None:
+        """
+        INPUTS: grid, workers (number of processes, None for one per CPU), bands (None for BANDS_PER_WORKER per worker)
+        RAISE: None
+        OUTPUTS: None
+
+        Complexity: O(x*y) to allocate the shared arrays, plus starting the workers.
+        """
+        self.grid = grid
+        self.workers = workers or os.cpu_count() or 1
+        band_count = min(grid.y, bands or self.BANDS_PER_WORKER * self.workers)
+        edges = np.linspace(0, grid.y, band_count + 1).astype(int).tolist()
+        self.bands = [(y0, y1) for y0, y1 in zip(edges, edges[1:]) if y0 < y1]
+
+        self.blocks = [
+            shared_memory.SharedMemory(create=True, size=max(1, size))
+            for size in (grid.x * grid.y * 3, grid.x * grid.y * 4, grid.x * grid.y)
+        ]
+        self.frame = _shared_array(self.blocks[0], (grid.y, grid.x, 3), np.uint8)
+        self.ids = _shared_array(self.blocks[1], (grid.y, grid.x), np.int32)
+        self.dirty = _shared_array(self.blocks[2], (grid.y, grid.x), np.bool_)
+        self.dirty[:] = False
+
+        self.signatures = [] # id -> signature
+        self.signature_ids = {}
+        self.animated = [] # id -> whether the signature holds a time-varying layer
+        self.background = None
+        self.recomputed_cells = 0
+        self.pool = ProcessPoolExecutor(
+            self.workers, initializer=_attach,
+            initargs=tuple(block.name for block in self.blocks) + (grid.x, grid.y),
+        )
+
+    def signature_id(self, signature) -> int:
+        signature_id = self.signature_ids.get(signature)
+        if signature_id is None:
+            signature_id = self.signature_ids[signature] = len(self.signatures)
+            self.signatures.append(signature)
+            self.animated.append(not compile_stack(signature[0]).time_invariant)
+        return signature_id
+
+    def update(self, xs: np.ndarray, ys: np.ndarray) -> None:
+        """Reads the signatures of these squares into the shared ids. Complexity: please refer to group_cells."""
+        for signature, (group_xs, group_ys) in self.grid.grid.group_cells(xs, ys).items():
+            self.ids[group_ys, group_xs] = self.signature_id(signature)
+
+    def render_frame(self, timestamp, background) -> np.ndarray:
+        """
+        Evaluates the colour of every grid square, splitting the work across the workers by bands of rows.
+        The result matches Grid.render_frame.
+
+        INPUTS: timestamp (float), background (starting colour, tuple)
+        RAISE: None
+        OUTPUTS: y x x x 3 uint8 array, indexed as frame[y][x]. It is the shared buffer, reused by the next call,
+        so copy it to keep it.
+
+        Complexity: O(d) in this process to read the d dirty squares' signatures (every square after a grid-wide
+        special, see group_cells), then the band work (see _render_band) split over the workers.
+        """
+        background = tuple(int(c) for c in background)
+        state = self.grid.state
+        full = self.background != background or state.all_dirty
+        if full:
+            xs, ys = np.indices((self.grid.x, self.grid.y)).reshape(2, -1)
+            self.update(xs, ys)
+            dirty_xs = dirty_ys = None
+        elif state.has_dirty():
+            dirty_xs, dirty_ys = state.dirty_squares()
+            self.update(dirty_xs, dirty_ys)
+            self.dirty[dirty_ys, dirty_xs] = True
+        else:
+            dirty_xs = dirty_ys = None
+        state.clear()
+        self.background = background
+
+        animated = np.array(self.animated, dtype=bool)
+        futures = [
+            self.pool.submit(_render_band, y0, y1, self.signatures, animated, timestamp, background, full)
+            for y0, y1 in self.bands
+        ]
+        self.recomputed_cells = sum(future.result() for future in futures)
+        if dirty_xs is not None:
+            self.dirty[dirty_ys, dirty_xs] = False
+        return self.frame
+
+    def close(self) -> None:
+        """Stops the workers and frees the shared memory."""
+        self.pool.shutdown()
+        self.frame = self.ids = self.dirty = None
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+    def __enter__(self) -> BandRenderer:
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
@@ -0,0 +1,109 @@
+"""
+Canvas renderers.
+
+Both renderers draw a viewport of the grid, view_x by view_y squares, into the rectangle (0, 0) -> (width, height)
+of the window. Only the squares in the viewport are evaluated, so grids far larger than the window (e.g. tiled
+storage) cost no more per frame than one the size of the viewport.
+- RectangleRenderer: one filled rectangle per grid square (the original approach).
+- TextureRenderer: every square colour is written into a single texture, which is drawn as one quad.
+"""
+
+from __future__ import annotations
+import arcade
+import numpy as np
+from arcade.gl import geometry
+from grid import Grid
+
+RENDER_BACKEND_RECTANGLES = "RECTANGLES"
+RENDER_BACKEND_TEXTURE = "TEXTURE"
+RENDER_BACKENDS = (
+    RENDER_BACKEND_RECTANGLES,
+    RENDER_BACKEND_TEXTURE,
+)
+
+
+class RectangleRenderer:
+    """Draws every grid square with its own immediate-mode rectangle call."""
+
+    def __init__(self, window: arcade.Window, view_x: int, view_y: int, width: float, height: float) -> None:
+        self.view_x = view_x
+        self.view_y = view_y
+        self.sq_width = width / view_x
+        self.sq_height = height / view_y
+
+    def draw(self, grid: Grid, timestamp, background, viewport=None) -> None:
+        """viewport (x0, y0, x1, y1) is the view_x by view_y area of the grid to draw, (0, 0) -> (view_x, view_y) if None."""
+        x0, y0, x1, y1 = (0, 0, self.view_x, self.view_y) if viewport is None else viewport
+        for x in range(x0, x1):
+            for y in range(y0, y1):
+                arcade.draw_lrtb_rectangle_filled(
+                    self.sq_width * (x-x0),
+                    self.sq_width * (x-x0+1),
+                    self.sq_height * (y-y0+1),
+                    self.sq_height * (y-y0),
+                    grid[x][y].get_color(background[:], timestamp, x, y),
+                )
+
+
+class TextureRenderer:
+    """
+    Writes the frame from Grid.render_frame into a viewport-sized texture (one texel per square),
+    then draws that texture stretched over the canvas with nearest-neighbour filtering.
+    """
+
+    VERTEX_SHADER = """
+    #version 330
+    in vec2 in_vert;
+    in vec2 in_uv;
+    out vec2 uv;
+    void main() {
+        gl_Position = vec4(in_vert, 0.0, 1.0);
+        uv = in_uv;
+    }
+    """
+
+    FRAGMENT_SHADER = """
+    #version 330
+    uniform sampler2D canvas;
+    in vec2 uv;
+    out vec4 fragColor;
+    void main() {
+        fragColor = texture(canvas, uv);
+    }
+    """
+
+    def __init__(self, window: arcade.Window, view_x: int, view_y: int, width: float, height: float) -> None:
+        ctx = window.ctx
+        self.view_x = view_x
+        self.view_y = view_y
+        # RGBA keeps every texture row 4-byte aligned, whatever the viewport width.
+        self.pixels = np.full((view_y, view_x, 4), 255, dtype=np.uint8)
+        self.texture = ctx.texture((view_x, view_y), components=4, filter=(ctx.NEAREST, ctx.NEAREST))
+        self.program = ctx.program(vertex_shader=self.VERTEX_SHADER, fragment_shader=self.FRAGMENT_SHADER)
+        # The quad is placed in normalised device coordinates, where the window spans [-1, 1] on both axes.
+        # Row 0 of the frame is y = 0, which is also the bottom row of the texture, so no flip is needed.
+        self.quad = geometry.quad_2d(
+            size=(2 * width / window.width, 2 * height / window.height),
+            pos=(width / window.width - 1, height / window.height - 1),
+        )
+
+    def draw(self, grid: Grid, timestamp, background, viewport=None) -> None:
+        """viewport (x0, y0, x1, y1) is the view_x by view_y area of the grid to draw, (0, 0) -> (view_x, view_y) if None."""
+        viewport = (0, 0, self.view_x, self.view_y) if viewport is None else viewport
+        self.pixels[:, :, :3] = grid.render_frame(timestamp, background, viewport)
+        self.texture.write(self.pixels.tobytes())
+        self.texture.use(0)
+        self.quad.render(self.program)
+
+
+def make_renderer(backend: str, window: arcade.Window, view_x: int, view_y: int, width: float, height: float):
+    """
+    Create the renderer for `backend`, drawing view_x by view_y squares of a grid.
+    If the texture backend cannot be set up (for example, no usable GL context), fall back to rectangles.
+    """
+    if backend == RENDER_BACKEND_TEXTURE:
+        try:
+            return TextureRenderer(window, view_x, view_y, width, height)
+        except Exception as e:
+            print(f"Texture renderer unavailable, using rectangles: {e}")
+    return RectangleRenderer(window, view_x, view_y, width, height)
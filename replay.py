@@ -1,11 +1,65 @@
 from __future__ import annotations
-from action import PaintAction
+import math
+import numpy as np
+from action import PaintAction, RestoreAction
 from grid import Grid
 from undo import *
-from data_structures.queue_adt import CircularQueue
+from layer_deque import LayerDeque
+from journal import Journal, JournalWriter
 
-class ReplayTracker: # using circular queue to serve actions in the order that they happened in
+class ReplayTracker: # using a growable deque to keep actions in the order that they happened in
+    """
+    Records a session's actions, and plays them back as a timeline of steps.
 
+    Step i of the timeline is the i-th recorded action. Before the first step is played, the timeline is built by playing
+    the whole session once on a scratch grid: undo entries are resolved there into the squares they changed (with an
+    UndoTracker, exactly as live undo does), so every step becomes a plain forward action, and a snapshot of the grid
+    is kept every snapshot_interval steps. seek(grid, step) then costs one snapshot restore plus at most
+    snapshot_interval steps.
+
+    With a journal (see journal.py), every recorded action is also appended to it. from_journal replays a journal
+    instead, decoding each action from the file when its step is played, so the session is never loaded as a whole.
+    """
+
+    SNAPSHOT_INTERVAL = 64
+
+    def __init__(self, snapshot_interval: int = SNAPSHOT_INTERVAL, journal: JournalWriter | None = None) -> None:
+        """
+        INPUTS: snapshot_interval (integer), journal (JournalWriter to record to, or None)
+        RAISE: None
+        OUTPUTS: None
+
+        Complexity: best = worst = O(1), since initialising is always constant
+        """
+        self.entries = LayerDeque() # (action, is_undo), in the order they happened
+        self.journal = journal
+        self.snapshot_interval = snapshot_interval
+        self.undo_budget = math.inf # memory budget of the history build uses to resolve undo entries
+        self.position = 0 # number of steps played so far
+        self.undos = None # step -> forward action of each undo entry, once the timeline is built (see build)
+        self.snapshots = {}
+
+    @classmethod
+    def from_journal(cls, journal: Journal, snapshot_interval: int = SNAPSHOT_INTERVAL) -> ReplayTracker:
+        """
+        A replay of the consistent part of a journal, e.g. to recover a session after a crash: skip_to_end puts
+        a grid of the journal's draw style and size in the state of the last action written.
+        Resolving undo entries keeps the same history as the window's UndoTracker, so it is bounded the same way.
+
+        INPUTS: journal (Journal), snapshot_interval (integer)
+        RAISE: None
+        OUTPUTS: ReplayTracker
+
+        Complexity: O(1), the journal is only read when the timeline is built and played.
+        """
+        replay = cls(snapshot_interval)
+        replay.entries = journal
+        replay.undo_budget = UndoTracker.DEFAULT_MEMORY_BUDGET
+        return replay
+
+    def __len__(self) -> int:
+        """Number of steps in the replay."""
+        return len(self.entries)
 
     def start_replay(self) -> None:
         """
@@ -17,15 +71,10 @@ class ReplayTracker: # using circular queue to serve actions in the order that t
         RAISE: None
         OUTPUTS: None
 
-        Complexity: best-case is O(1) if there is only one action to replay, best-case is O(len(self.replay_tracker)), if it has 
-        to replay more than one action, thus serving each item in the tracker.
+        Complexity: best = worst = O(1), the replay restarts from the first step, and the timeline is built when the
+        first step is played.
         """
-        self.replay_tracker = CircularQueue(100)
-        # use for loop to serve actions
-        for i in range(len(self.replay_tracker)):
-            self.replay_tracker.serve()
-        
-        
+        self.position = 0
 
     def add_action(self, action: PaintAction, is_undo: bool=False) -> None:
         """
@@ -38,9 +87,69 @@ class ReplayTracker: # using circular queue to serve actions in the order that t
         RAISE: None
         OUTPUT: None
 
-        Complexity: best = worst = O(1), since appending an item to a queue is always constant
+        Complexity: amortised O(1), since appending to the deque is amortised constant, plus encoding the action
+        into the journal's buffer (see journal.py). The timeline is built again on the next play.
         """
-        self.replay_tracker.append(action)
+        self.entries.append((action, is_undo))
+        if self.journal is not None:
+            self.journal.write(action, is_undo)
+        self.undos = None
+
+    def build(self, grid: Grid) -> None:
+        """
+        Builds the timeline for grids like `grid` (same draw style and size), starting from an empty grid.
+
+        INPUTS: grid
+        RAISE: None
+        OUTPUTS: None
+
+        Complexity: O(the cost of playing every action once, plus x*y per snapshot), on a compact scratch grid.
+        """
+        scratch = Grid(grid.draw_style, grid.x, grid.y, storage=Grid.STORAGE_COMPACT)
+        undo = UndoTracker(scratch, memory_budget=self.undo_budget)
+        self.undos = {}
+        self.snapshots = {0: scratch.snapshot()}
+        for step, (action, is_undo) in enumerate(self.entries, 1):
+            if not is_undo:
+                action.redo_apply(scratch)
+                undo.add_action(action)
+            else:
+                self.undos[step - 1] = self.resolve_undo(scratch, undo)
+            if step % self.snapshot_interval == 0:
+                self.snapshots[step] = scratch.snapshot()
+
+    def play_step(self, grid: Grid) -> None:
+        """Plays the step at self.position: the recorded action, or the forward form of an undo entry."""
+        action = self.undos.get(self.position)
+        if action is None:
+            action = self.entries[self.position][0]
+        action.redo_apply(grid)
+        self.position += 1
+
+    def resolve_undo(self, scratch: Grid, undo: UndoTracker) -> PaintAction | RestoreAction:
+        """
+        Undoes the last action on the scratch grid, and returns a forward action with the same effect.
+        Undoing a SEQUENCE special can change any square written before or after it: squares empty both times are
+        unchanged, so only the written ones are recorded.
+        """
+        if undo.undoTracker.is_empty():
+            return PaintAction() # nothing to undo, as in the session
+        before = np.zeros(0, dtype=np.int64)
+        if scratch.draw_style == Grid.DRAW_STYLE_SEQUENCE and undo.undoTracker[len(undo.undoTracker) - 1].is_special:
+            before = scratch.written_keys()
+        action = undo.undo(scratch)
+        if action.is_special and scratch.draw_style != Grid.DRAW_STYLE_SEQUENCE:
+            return action # special is its own inverse
+        if action.is_special:
+            keys = np.union1d(before, scratch.written_keys())
+        else:
+            keys = np.unique(action.keys(scratch.y))
+        signatures = []
+        ids = np.empty(len(keys), dtype=np.intp)
+        for signature, (xs, ys) in scratch.grid.group_cells(keys // scratch.y, keys % scratch.y).items():
+            ids[np.searchsorted(keys, xs * scratch.y + ys)] = len(signatures)
+            signatures.append(signature)
+        return RestoreAction(keys, ids, signatures)
 
     def play_next_action(self, grid: Grid) -> bool:
         """
@@ -51,13 +160,108 @@ class ReplayTracker: # using circular queue to serve actions in the order that t
 
         INPUTS: grid
         RAISE: None
-        OUTPUTS: True (boolean value), grid (array) with the action applied on it
+        OUTPUTS: True (boolean value) if the replay is finished, otherwise False
+
+        Complexity: the cost of the step's action (see action.py), plus building the timeline if it isn't built yet.
         """
-        if self.replay_tracker.is_empty():
+        if self.position >= len(self.entries):
             return True
-        else:
-            self.replay_tracker.serve(grid)
-            return grid
+        if self.undos is None:
+            self.build(grid)
+        self.play_step(grid)
+        return False
+
+    def play_actions(self, grid: Grid, n: int) -> bool:
+        """
+        Plays the next n replay actions on the grid (or as many as are left), for replaying faster than one action
+        at a time. When n is more than snapshot_interval, the grid jumps there through a snapshot instead.
+
+        INPUTS: grid, n (integer, math.inf plays every remaining action)
+        RAISE: None
+        OUTPUTS: True (boolean value) if the replay is finished, otherwise False
+
+        Complexity: please refer to seek, with at most min(n, snapshot_interval) steps played.
+        """
+        self.seek(grid, int(min(self.position + n, len(self.entries))))
+        return self.position >= len(self.entries)
+
+    def skip_to_end(self, grid: Grid) -> None:
+        """
+        Puts the grid in its state at the end of the replay.
+
+        Complexity: please refer to seek.
+        """
+        self.seek(grid, len(self.entries))
+
+    def replay_all(self, grid: Grid, frames=(), timestamp=0, background=(255, 255, 255)) -> dict:
+        """
+        Plays the whole replay on an empty grid with no window, as fast as possible, rendering only the requested
+        frames. The steps are played once in order, as play_forward does, so the timeline isn't built unless the
+        replay is seeked afterwards. The grid is left in its state at the end of the replay.
+
+        INPUTS: grid, frames (steps after which to render a frame, 0 being the empty grid), timestamp and
+        background (as for Grid.render_frame)
+        RAISE: ValueError if a frame step is not between 0 and the number of steps
+        OUTPUTS: dictionary of step -> H x W x 3 uint8 array (see Grid.render_frame)
+
+        Complexity: O(the cost of every step once, see play_forward), plus one render per frame.
+        """
+        frames = set(frames)
+        for step in frames:
+            if not 0 <= step <= len(self.entries):
+                raise ValueError(f"Can only render a frame between 0 and {len(self.entries)}, not {step}.")
+        rendered = {}
+        if 0 in frames:
+            rendered[0] = grid.render_frame(timestamp, background).copy()
+        for step, _ in enumerate(self.play_forward(grid), 1):
+            if step in frames:
+                rendered[step] = grid.render_frame(timestamp, background).copy()
+        self.position = len(self.entries)
+        return rendered
+
+    def play_forward(self, grid: Grid):
+        """
+        Plays every step on an empty grid in order, yielding after each one, without building the timeline: undo
+        entries are undone with an UndoTracker on the grid itself, so no snapshots are kept, and the memory used is
+        bounded by undo_budget however long the replay is (from_journal also reads each action as it is played).
+        This doesn't move the replay position.
+
+        INPUTS: grid
+        RAISE: None
+        OUTPUTS: generator, yielding None after each step
+
+        Complexity: the cost of each action (see action.py and UndoTracker.undo), as it is played.
+        """
+        undo = UndoTracker(grid, memory_budget=self.undo_budget)
+        for action, is_undo in self.entries:
+            if is_undo:
+                undo.undo(grid)
+            else:
+                action.redo_apply(grid)
+                undo.add_action(action)
+            yield
+
+    def seek(self, grid: Grid, step: int) -> None:
+        """
+        Puts the grid in its state after `step` steps of the replay, and continues the replay from there.
+
+        INPUTS: grid, step (integer)
+        RAISE: ValueError if step is not between 0 and the number of steps
+        OUTPUTS: None
+
+        Complexity: one snapshot restore (see Grid.restore) plus at most snapshot_interval steps,
+        plus building the timeline if it isn't built yet.
+        """
+        if not 0 <= step <= len(self.entries):
+            raise ValueError(f"Can only seek to a step between 0 and {len(self.entries)}, not {step}.")
+        if self.undos is None:
+            self.build(grid)
+        start = step - step % self.snapshot_interval
+        if not start <= self.position <= step:
+            grid.restore(self.snapshots[start]) # otherwise playing on from the current position is cheaper
+            self.position = start
+        while self.position < step:
+            self.play_step(grid)
 
 if __name__ == "__main__":
     action1 = PaintAction([], is_special=True)
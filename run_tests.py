@@ -31,8 +31,23 @@ if __name__ == "__main__":
         help="Use if running on Ed.",
         action="store_true",
     )
+    p.add_argument(
+        "-b",
+        "--bench",
+        help="Run the benchmark suite against its stored baseline instead of the tests (see benchmarks/suite.py).",
+        action="store_true",
+    )
+    # The benchmark options (and the benchmark imports) are only added with --bench.
+    bench = argparse.ArgumentParser(add_help=False)
+    bench.add_argument("-b", "--bench", action="store_true")
+    if bench.parse_known_args()[0].bench:
+        from benchmarks import suite as benchmark_suite
+        benchmark_suite.add_arguments(p)
     args = p.parse_args()
 
+    if args.bench:
+        raise SystemExit(benchmark_suite.main(args))
+
     suite = unittest.defaultTestLoader.discover('.')
     for s in suite:
         for t in s:
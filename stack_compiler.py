@@ -0,0 +1,119 @@
+"""
+Layer stack compiler.
+
+compile_stack turns an ordered stack of layers (given by index) into one CompiledStack,
+which behaves like applying every layer in turn but does far less work:
+- A colour invariant layer (e.g. red, rainbow) throws away everything applied before it.
+- Pure layers applied to a known constant colour are evaluated once, at compile time.
+- Runs of channelwise layers (lighten, darken, invert) are fused into a single 256 entry lookup table,
+  so invert then invert cancels out entirely, and 100 lightens cost the same as one.
+
+Compiled stacks are cached per distinct stack, so every square (and frame) with the same stack shares one.
+"""
+
+from __future__ import annotations
+import numpy as np
+from layer_util import LAYERS, Layer
+
+IDENTITY_LUT = tuple(range(256))
+
+
+class CompiledStack:
+
+    def __init__(self, layer_indices: tuple[int, ...]) -> None:
+        self.layer_indices = layer_indices
+        # constant: the colour everything so far reduces to, whatever the start (None if it depends on the start).
+        # steps: what is still applied afterwards, each either a Layer or a lookup table (tuple of 256 ints).
+        self.constant = None
+        self.steps = []
+        for index in layer_indices:
+            self._push(LAYERS[index])
+        self.time_invariant = all(
+            isinstance(step, tuple) or step.time_invariant for step in self.steps
+        )
+        self.position_invariant = all(
+            isinstance(step, tuple) or step.position_invariant for step in self.steps
+        )
+        self.luts = [np.array(step, dtype=np.int64) if isinstance(step, tuple) else None for step in self.steps]
+        self.apply = self._fuse()
+
+    def _push(self, layer: Layer) -> None:
+        if layer.color_invariant:
+            if layer.pure_in_color:
+                self.constant = tuple(layer.apply((0, 0, 0), 0, 0, 0))
+                self.steps = []
+            else:
+                # The start is irrelevant, but the layer itself still has to run.
+                self.constant = None
+                self.steps = [layer]
+        elif self.constant is not None and not self.steps and layer.pure_in_color:
+            self.constant = tuple(layer.apply(self.constant, 0, 0, 0))
+        elif layer.channelwise and layer.pure_in_color:
+            lut = tuple(layer.apply((v, v, v), 0, 0, 0)[0] for v in range(256))
+            if self.steps and isinstance(self.steps[-1], tuple):
+                previous = self.steps.pop()
+                lut = tuple(lut[v] for v in previous)
+            if lut != IDENTITY_LUT:
+                self.steps.append(lut)
+        else:
+            self.steps.append(layer)
+
+    def _fuse(self) -> function:
+        """Build the single callable (color, timestamp, x, y) -> colour for this stack."""
+        constant = self.constant
+        steps = self.steps
+        if not steps:
+            if constant is not None:
+                return lambda color, timestamp, x, y: constant
+            return lambda color, timestamp, x, y: tuple(color)
+        if len(steps) == 1 and isinstance(steps[0], tuple):
+            lut = steps[0]
+            if constant is not None:
+                result = (lut[constant[0]], lut[constant[1]], lut[constant[2]])
+                return lambda color, timestamp, x, y: result
+            return lambda color, timestamp, x, y: (lut[color[0]], lut[color[1]], lut[color[2]])
+
+        def apply(color, timestamp, x, y):
+            if constant is not None:
+                color = constant
+            for step in steps:
+                if isinstance(step, tuple):
+                    color = (step[color[0]], step[color[1]], step[color[2]])
+                else:
+                    color = step.apply(color, timestamp, x, y)
+            return tuple(color)
+        return apply
+
+    @property
+    def pure_in_color(self) -> bool:
+        """True if the output only depends on the input colour, as for Layer.pure_in_color."""
+        return self.time_invariant and self.position_invariant
+
+    def apply_batch(self, colors: np.ndarray, timestamp, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        """Vectorised form of apply, see Layer.apply_batch."""
+        if self.position_invariant and len(colors) > 1 and (colors == colors[0]).all():
+            # Every square starts from the same colour and position doesn't matter: evaluate one and copy it.
+            return np.repeat(self.apply_batch(colors[:1], timestamp, xs[:1], ys[:1]), len(colors), axis=0)
+        if self.constant is not None:
+            colors = np.empty_like(colors)
+            colors[:] = self.constant
+        for step, lut in zip(self.steps, self.luts):
+            if lut is not None:
+                colors = lut[colors]
+            else:
+                colors = step.apply_batch(colors, timestamp, xs, ys)
+        return colors
+
+
+_COMPILED: dict[tuple[int, ...], CompiledStack] = {}
+
+
+def compile_stack(layer_indices: tuple[int, ...]) -> CompiledStack:
+    """
+    Returns the compiled form of the stack of layers with these indices (applied first to last).
+    Complexity: O(1) for a stack seen before, otherwise O(len(layer_indices)).
+    """
+    compiled = _COMPILED.get(layer_indices)
+    if compiled is None:
+        compiled = _COMPILED[layer_indices] = CompiledStack(layer_indices)
+    return compiled
@@ -0,0 +1,75 @@
+import random
+import unittest
+from ed_utils.decorators import number
+
+import numpy as np
+from action import PaintAction, PaintStep
+from grid import Grid
+from layer_util import get_layers
+
+
+def random_steps(rng: random.Random, width: int, height: int, count: int, repeats: bool = False) -> list[PaintStep]:
+    """Steps painting column runs of squares, with each square painted at most once unless repeats."""
+    layers = [layer for layer in get_layers() if layer is not None]
+    steps, painted = [], set()
+    while len(steps) < count:
+        x, y, layer = rng.randrange(width), rng.randrange(height), rng.choice(layers)
+        for k in range(rng.randrange(1, 6)):
+            if y + k < height and (repeats or (x, y + k) not in painted):
+                painted.add((x, y + k))
+                steps.append(PaintStep((x, y + k), layer))
+    return steps
+
+
+def signatures(grid: Grid) -> list:
+    return [[grid[x][y].signature() for y in range(grid.y)] for x in range(grid.x)]
+
+
+class TestPaintAction(unittest.TestCase):
+
+    @number("10.1")
+    def test_steps_round_trip(self):
+        rng = random.Random(12)
+        for repeats in (False, True):
+            with self.subTest(repeats=repeats):
+                steps = random_steps(rng, 9, 14, 80, repeats)
+                action = PaintAction(steps)
+                self.assertEqual(list(action.steps), steps)
+                self.assertEqual(len(action), len(steps))
+                self.assertEqual(action, PaintAction(list(steps)))
+                xs, ys, layers = action.squares()
+                self.assertEqual(
+                    list(zip(xs.tolist(), ys.tolist(), layers.tolist())),
+                    [(step.affected_grid_square[0], step.affected_grid_square[1], step.affected_layer.index)
+                     for step in steps],
+                )
+        column = PaintAction()
+        column.add_squares([(3, y) for y in range(2, 40)], get_layers()[1])
+        column.add_squares([(3, y) for y in range(40, 50)], get_layers()[2])
+        self.assertEqual(len(column.run_xs), 2)
+        self.assertEqual(len(column), 48)
+
+    @number("10.2")
+    def test_bulk_apply_matches_each_step(self):
+        rng = random.Random(13)
+        for style in Grid.DRAW_STYLE_OPTIONS:
+            for repeats in (False, True):
+                with self.subTest(style=style, repeats=repeats):
+                    steps = random_steps(rng, 9, 14, 60, repeats)
+                    action = PaintAction(steps)
+                    bulk, each = Grid(style, 9, 14), Grid(style, 9, 14)
+                    action.redo_apply(bulk)
+                    for step in steps:
+                        step.redo_apply(each)
+                    self.assertEqual(signatures(bulk), signatures(each))
+                    action.undo_apply(bulk)
+                    for step in steps:
+                        step.undo_apply(each)
+                    self.assertEqual(signatures(bulk), signatures(each))
+
+    @number("10.3")
+    def test_from_squares(self):
+        steps = random_steps(random.Random(15), 9, 14, 50, repeats=True)
+        xs, ys, layers = PaintAction(steps).squares()
+        self.assertEqual(list(PaintAction.from_squares(xs, ys, layers).steps), steps)
+        self.assertEqual(len(PaintAction.from_squares(np.array([], dtype=int), np.array([], dtype=int), [])), 0)
@@ -0,0 +1,130 @@
+import os
+import random
+import struct
+import tempfile
+import unittest
+from unittest import mock
+from ed_utils.decorators import number
+
+import numpy as np
+from animation import GIF_PALETTE, gif_indices, lzw_encode, replay_frames, write_gif
+from grid import Grid
+from headless import render_image
+from replay import ReplayTracker
+from tests.test_replay import record_session
+
+
+def lzw_decode(data: bytes, min_code_size: int) -> bytes:
+    """GIF's variable code length LZW decoder."""
+    clear, end = 1 << min_code_size, (1 << min_code_size) + 1
+    out = bytearray()
+    position = 0
+    table, code_size, previous = None, min_code_size + 1, None
+    while True:
+        code = int.from_bytes(data[position // 8:position // 8 + 3], "little") >> position % 8 & (1 << code_size) - 1
+        position += code_size
+        if code == clear:
+            table = [bytes([i]) for i in range(clear)] + [b"", b""]
+            code_size, previous = min_code_size + 1, None
+            continue
+        if code == end:
+            return bytes(out)
+        entry = table[code] if code < len(table) else previous + previous[:1]
+        out += entry
+        if previous is not None and len(table) < 4096:
+            table.append(previous + entry[:1])
+        previous = entry
+        if len(table) == 1 << code_size and code_size < 12:
+            code_size += 1
+
+
+def read_gif(path: str) -> tuple[np.ndarray, list, list]:
+    """The global palette, and the palette indices (H x W) and delay of every image in an animated GIF."""
+    with open(path, "rb") as f:
+        data = f.read()
+    assert data[:6] == b"GIF89a"
+    width, height, flags = struct.unpack_from("<HHB", data, 6)
+    palette = np.frombuffer(data, np.uint8, 3 << (flags & 7) + 1, 13).reshape(-1, 3)
+    offset = 13 + len(palette) * 3
+    images, delays = [], []
+
+    def sub_blocks(offset: int) -> tuple[bytes, int]:
+        chunks = []
+        while data[offset]:
+            chunks.append(data[offset + 1:offset + 1 + data[offset]])
+            offset += 1 + data[offset]
+        return b"".join(chunks), offset + 1
+
+    while data[offset] != 0x3B:
+        if data[offset] == 0x21:
+            if data[offset + 1] == 0xF9:
+                delays.append(struct.unpack_from("<H", data, offset + 4)[0])
+            _, offset = sub_blocks(offset + 2)
+        else:
+            assert data[offset] == 0x2C
+            x, y, w, h, _ = struct.unpack_from("<HHHHB", data, offset + 1)
+            assert (x, y, w, h) == (0, 0, width, height)
+            min_code_size = data[offset + 10]
+            pixels, offset = sub_blocks(offset + 11)
+            images.append(np.frombuffer(lzw_decode(pixels, min_code_size), np.uint8).reshape(h, w))
+    return palette, images, delays
+
+
+class TestAnimation(unittest.TestCase):
+
+    def session(self, style: str) -> ReplayTracker:
+        replay = ReplayTracker()
+        record_session(Grid(style, 12, 9), replay, random.Random(1), 30)
+        return replay
+
+    @number("7.1")
+    def test_frames_show_each_step(self):
+        for style in Grid.DRAW_STYLE_OPTIONS:
+            with self.subTest(style=style):
+                replay = self.session(style)
+                frames = [(pixels.copy(), repeated) for pixels, repeated in replay_frames(replay, Grid(style, 12, 9),
+                                                                                          fps=4, scale=3)]
+                self.assertEqual(len(frames), len(replay) + 1)
+                reference = Grid(style, 12, 9)
+                for step, (pixels, repeated) in enumerate(frames):
+                    replay.seek(reference, step)
+                    self.assertEqual(pixels.tolist(), render_image(reference, step / 4, scale=3).tolist())
+                    if repeated:
+                        self.assertEqual(pixels.tolist(), frames[step - 1][0].tolist())
+                with self.assertRaises(ValueError):
+                    next(replay_frames(replay, Grid(style, 12, 9), scale=0))
+
+    @number("7.2")
+    def test_gif_decodes(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "session.gif")
+        replay = self.session(Grid.DRAW_STYLE_ADD)
+        frames = [(pixels.copy(), repeated) for pixels, repeated in replay_frames(replay, Grid(Grid.DRAW_STYLE_ADD, 12, 9),
+                                                                                  fps=8, scale=2)]
+        count = write_gif(replay_frames(replay, Grid(Grid.DRAW_STYLE_ADD, 12, 9), fps=8, scale=2), path, fps=8)
+        self.assertEqual(count, len(frames))
+        palette, images, delays = read_gif(path)
+        np.testing.assert_array_equal(palette, GIF_PALETTE)
+        shown = [pixels for pixels, repeated in frames if not repeated]
+        self.assertEqual(len(images), len(shown))
+        self.assertEqual(len(delays), len(images))
+        self.assertEqual(sum(delays), round(100 * len(frames) / 8))
+        for image, pixels in zip(images, shown):
+            np.testing.assert_array_equal(image, gif_indices(pixels))
+
+    @number("7.3")
+    def test_lzw_round_trip(self):
+        rng = random.Random(2)
+        for data in (b"", b"\x07", bytes(5000), bytes(rng.randrange(256) for _ in range(20000)),
+                     bytes(rng.randrange(4) for _ in range(50000))):
+            with self.subTest(size=len(data)):
+                self.assertEqual(lzw_decode(lzw_encode(data), 8), data)
+
+    @number("7.4")
+    def test_one_render_per_frame(self):
+        replay = self.session(Grid.DRAW_STYLE_SET)
+        grid = Grid(Grid.DRAW_STYLE_SET, 12, 9)
+        with mock.patch.object(grid, "render_frame", wraps=grid.render_frame) as render_frame:
+            for frame, _ in enumerate(replay_frames(replay, grid, fps=4, scale=2), 1):
+                self.assertEqual(render_frame.call_count, frame)
@@ -0,0 +1,56 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+from ed_utils.decorators import number
+
+from benchmarks import grid_storage
+from benchmarks.suite import best_time, compare, format_seconds
+from grid import Grid
+
+
+class TestSuite(unittest.TestCase):
+
+    @number("12.1")
+    def test_compare_threshold(self):
+        results = {"fast": 0.5, "same": 1.0, "limit": 1.25, "slow": 1.3, "new": 2.0}
+        baseline = {"fast": 1.0, "same": 1.0, "limit": 1.0, "slow": 1.0, "gone": 1.0}
+        cases = {case["name"]: case for case in compare(results, baseline, threshold=0.25)}
+        self.assertEqual(set(cases), set(results))
+        self.assertEqual({name for name, case in cases.items() if not case["passed"]}, {"slow"})
+        self.assertIsNone(cases["new"]["baseline"])
+        self.assertIn("no baseline", cases["new"]["feedback"])
+        self.assertIn("+30%", cases["slow"]["feedback"])
+        self.assertIn("more than the 25% allowed", cases["slow"]["feedback"])
+        self.assertEqual((cases["fast"]["seconds"], cases["fast"]["baseline"]), (0.5, 1.0))
+        self.assertFalse(compare({"slow": 1.3}, {"slow": 1.0}, threshold=0.1)[0]["passed"])
+        self.assertTrue(compare({"slow": 1.3}, {"slow": 1.0}, threshold=0.5)[0]["passed"])
+        relative = compare({"a": 2.5, "b": 2.6}, {"a": 1.0, "b": 1.0}, threshold=0.25, unit=2.0) # baseline in units
+        self.assertEqual([(case["baseline"], case["passed"]) for case in relative], [(2.0, True), (2.0, False)])
+
+    @number("12.2")
+    def test_best_time_and_format(self):
+        calls = []
+        seconds = best_time(lambda: calls.append("run"), repeats=4, setup=lambda: calls.append("setup"), min_time=0)
+        self.assertEqual(calls, ["setup", "run"] * 4)
+        self.assertGreaterEqual(seconds, 0)
+        calls.clear()
+        seconds = best_time(lambda: (calls.append("run"), time.sleep(0.002)), repeats=3, min_time=0.02)
+        self.assertGreaterEqual(len(calls), 3 * 5) # each sample runs until it has measured min_time
+        self.assertTrue(0.002 <= seconds < 0.02, seconds) # the time of one run
+        self.assertEqual(format_seconds(2.5), "2.5 s")
+        self.assertEqual(format_seconds(0.0123), "12.3 ms")
+        self.assertEqual(format_seconds(4e-6), "4 us")
+        self.assertEqual(format_seconds(5e-8), "50 ns")
+
+    @number("12.3")
+    def test_grid_storage_closes_grids(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        with mock.patch.object(tempfile, "tempdir", directory.name): # where the tiled storage's file goes
+            for storage in Grid.STORAGE_CLASSES:
+                seconds, peak = grid_storage.measure(storage, 64)
+                self.assertGreaterEqual(seconds, 0)
+                self.assertGreater(peak, 0)
+        self.assertEqual(os.listdir(directory.name), [])
@@ -0,0 +1,95 @@
+import os
+import random
+import struct
+import tempfile
+import unittest
+import zlib
+from ed_utils.decorators import number
+
+import numpy as np
+from action import PaintAction, PaintStep
+from grid import Grid
+from headless import encode_png, encode_ppm, render_image, render_sessions
+from journal import JournalWriter
+from layer_util import get_layers
+from replay import ReplayTracker
+from tests.test_replay import record_session
+
+
+def decode_png(data: bytes) -> np.ndarray:
+    """The pixels of an 8-bit RGB PNG with no row filters, checking every chunk's CRC."""
+    if data[:8] != b"\x89PNG\r\n\x1a\n":
+        raise ValueError("Not a PNG.")
+    position, chunks = 8, {}
+    while position < len(data):
+        length, = struct.unpack(">I", data[position:position + 4])
+        kind, body = data[position + 4:position + 8], data[position + 8:position + 8 + length]
+        crc, = struct.unpack(">I", data[position + 8 + length:position + 12 + length])
+        if crc != zlib.crc32(kind + body):
+            raise ValueError(f"Bad CRC in {kind}.")
+        chunks[kind] = chunks.get(kind, b"") + body
+        position += 12 + length
+    width, height, depth, colour_type, _, _, _ = struct.unpack(">IIBBBBB", chunks[b"IHDR"])
+    if (depth, colour_type) != (8, 2) or b"IEND" not in chunks:
+        raise ValueError("Not an 8-bit RGB PNG.")
+    rows = np.frombuffer(zlib.decompress(chunks[b"IDAT"]), dtype=np.uint8).reshape(height, width * 3 + 1)
+    if rows[:, 0].any():
+        raise ValueError("Rows are filtered.")
+    return rows[:, 1:].reshape(height, width, 3)
+
+
+def decode_ppm(data: bytes) -> np.ndarray:
+    magic, size, maximum, pixels = data.split(b"\n", 3)
+    width, height = map(int, size.split())
+    if magic != b"P6" or maximum != b"255":
+        raise ValueError("Not a binary PPM.")
+    return np.frombuffer(pixels, dtype=np.uint8).reshape(height, width, 3)
+
+
+class TestImages(unittest.TestCase):
+
+    @number("11.1")
+    def test_encode(self):
+        pixels = np.random.default_rng(1).integers(0, 256, size=(7, 5, 3), dtype=np.uint8)
+        np.testing.assert_array_equal(decode_png(encode_png(pixels)), pixels)
+        np.testing.assert_array_equal(decode_png(encode_png(pixels, level=0)), pixels)
+        np.testing.assert_array_equal(decode_ppm(encode_ppm(pixels)), pixels)
+        self.assertTrue(encode_ppm(pixels).startswith(b"P6\n5 7\n255\n"))
+
+    @number("11.2")
+    def test_render_image(self):
+        grid = Grid(Grid.DRAW_STYLE_SET, 4, 3)
+        grid[1][2].special()
+        frame = grid.render_frame(0, (255, 255, 255)).copy()
+        image = render_image(grid, scale=3)
+        self.assertEqual(image.shape, (9, 12, 3))
+        np.testing.assert_array_equal(image[::3, ::3], frame[::-1]) # the top row is the largest y
+        self.assertEqual(image[0:3, 3:6].tolist(), [[[0, 0, 0]] * 3] * 3)
+        with self.assertRaises(ValueError):
+            render_image(grid, scale=0)
+
+
+class TestRenderSessions(unittest.TestCase):
+
+    @number("11.3")
+    def test_render_sessions(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        session = os.path.join(directory.name, "session.journal")
+        with JournalWriter(session, Grid.DRAW_STYLE_ADD, 10, 8) as writer:
+            grid = Grid(Grid.DRAW_STYLE_ADD, 10, 8)
+            record_session(grid, ReplayTracker(journal=writer), random.Random(1), 30)
+        broken = os.path.join(directory.name, "broken.journal")
+        with open(broken, "wb") as f:
+            f.write(b"not a journal")
+        outside = os.path.join(directory.name, "outside.journal")
+        with JournalWriter(outside, Grid.DRAW_STYLE_ADD, 10, 8) as writer:
+            writer.write(PaintAction([PaintStep((50, 3), get_layers()[1])])) # off the grid, so replaying it fails
+        out = os.path.join(directory.name, "images")
+        results = render_sessions([session, broken, outside], out, workers=2, scale=2)
+        self.assertEqual(results[session], os.path.join(out, "session.png"))
+        self.assertIsInstance(results[broken], ValueError)
+        self.assertIsInstance(results[outside], IndexError)
+        self.assertFalse(os.path.exists(os.path.join(out, "outside.png")))
+        with open(results[session], "rb") as f:
+            np.testing.assert_array_equal(decode_png(f.read()), render_image(grid, scale=2))
@@ -0,0 +1,119 @@
+import os
+import random
+import tempfile
+import unittest
+from ed_utils.decorators import number
+
+from action import PaintAction
+from grid import Grid
+from journal import Journal, JournalWriter
+from layer_util import get_layers
+from replay import ReplayTracker
+from tests.test_replay import record_session, signatures
+
+
+def random_actions(rng: random.Random, count: int) -> list:
+    """Paint, special and undo entries (action, is_undo), as a session records them."""
+    layers = [layer for layer in get_layers() if layer is not None]
+    grid = Grid(Grid.DRAW_STYLE_ADD, 20, 20, storage=Grid.STORAGE_COMPACT)
+    entries = []
+    for _ in range(count):
+        choice = rng.random()
+        if choice < 0.15:
+            entries.append((PaintAction(is_special=True), False))
+        elif choice < 0.3:
+            entries.append((PaintAction(), True))
+        else:
+            layer = rng.choice(layers)
+            grid.brush_size = rng.randrange(Grid.MAX_BRUSH + 1)
+            action = PaintAction()
+            action.add_squares(grid.stamp(layer, rng.randrange(grid.x), rng.randrange(grid.y)), layer)
+            entries.append((action, False))
+    return entries
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "session.journal")
+
+    def write(self, entries: list) -> None:
+        with JournalWriter(self.path, Grid.DRAW_STYLE_ADD, 20, 20) as writer:
+            for action, is_undo in entries:
+                writer.write(action, is_undo)
+
+    def read(self) -> tuple[list, bool]:
+        with Journal(self.path) as journal:
+            return list(journal), journal.is_complete()
+
+    @number("5.1")
+    def test_round_trip(self):
+        entries = random_actions(random.Random(1), 40)
+        self.write(entries)
+        read, complete = self.read()
+        self.assertTrue(complete)
+        self.assertEqual(read, entries)
+        with Journal(self.path) as journal:
+            self.assertEqual((journal.draw_style, journal.x, journal.y), (Grid.DRAW_STYLE_ADD, 20, 20))
+            self.assertEqual(journal[7], entries[7])
+
+    @number("5.2")
+    def test_torn_trailing_record(self):
+        entries = random_actions(random.Random(2), 20)
+        self.write(entries)
+        with open(self.path, "rb") as f:
+            data = f.read()
+        for cut in (1, 4, 6):
+            with self.subTest(cut=cut):
+                with open(self.path, "wb") as f:
+                    f.write(data[:-cut])
+                read, complete = self.read()
+                self.assertFalse(complete)
+                self.assertEqual(read, entries[:-1])
+
+    @number("5.3")
+    def test_corrupt_trailing_record(self):
+        entries = random_actions(random.Random(3), 20)
+        self.write(entries)
+        with open(self.path, "r+b") as f:
+            f.seek(-5, os.SEEK_END) # the last byte of the payload, just before its CRC
+            byte = f.read(1)[0]
+            f.seek(-5, os.SEEK_END)
+            f.write(bytes([byte ^ 0xFF]))
+        read, complete = self.read()
+        self.assertFalse(complete)
+        self.assertEqual(read, entries[:-1])
+
+    @number("5.4")
+    def test_writer_cuts_torn_tail(self):
+        entries = random_actions(random.Random(4), 20)
+        self.write(entries)
+        with open(self.path, "r+b") as f:
+            f.truncate(os.path.getsize(self.path) - 3)
+        more = random_actions(random.Random(5), 5)
+        self.write(more)
+        read, complete = self.read()
+        self.assertTrue(complete)
+        self.assertEqual(read, entries[:-1] + more)
+        with self.assertRaises(ValueError):
+            JournalWriter(self.path, Grid.DRAW_STYLE_SET, 20, 20)
+        with open(self.path, "wb") as f:
+            f.write(b"PJNL")
+        with self.assertRaises(ValueError):
+            Journal(self.path)
+
+    @number("5.5")
+    def test_replay_recovers_session(self):
+        for style in Grid.DRAW_STYLE_OPTIONS:
+            with self.subTest(style=style):
+                with JournalWriter(self.path + style, style, 10, 8) as writer:
+                    states = record_session(Grid(style, 10, 8), ReplayTracker(journal=writer), random.Random(6), 50)
+                with open(self.path + style, "ab") as f:
+                    f.write(b"\x05\x00") # a record torn by a crash
+                with Journal(self.path + style) as journal:
+                    self.assertFalse(journal.is_complete())
+                    grid = Grid(style, 10, 8)
+                    ReplayTracker.from_journal(journal).skip_to_end(grid)
+                self.assertEqual(signatures(grid), states[-1])
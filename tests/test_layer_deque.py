@@ -0,0 +1,70 @@
+import random
+import unittest
+from collections import deque
+from ed_utils.decorators import number
+
+from layer_deque import LayerDeque
+
+
+class TestLayerDeque(unittest.TestCase):
+
+    def assertSameItems(self, layer_deque: LayerDeque, expected: deque) -> None:
+        self.assertEqual(len(layer_deque), len(expected))
+        self.assertEqual(list(layer_deque), list(expected))
+        self.assertEqual([layer_deque[i] for i in range(len(layer_deque))], list(expected))
+
+    @number("9.1")
+    def test_wraparound_and_growth(self):
+        layer_deque, expected = LayerDeque(), deque()
+        self.assertIsNone(layer_deque.array)
+        for item in range(3):
+            layer_deque.append(item)
+            expected.append(item)
+        for _ in range(2):
+            self.assertEqual(layer_deque.serve(), expected.popleft())
+        # The front is now part way along the array, so these wrap around its end before it grows.
+        for item in range(3, 12):
+            layer_deque.append(item)
+            expected.append(item)
+            self.assertSameItems(layer_deque, expected)
+        self.assertEqual(len(layer_deque.array), 16)
+
+    @number("9.2")
+    def test_reverse(self):
+        layer_deque, expected = LayerDeque(), deque()
+        for item in range(5):
+            layer_deque.append(item)
+            expected.append(item)
+        layer_deque.reverse()
+        expected.reverse()
+        self.assertSameItems(layer_deque, expected)
+        for item in range(5, 9):
+            layer_deque.append(item) # appended at the physical front, so the array has to grow while reversed
+            expected.append(item)
+        self.assertEqual(layer_deque.serve(), expected.popleft())
+        self.assertSameItems(layer_deque, expected)
+        layer_deque.reverse()
+        expected.reverse()
+        self.assertSameItems(layer_deque, expected)
+
+    @number("9.3")
+    def test_matches_deque(self):
+        rng = random.Random(10)
+        layer_deque, expected = LayerDeque(), deque()
+        for item in range(2000):
+            choice = rng.random()
+            if choice < 0.5:
+                layer_deque.append(item)
+                expected.append(item)
+            elif choice < 0.85:
+                if expected:
+                    self.assertEqual(layer_deque.serve(), expected.popleft())
+                else:
+                    with self.assertRaises(IndexError):
+                        layer_deque.serve()
+            else:
+                layer_deque.reverse()
+                expected.reverse()
+            self.assertSameItems(layer_deque, expected)
+        with self.assertRaises(IndexError):
+            layer_deque[len(expected)]
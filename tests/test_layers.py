@@ -0,0 +1,194 @@
+import random
+import unittest
+from unittest import mock
+from ed_utils.decorators import number
+
+import numpy as np
+from grid import Grid
+from layer_util import get_layers
+from layers import SparkleNoise
+from stack_compiler import compile_stack
+
+BACKGROUND = (255, 255, 255)
+
+
+def all_layers() -> list:
+    return [layer for layer in get_layers() if layer is not None]
+
+
+class TestLayerProperties(unittest.TestCase):
+
+    @number("2.1")
+    def test_declared_invariants_hold(self):
+        rng = random.Random(1)
+        for layer in all_layers():
+            with self.subTest(layer=layer.name):
+                for _ in range(50):
+                    colour = tuple(rng.randrange(256) for _ in range(3))
+                    x, y, t = rng.randrange(500), rng.randrange(500), rng.uniform(0, 100)
+                    result = layer.apply(colour, t, x, y)
+                    if layer.time_invariant:
+                        self.assertEqual(layer.apply(colour, t + rng.uniform(1, 50), x, y), result)
+                    if layer.position_invariant:
+                        self.assertEqual(layer.apply(colour, t, rng.randrange(500), rng.randrange(500)), result)
+                    if layer.color_invariant:
+                        self.assertEqual(layer.apply(tuple(rng.randrange(256) for _ in range(3)), t, x, y), result)
+                    if layer.channelwise:
+                        single = [layer.apply((c, c, c), t, x, y)[0] for c in colour]
+                        self.assertEqual(tuple(result), tuple(single))
+                self.assertEqual(layer.pure_in_color, layer.time_invariant and layer.position_invariant)
+
+
+class TestApplyBatch(unittest.TestCase):
+
+    @number("2.4")
+    def test_matches_apply(self):
+        rng = np.random.default_rng(2)
+        colours = rng.integers(0, 256, (400, 3))
+        xs, ys = rng.integers(0, 3000, 400), rng.integers(0, 3000, 400)
+        for layer in all_layers():
+            for timestamp in (0, 0.25, 13.5):
+                with self.subTest(layer=layer.name, timestamp=timestamp):
+                    expected = [
+                        layer.apply(tuple(int(c) for c in colour), timestamp, int(x), int(y))
+                        for colour, x, y in zip(colours, xs, ys)
+                    ]
+                    batch = layer.apply_batch(colours.copy(), timestamp, xs, ys)
+                    self.assertEqual(batch.shape, (400, 3))
+                    self.assertEqual([tuple(row) for row in batch.tolist()], [tuple(c) for c in expected])
+
+
+class TestSparkleNoise(unittest.TestCase):
+
+    @number("2.5")
+    def test_matches_lcg(self):
+        noise = SparkleNoise()
+        xs, ys = np.meshgrid(np.arange(0, 300, 7), np.arange(0, 200, 5), indexing="ij")
+        xs, ys = xs.ravel(), ys.ravel()
+        for ts in (0, 1, 5, 16):
+            expected = [SparkleNoise.compute(x, y, ts * 31 % SparkleNoise.PHASES) for x, y in zip(xs.tolist(), ys.tolist())]
+            batch = noise.is_bright_batch(xs, ys, np.full(len(xs), ts))
+            self.assertEqual(batch.tolist(), expected)
+            misses = noise.misses
+            self.assertEqual([noise.is_bright(x, y, ts) for x, y in zip(xs.tolist(), ys.tolist())], expected)
+            self.assertEqual(noise.misses, misses) # every decision was cached by the batch
+
+    @number("2.6")
+    def test_memory_follows_drawn_squares(self):
+        noise = SparkleNoise(max_tiles=4)
+        far = 10**7
+        self.assertEqual(noise.is_bright(far, far, 3), SparkleNoise.compute(far, far, 3 * 31 % SparkleNoise.PHASES))
+        self.assertEqual(len(noise.tiles), 1)
+        xs = np.arange(0, 10 * SparkleNoise.TILE, SparkleNoise.TILE)
+        noise.is_bright_batch(xs, np.zeros(len(xs), dtype=np.int64), np.zeros(len(xs), dtype=np.int64))
+        self.assertEqual(len(noise.tiles), 4) # the least recently used tiles were dropped
+        misses = noise.misses
+        self.assertEqual(noise.is_bright(int(xs[-1]), 0, 0), SparkleNoise.compute(int(xs[-1]), 0, 0))
+        self.assertEqual(noise.misses, misses)
+        self.assertEqual(noise.is_bright(0, 0, 0), SparkleNoise.compute(0, 0, 0)) # dropped, so worked out again
+        self.assertEqual(noise.misses, misses + 1)
+
+
+class TestStackCompiler(unittest.TestCase):
+
+    @number("2.7")
+    def test_matches_applying_each_layer(self):
+        rng = random.Random(3)
+        layers = all_layers()
+        xs, ys = np.arange(0, 60, 3), np.arange(0, 100, 5)
+        for depth in (0, 1, 2, 3, 5, 30):
+            for _ in range(20):
+                stack = tuple(rng.choice(layers).index for _ in range(depth))
+                with self.subTest(stack=stack):
+                    compiled = compile_stack(stack)
+                    start = tuple(rng.randrange(256) for _ in range(3))
+                    for t in (0, 0.4, 2.9):
+                        colours = np.empty((len(xs), 3), dtype=np.int64)
+                        colours[:] = start
+                        for x, y, batch in zip(xs.tolist(), ys.tolist(), compiled.apply_batch(colours, t, xs, ys).tolist()):
+                            colour = start
+                            for index in stack:
+                                colour = get_layers()[index].apply(colour, t, x, y)
+                            self.assertEqual(tuple(compiled.apply(start, t, x, y)), tuple(colour))
+                            self.assertEqual(tuple(batch), tuple(colour))
+
+    @number("2.8")
+    def test_fuses_and_shares_stacks(self):
+        names = {layer.name: layer.index for layer in all_layers()}
+        self.assertEqual(compile_stack((names["invert"], names["invert"])).steps, [])
+        self.assertEqual(len(compile_stack((names["lighten"],) * 100).steps), 1)
+        red_then_lighten = compile_stack((names["lighten"], names["red"], names["lighten"]))
+        self.assertEqual(red_then_lighten.steps, [])
+        self.assertEqual(red_then_lighten.apply((1, 2, 3), 0, 0, 0), get_layers()[names["lighten"]].apply(
+            get_layers()[names["red"]].apply((1, 2, 3), 0, 0, 0), 0, 0, 0))
+        self.assertIs(compile_stack((names["sparkle"], names["darken"])), compile_stack((names["sparkle"], names["darken"])))
+
+
+class TestColourMemo(unittest.TestCase):
+
+    @number("2.2")
+    def test_memo_reused_until_the_store_changes(self):
+        black, lighten = get_layers()[1], get_layers()[2]
+        for style in Grid.DRAW_STYLE_OPTIONS:
+            with self.subTest(style=style):
+                store = Grid(style, 1, 1)[0][0]
+                store.add(lighten)
+                compiled = store.compiled()
+                # SET applies its single layer directly, the others go through the compiled stack.
+                target = lighten if style == Grid.DRAW_STYLE_SET else compiled
+                with mock.patch.object(target, "apply", wraps=target.apply) as apply:
+                    colour = store.get_color(BACKGROUND, 0, 0, 0)
+                    self.assertEqual(store.get_color(BACKGROUND, 5, 0, 0), colour) # time invariant
+                    self.assertEqual(apply.call_count, 1)
+                    store.get_color((10, 20, 30), 5, 0, 0)
+                    self.assertEqual(apply.call_count, 2)
+                store.add(black)
+                self.assertEqual(store.get_color(BACKGROUND, 0, 0, 0), fresh_colour(style, [lighten, black]))
+                store.erase(black)
+                layers = store.applied_layers()
+                self.assertEqual(store.get_color(BACKGROUND, 0, 0, 0), fresh_colour(style, layers))
+                store.special()
+                self.assertEqual(store.get_color(BACKGROUND, 0, 0, 0), fresh_colour(style, layers, special=True))
+
+    @number("2.3")
+    def test_time_varying_layers_are_not_memoised_across_frames(self):
+        rainbow = get_layers()[0]
+        for style in Grid.DRAW_STYLE_OPTIONS:
+            with self.subTest(style=style):
+                store = Grid(style, 1, 1)[0][0]
+                store.add(rainbow)
+                for t in (0, 0.3, 1.7, 0.3):
+                    self.assertEqual(store.get_color(BACKGROUND, t, 3, 4), rainbow.apply(BACKGROUND, t, 3, 4))
+
+    @number("2.9")
+    def test_set_signature_clears_the_memo(self):
+        rng = random.Random(14)
+        layers = [layer for layer in all_layers() if layer.time_invariant]
+        for storage in Grid.STORAGE_CLASSES:
+            for style in Grid.DRAW_STYLE_OPTIONS:
+                with self.subTest(storage=storage, style=style):
+                    grid = Grid(style, 2, 1, storage=storage)
+                    self.addCleanup(grid.close)
+                    source = Grid(style, 1, 1)[0][0]
+                    for _ in range(10):
+                        source.add(rng.choice(layers))
+                        if rng.random() < 0.3:
+                            source.special()
+                        store = grid[0][0]
+                        store.get_color(BACKGROUND, 0, 0, 0) # memoise the colour before the change
+                        grid.render_frame(0, BACKGROUND)
+                        store.set_signature(source.signature())
+                        expected = source.get_color(BACKGROUND, 0, 0, 0)
+                        self.assertEqual(grid[0][0].signature(), source.signature())
+                        self.assertEqual(grid[0][0].get_color(BACKGROUND, 0, 0, 0), expected)
+                        self.assertEqual(tuple(grid.render_frame(0, BACKGROUND)[0, 0]), expected)
+
+
+def fresh_colour(style: str, layers: list, special: bool = False) -> tuple:
+    """The colour of a new square of the style holding the layers."""
+    store = Grid(style, 1, 1)[0][0]
+    for layer in layers:
+        store.add(layer)
+    if special:
+        store.special()
+    return store.get_color(BACKGROUND, 0, 0, 0)
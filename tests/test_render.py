@@ -0,0 +1,213 @@
+import random
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+from ed_utils.decorators import number
+
+import numpy as np
+from grid import Grid, GridState
+from layer_util import get_layers
+from parallel_render import BandRenderer
+
+try:
+    import renderer
+except ImportError: # arcade isn't installed
+    renderer = None
+
+BACKGROUND = (255, 255, 255)
+
+
+def paint_randomly(grid: Grid, rng: random.Random, count: int = 60) -> None:
+    """Adds random layers to random squares, with a special on some of them now and then."""
+    layers = [layer for layer in get_layers() if layer is not None]
+    for k in range(count):
+        x, y = rng.randrange(grid.x), rng.randrange(grid.y)
+        grid[x][y].add(rng.choice(layers))
+        if k % 7 == 6:
+            grid[x][y].special()
+
+
+def colours_of(grid: Grid, timestamp, viewport=None) -> np.ndarray:
+    """The frame render_frame should return, from get_color on every square."""
+    x0, y0, x1, y1 = (0, 0, grid.x, grid.y) if viewport is None else viewport
+    frame = np.empty((y1 - y0, x1 - x0, 3), dtype=np.uint8)
+    for x in range(x0, x1):
+        for y in range(y0, y1):
+            frame[y - y0, x - x0] = grid[x][y].get_color(BACKGROUND, timestamp, x, y)
+    return frame
+
+
+class TestRenderFrame(unittest.TestCase):
+
+    def grids(self):
+        """One grid of every draw style on every storage."""
+        for storage in Grid.STORAGE_CLASSES:
+            for style in Grid.DRAW_STYLE_OPTIONS:
+                grid = Grid(style, 13, 9, storage=storage)
+                self.addCleanup(grid.close)
+                yield grid
+
+    @number("1.1")
+    def test_matches_get_color(self):
+        for grid in self.grids():
+            with self.subTest(style=grid.draw_style, storage=grid.storage):
+                paint_randomly(grid, random.Random(1))
+                for timestamp in (0, 0.5, 7.25):
+                    np.testing.assert_array_equal(grid.render_frame(timestamp, BACKGROUND), colours_of(grid, timestamp))
+
+    @number("1.4")
+    def test_only_changed_squares_are_recomputed(self):
+        layers = get_layers()
+        for grid in self.grids():
+            with self.subTest(style=grid.draw_style, storage=grid.storage):
+                grid.render_frame(0, BACKGROUND)
+                self.assertEqual(grid.recomputed_cells, grid.x * grid.y)
+                grid.render_frame(0, BACKGROUND)
+                self.assertEqual(grid.recomputed_cells, 0)
+                grid[2][4].add(layers[1])
+                grid[3][4].add(layers[1])
+                frame = grid.render_frame(0, BACKGROUND)
+                self.assertEqual(grid.recomputed_cells, 2)
+                np.testing.assert_array_equal(frame, colours_of(grid, 0))
+                grid[5][5].add(layers[0]) # rainbow changes with time, so it is evaluated every frame
+                grid.render_frame(1, BACKGROUND)
+                self.assertEqual(grid.recomputed_cells, 1)
+                np.testing.assert_array_equal(grid.render_frame(2, BACKGROUND), colours_of(grid, 2))
+                self.assertEqual(grid.recomputed_cells, 1)
+                paint_randomly(grid, random.Random(4))
+                np.testing.assert_array_equal(grid.render_frame(3, BACKGROUND), colours_of(grid, 3))
+
+    @number("1.7")
+    def test_viewport(self):
+        viewport = (3, 2, 11, 7)
+        for grid in self.grids():
+            with self.subTest(style=grid.draw_style, storage=grid.storage):
+                paint_randomly(grid, random.Random(3))
+                frame = grid.render_frame(2, BACKGROUND, viewport)
+                self.assertEqual(frame.shape, (5, 8, 3))
+                np.testing.assert_array_equal(frame, colours_of(grid, 2, viewport))
+                grid.add_many(get_layers()[1], np.array([2, 4, 10]), np.array([4, 4, 8]))
+                np.testing.assert_array_equal(grid.render_frame(2, BACKGROUND, viewport), colours_of(grid, 2, viewport))
+                self.assertLessEqual(grid.recomputed_cells, 1 + int(np.count_nonzero(grid.animated)))
+
+
+class TestDirtySquares(unittest.TestCase):
+
+    @number("1.6")
+    def test_distinct_and_bounded(self):
+        state = GridState(7)
+        self.assertFalse(state.has_dirty())
+        xs, ys = np.array([1, 2, 2, 0]), np.array([6, 0, 0, 3])
+        for _ in range(GridState.COMPACT_AFTER // 2):
+            state.mark_dirty_many(xs, ys)
+            state.mark_dirty((4, 5))
+        self.assertTrue(state.has_dirty())
+        self.assertLessEqual(state.dirty_count, 2 * GridState.COMPACT_AFTER) # repeats are merged as they pile up
+        dirty_xs, dirty_ys = state.dirty_squares()
+        self.assertEqual(sorted(zip(dirty_xs.tolist(), dirty_ys.tolist())), [(0, 3), (1, 6), (2, 0), (4, 5)])
+        state.mark_all_dirty()
+        state.mark_dirty((3, 3)) # already covered by all_dirty
+        self.assertFalse(state.has_dirty())
+        state.clear()
+        self.assertFalse(state.all_dirty)
+        self.assertEqual(len(state.dirty_squares()[0]), 0)
+
+
+class TestBandRenderer(unittest.TestCase):
+
+    @number("1.5")
+    def test_matches_render_frame(self):
+        for storage in (Grid.STORAGE_DENSE, Grid.STORAGE_COMPACT):
+            for style in Grid.DRAW_STYLE_OPTIONS:
+                with self.subTest(storage=storage, style=style):
+                    grid, reference = Grid(style, 13, 9, storage=storage), Grid(style, 13, 9, storage=storage)
+                    with BandRenderer(grid, workers=2, bands=3) as bands:
+                        for k, timestamp in enumerate((0, 0.5, 0.5, 2.25, 3)):
+                            if k == 1:
+                                for target in (grid, reference):
+                                    paint_randomly(target, random.Random(5))
+                            elif k == 2:
+                                grid.special() # a grid-wide special between frames
+                                reference.special()
+                            elif k == 3:
+                                for target in (grid, reference):
+                                    target[4][2].add(get_layers()[1])
+                                    target[4][2].special()
+                            background = (10, 20, 30) if k == 4 else BACKGROUND
+                            np.testing.assert_array_equal(
+                                bands.render_frame(timestamp, background), reference.render_frame(timestamp, background),
+                            )
+
+
+class FakeContext:
+    """Records what a renderer does with the window's GL context."""
+    NEAREST = "NEAREST"
+
+    def texture(self, size, components, filter):
+        self.size = size
+        return SimpleNamespace(write=self.write, use=lambda unit: None)
+
+    def write(self, data: bytes) -> None:
+        self.written = data
+
+    def program(self, vertex_shader, fragment_shader):
+        return None
+
+
+@unittest.skipIf(renderer is None, "the canvas renderers need arcade")
+class TestCanvasRenderers(unittest.TestCase):
+
+    def window(self):
+        return SimpleNamespace(width=700, height=500, ctx=FakeContext())
+
+    @number("1.2")
+    def test_texture_holds_every_square(self):
+        for style in Grid.DRAW_STYLE_OPTIONS:
+            with self.subTest(style=style):
+                grid = Grid(style, 13, 9)
+                paint_randomly(grid, random.Random(2))
+                window = self.window()
+                with mock.patch.object(renderer.geometry, "quad_2d") as quad_2d:
+                    canvas = renderer.make_renderer(renderer.RENDER_BACKEND_TEXTURE, window, 13, 9, 400, 500)
+                    canvas.draw(grid, 1.5, BACKGROUND)
+                self.assertIsInstance(canvas, renderer.TextureRenderer)
+                self.assertEqual(window.ctx.size, (13, 9))
+                quad_2d.return_value.render.assert_called_once()
+                pixels = np.frombuffer(window.ctx.written, dtype=np.uint8).reshape(9, 13, 4)
+                np.testing.assert_array_equal(pixels[:, :, :3], colours_of(grid, 1.5))
+                self.assertTrue((pixels[:, :, 3] == 255).all())
+
+    @number("1.3")
+    def test_rectangles_draw_every_square(self):
+        grid = Grid(Grid.DRAW_STYLE_ADD, 13, 9)
+        paint_randomly(grid, random.Random(3))
+        canvas = renderer.make_renderer(renderer.RENDER_BACKEND_RECTANGLES, self.window(), 13, 9, 390, 450)
+        with mock.patch.object(renderer.arcade, "draw_lrtb_rectangle_filled") as draw:
+            canvas.draw(grid, 0, BACKGROUND)
+        self.assertEqual(draw.call_count, 13 * 9)
+        expected = colours_of(grid, 0)
+        for (left, right, top, bottom, colour), _ in draw.call_args_list:
+            x, y = round(left / 30), round(bottom / 50)
+            self.assertEqual((right - left, top - bottom), (30, 50))
+            self.assertEqual(tuple(colour), tuple(expected[y, x]))
+
+    @number("1.8")
+    def test_renderers_draw_only_the_viewport(self):
+        grid = Grid(Grid.DRAW_STYLE_ADD, 13, 9)
+        paint_randomly(grid, random.Random(6))
+        viewport = (4, 3, 9, 7)
+        expected = colours_of(grid, 0.5, viewport)
+        window = self.window()
+        with mock.patch.object(renderer.geometry, "quad_2d"):
+            canvas = renderer.make_renderer(renderer.RENDER_BACKEND_TEXTURE, window, 5, 4, 400, 500)
+            canvas.draw(grid, 0.5, BACKGROUND, viewport)
+        self.assertEqual(window.ctx.size, (5, 4))
+        pixels = np.frombuffer(window.ctx.written, dtype=np.uint8).reshape(4, 5, 4)
+        np.testing.assert_array_equal(pixels[:, :, :3], expected)
+        canvas = renderer.make_renderer(renderer.RENDER_BACKEND_RECTANGLES, self.window(), 5, 4, 400, 500)
+        with mock.patch.object(renderer.arcade, "draw_lrtb_rectangle_filled") as draw:
+            canvas.draw(grid, 0.5, BACKGROUND, viewport)
+        self.assertEqual(draw.call_count, 5 * 4)
+        for (left, right, top, bottom, colour), _ in draw.call_args_list:
+            x, y = round(left / 80), round(bottom / 125)
+            self.assertEqual(tuple(colour), tuple(expected[y, x]))
@@ -0,0 +1,111 @@
+import math
+import random
+import unittest
+from ed_utils.decorators import number
+
+from action import PaintAction
+from grid import Grid
+from layer_util import get_layers
+from replay import ReplayTracker
+from undo import UndoTracker
+
+
+def signatures(grid: Grid) -> list:
+    return [[grid[x][y].signature() for y in range(grid.y)] for x in range(grid.x)]
+
+
+def record_session(grid: Grid, replay: ReplayTracker, rng: random.Random, steps: int) -> list:
+    """
+    Paints, undoes, redoes and specials as main.py does, recording every step in the replay.
+    Returns the grid's signatures before the first step and after each one.
+    """
+    layers = [layer for layer in get_layers() if layer is not None]
+    undo = UndoTracker(grid)
+    states = [signatures(grid)]
+    for _ in range(steps):
+        choice = rng.random()
+        if choice < 0.2:
+            action = undo.undo(grid)
+            if action is None:
+                continue
+            replay.add_action(action, is_undo=True)
+        elif choice < 0.3:
+            action = undo.redo(grid)
+            if action is None:
+                continue
+            replay.add_action(action)
+        else:
+            if choice < 0.4:
+                grid.special()
+                action = PaintAction([], is_special=True)
+            else:
+                layer = rng.choice(layers)
+                grid.brush_size = rng.randrange(Grid.MAX_BRUSH + 1)
+                action = PaintAction()
+                action.add_squares(grid.stamp(layer, rng.randrange(grid.x), rng.randrange(grid.y)), layer)
+            undo.add_action(action)
+            replay.add_action(action)
+        states.append(signatures(grid))
+    return states
+
+
+class TestReplay(unittest.TestCase):
+
+    @number("8.1")
+    def test_seek_matches_session(self):
+        for storage in Grid.STORAGE_CLASSES:
+            for style in Grid.DRAW_STYLE_OPTIONS:
+                with self.subTest(style=style, storage=storage):
+                    replay = ReplayTracker(snapshot_interval=4)
+                    states = record_session(Grid(style, 10, 8), replay, random.Random(1), 50)
+                    grid = Grid(style, 10, 8, storage=storage)
+                    self.addCleanup(grid.close)
+                    replay.start_replay()
+                    for step in range(1, len(states)):
+                        self.assertFalse(replay.play_next_action(grid))
+                        self.assertEqual(signatures(grid), states[step], step)
+                    self.assertTrue(replay.play_next_action(grid))
+                    for step in random.Random(2).sample(range(len(states)), 20):
+                        replay.seek(grid, step)
+                        self.assertEqual(signatures(grid), states[step], step)
+
+    @number("8.2")
+    def test_replay_all(self):
+        background = (255, 255, 255)
+        for style in Grid.DRAW_STYLE_OPTIONS:
+            with self.subTest(style=style):
+                replay = ReplayTracker()
+                states = record_session(Grid(style, 10, 8), replay, random.Random(3), 40)
+                grid = Grid(style, 10, 8)
+                frames = replay.replay_all(grid, frames=[20, 0, 7], background=background)
+                self.assertIsNone(replay.undos) # played once, without building the timeline
+                self.assertEqual(signatures(grid), states[-1])
+                self.assertTrue(replay.play_next_action(grid))
+                self.assertEqual(sorted(frames), [0, 7, 20])
+                reference = Grid(style, 10, 8)
+                replay.start_replay()
+                for step in sorted(frames):
+                    replay.seek(reference, step)
+                    self.assertEqual(signatures(reference), states[step])
+                    self.assertEqual(frames[step].tolist(), reference.render_frame(0, background).tolist())
+                with self.assertRaises(ValueError):
+                    replay.replay_all(Grid(style, 10, 8), frames=[len(replay) + 1])
+
+    @number("8.3")
+    def test_play_actions(self):
+        for style in Grid.DRAW_STYLE_OPTIONS:
+            with self.subTest(style=style):
+                replay = ReplayTracker(snapshot_interval=4)
+                states = record_session(Grid(style, 10, 8), replay, random.Random(4), 40)
+                grid = Grid(style, 10, 8)
+                replay.start_replay()
+                step = 0
+                for n in (1, 3, 9, 2, 20):
+                    self.assertEqual(replay.play_actions(grid, n), step + n >= len(states) - 1)
+                    step = min(step + n, len(states) - 1)
+                    self.assertEqual(signatures(grid), states[step])
+                self.assertTrue(replay.play_actions(grid, math.inf))
+                self.assertEqual(signatures(grid), states[-1])
+                replay.start_replay()
+                replay.skip_to_end(grid)
+                self.assertEqual(signatures(grid), states[-1])
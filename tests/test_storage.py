@@ -0,0 +1,259 @@
+import os
+import random
+import tempfile
+import unittest
+from ed_utils.decorators import number
+
+import numpy as np
+from grid import Grid
+from layer_util import get_layers
+
+STORAGES = (Grid.STORAGE_COMPACT, Grid.STORAGE_SPARSE, Grid.STORAGE_TILED)
+
+
+def paint_all(grids: list[Grid], rng: random.Random, steps: int = 60) -> None:
+    """Applies the same random single square changes and specials to every grid."""
+    layers = [layer for layer in get_layers() if layer is not None]
+    width, height = grids[0].x, grids[0].y
+    for _ in range(steps):
+        choice = rng.random()
+        layer = rng.choice(layers)
+        if choice < 0.9:
+            x, y, add = rng.randrange(width), rng.randrange(height), rng.random() < 0.6
+            for grid in grids:
+                grid[x][y].add(layer) if add else grid[x][y].erase(layer)
+        else:
+            for grid in grids:
+                grid.special()
+
+
+def signatures(grid: Grid) -> list:
+    return [[grid[x][y].signature() for y in range(grid.y)] for x in range(grid.x)]
+
+
+class TestStorage(unittest.TestCase):
+
+    def grids(self, style: str, x: int = 21, y: int = 17) -> list[Grid]:
+        """A DENSE grid, then one on every other storage."""
+        grids = [Grid(style, x, y, storage=storage) for storage in (Grid.STORAGE_DENSE,) + STORAGES]
+        for grid in grids:
+            self.addCleanup(grid.close)
+        return grids
+
+    @number("3.1")
+    def test_same_signatures_as_dense(self):
+        for style in Grid.DRAW_STYLE_OPTIONS:
+            for seed in range(3):
+                with self.subTest(style=style, seed=seed):
+                    grids = self.grids(style)
+                    paint_all(grids, random.Random(seed))
+                    expected = signatures(grids[0])
+                    for grid in grids[1:]:
+                        self.assertEqual(signatures(grid), expected, grid.storage)
+                        for timestamp in (0, 0.6):
+                            np.testing.assert_array_equal(
+                                grid.render_frame(timestamp, (20, 40, 60)), grids[0].render_frame(timestamp, (20, 40, 60)),
+                            )
+
+    @number("3.2")
+    def test_group_cells(self):
+        for style in Grid.DRAW_STYLE_OPTIONS:
+            with self.subTest(style=style):
+                grids = self.grids(style)
+                paint_all(grids, random.Random(4))
+                xs, ys = np.indices((grids[0].x, grids[0].y)).reshape(2, -1)
+                for grid in grids:
+                    groups = grid.grid.group_cells(xs, ys)
+                    self.assertEqual(sum(len(gx) for gx, _ in groups.values()), len(xs), grid.storage)
+                    for signature, (gx, gy) in groups.items():
+                        for x, y in zip(gx.tolist(), gy.tolist()):
+                            self.assertEqual(grids[0][x][y].signature(), signature, grid.storage)
+
+    @number("3.3")
+    def test_compact_index_errors(self):
+        grid = Grid(Grid.DRAW_STYLE_SET, 4, 3, storage=Grid.STORAGE_COMPACT)
+        for index in (-1, 4):
+            with self.assertRaises(IndexError):
+                grid[index]
+        with self.assertRaises(IndexError):
+            grid[0][3]
+
+    @number("3.4")
+    def test_sparse_allocates_written_chunks_only(self):
+        grid = Grid(Grid.DRAW_STYLE_ADD, 1000, 1000, storage=Grid.STORAGE_SPARSE)
+        self.assertEqual(grid[999][999].get_color((1, 2, 3), 0, 999, 999), (1, 2, 3))
+        self.assertEqual(len(grid.grid.chunks), 0)
+        grid[500][500].add(get_layers()[0])
+        grid[510][505].add(get_layers()[1])
+        self.assertEqual(len(grid.grid.chunks), 1)
+        grid.special()
+        self.assertEqual(len(grid.grid.chunks), 1)
+
+    @number("3.5")
+    def test_tiled_reopen(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "canvas.tiles")
+        dense = Grid(Grid.DRAW_STYLE_ADD, 40, 30)
+        tiled = Grid(Grid.DRAW_STYLE_ADD, 40, 30, storage=Grid.STORAGE_TILED, path=path, tile=16, max_tiles=2)
+        paint_all([dense, tiled], random.Random(6))
+        self.assertLessEqual(len(tiled.grid.mapped), 2)
+        tiled.close()
+        reopened = Grid(Grid.DRAW_STYLE_ADD, 40, 30, storage=Grid.STORAGE_TILED, path=path, tile=16)
+        self.assertEqual(signatures(reopened), signatures(dense))
+        reopened.close()
+        for style, x, y, tile in ((Grid.DRAW_STYLE_SET, 40, 30, 16), (Grid.DRAW_STYLE_ADD, 30, 40, 16),
+                                  (Grid.DRAW_STYLE_ADD, 40, 30, 8)):
+            with self.assertRaises(ValueError):
+                Grid(style, x, y, storage=Grid.STORAGE_TILED, path=path, tile=tile)
+
+    @number("3.6")
+    def test_viewport(self):
+        for style in Grid.DRAW_STYLE_OPTIONS:
+            with self.subTest(style=style):
+                grids = self.grids(style)
+                paint_all(grids, random.Random(8))
+                whole = grids[0].render_frame(0.5, (9, 8, 7)).copy()
+                for grid in grids:
+                    frame = grid.render_frame(0.5, (9, 8, 7), (3, 2, 15, 11))
+                    np.testing.assert_array_equal(frame, whole[2:11, 3:15], grid.storage)
+
+    @number("3.7")
+    def test_compact_sequence_special(self):
+        layers = [layer for layer in get_layers() if layer is not None]
+        dense = Grid(Grid.DRAW_STYLE_SEQUENCE, 6, 5)
+        compact = Grid(Grid.DRAW_STYLE_SEQUENCE, 6, 5, storage=Grid.STORAGE_COMPACT)
+        rng = random.Random(9)
+        for x in range(6):
+            for y in range(5):
+                for layer in rng.sample(layers, rng.randrange(len(layers) + 1)):
+                    dense[x][y].add(layer)
+                    compact[x][y].add(layer)
+        for _ in range(3):
+            dense.special()
+            compact.special()
+            self.assertEqual(signatures(compact), signatures(dense))
+        self.assertEqual(compact.grid.masks.dtype, np.uint32)
+
+    @number("3.8")
+    def test_compact_add_shares_stacks(self):
+        layers = [layer for layer in get_layers() if layer is not None]
+        grid = Grid(Grid.DRAW_STYLE_ADD, 8, 8, storage=Grid.STORAGE_COMPACT)
+        for x in range(8):
+            for y in range(8):
+                for layer in layers[:3]:
+                    grid[x][y].add(layer)
+        self.assertEqual(len(np.unique(grid.grid.stack_ids)), 1)
+        node = grid[0][0].node
+        self.assertIs(grid[7][7].node, node)
+        self.assertEqual(node.layers, tuple(layer.index for layer in layers[:3]))
+        self.assertIs(node.reversed().reversed(), node)
+        self.assertIs(node.push(layers[4].index), grid.grid.table.intern(node.layers + (layers[4].index,)))
+        grid.special()
+        self.assertIs(grid[3][4].node, node.reversed())
+        grid[3][4].erase(layers[0])
+        self.assertEqual(grid[3][4].node.layers, node.reversed().layers[1:])
+        self.assertIs(grid[3][5].node, node.reversed())
+
+    @number("3.9")
+    def test_lazy_special_matches_eager(self):
+        layers = [layer for layer in get_layers() if layer is not None]
+        for style in Grid.DRAW_STYLE_OPTIONS:
+            with self.subTest(style=style):
+                eager = Grid(style, 12, 10)
+                grids = self.grids(style, 12, 10)
+                rng = random.Random(7)
+                for k in range(40):
+                    x, y, layer = rng.randrange(12), rng.randrange(10), rng.choice(layers)
+                    for grid in [eager] + grids:
+                        grid[x][y].add(layer)
+                    if k % 6 == 5:
+                        for grid in grids:
+                            grid.special() # counted, and applied when the squares are next used
+                        for i in range(eager.x):
+                            for j in range(eager.y):
+                                eager[i][j].special()
+                for grid in grids:
+                    self.assertEqual(signatures(grid), signatures(eager), grid.storage)
+
+    @number("3.10")
+    def test_set_signatures(self):
+        for style in Grid.DRAW_STYLE_OPTIONS:
+            with self.subTest(style=style):
+                source = Grid(style, 21, 17)
+                paint_all([source], random.Random(10))
+                table = sorted({signature for column in signatures(source) for signature in column})
+                for grid in self.grids(style):
+                    paint_all([grid], random.Random(11))
+                    grid.special()
+                    xs, ys = np.indices((grid.x, grid.y)).reshape(2, -1)
+                    ids = np.array([table.index(source[x][y].signature()) for x, y in zip(xs.tolist(), ys.tolist())])
+                    before = signatures(grid)
+                    changed = grid.set_signatures(table, ids, xs, ys)
+                    self.assertEqual(signatures(grid), signatures(source), grid.storage)
+                    self.assertEqual(changed, sum(
+                        before[x][y] != source[x][y].signature() for x, y in zip(xs.tolist(), ys.tolist())
+                    ), grid.storage)
+                    self.assertEqual(grid.set_signatures(table, ids, xs, ys), 0, grid.storage)
+                    grid[4][3].set_signature(table[0])
+                    self.assertEqual(grid[4][3].signature(), table[0], grid.storage)
+
+    @number("3.11")
+    def test_written_squares_and_snapshot(self):
+        for style in Grid.DRAW_STYLE_OPTIONS:
+            with self.subTest(style=style):
+                grids = self.grids(style)
+                paint_all(grids, random.Random(5))
+                keys = np.arange(grids[0].x * grids[0].y)
+                for grid in grids:
+                    written = set(grid.written_keys().tolist())
+                    for x in range(grid.x):
+                        for y in range(grid.y):
+                            if grid[x][y].signature() != grid.empty_signature():
+                                self.assertIn(x * grid.y + y, written, grid.storage)
+                    snapshot = grid.snapshot()
+                    self.assertEqual(
+                        snapshot.signatures_of(keys), [grid[k // grid.y][k % grid.y].signature() for k in keys.tolist()],
+                        grid.storage,
+                    )
+
+    @number("3.12")
+    def test_restore_snapshot(self):
+        for style in Grid.DRAW_STYLE_OPTIONS:
+            for filled in (False, True):
+                with self.subTest(style=style, filled=filled):
+                    grids = self.grids(style, 9, 7)
+                    if filled: # most squares share a non-empty signature, which becomes the snapshot's default
+                        xs, ys = np.divmod(np.arange(9 * 7 - 5), 7)
+                        for grid in grids:
+                            grid.add_many(get_layers()[1], xs, ys)
+                    paint_all(grids, random.Random(7), 15)
+                    snapshots = [grid.snapshot() for grid in grids]
+                    expected = [signatures(grid) for grid in grids]
+                    paint_all(grids, random.Random(8), 40)
+                    for grid, snapshot, before in zip(grids, snapshots, expected):
+                        if filled:
+                            self.assertNotEqual(snapshot.default, grid.empty_signature(), grid.storage)
+                        grid.restore(snapshot)
+                        self.assertEqual(signatures(grid), before, grid.storage)
+
+    @number("3.13")
+    def test_tiled_reopen_after_crash(self):
+        for style in Grid.DRAW_STYLE_OPTIONS:
+            with self.subTest(style=style):
+                directory = tempfile.TemporaryDirectory()
+                self.addCleanup(directory.cleanup)
+                path = os.path.join(directory.name, "canvas.tiles")
+                dense = Grid(style, 40, 30)
+                crashed = Grid(style, 40, 30, storage=Grid.STORAGE_TILED, path=path, tile=16, max_tiles=2)
+                paint_all([dense, crashed], random.Random(9))
+                self.assertEqual(signatures(crashed), signatures(dense))
+                crashed.grid.log.close() # the process dies: never closed, so only the tiles and the log are saved
+                reopened = Grid(style, 40, 30, storage=Grid.STORAGE_TILED, path=path, tile=16)
+                self.assertEqual(signatures(reopened), signatures(dense))
+                paint_all([dense, reopened], random.Random(10))
+                reopened.close()
+                self.assertFalse(os.path.exists(path + ".log"))
+                reopened = Grid(style, 40, 30, storage=Grid.STORAGE_TILED, path=path, tile=16)
+                self.assertEqual(signatures(reopened), signatures(dense))
+                reopened.close()
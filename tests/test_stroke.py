@@ -0,0 +1,113 @@
+import math
+import random
+import unittest
+from ed_utils.decorators import number
+
+import numpy as np
+from brush import Stencil
+from grid import Grid
+from layer_util import get_layers
+from stroke import Stroke, supercover
+
+
+def touches(x0: float, y0: float, x1: float, y1: float, i: int, j: int) -> bool:
+    """Whether the segment meets the closed square i <= x <= i+1, j <= y <= j+1 (Liang-Barsky clipping)."""
+    low, high = 0.0, 1.0
+    for delta, start, square_low in ((x1 - x0, x0, i), (y1 - y0, y0, j)):
+        if delta == 0:
+            if not square_low <= start <= square_low + 1:
+                return False
+            continue
+        a, b = (square_low - start) / delta, (square_low + 1 - start) / delta
+        low, high = max(low, min(a, b)), min(high, max(a, b))
+    return low <= high
+
+
+class TestStencil(unittest.TestCase):
+
+    @number("6.1")
+    def test_placed_at_the_grid_edges(self):
+        diamond = Stencil.diamond(2)
+        self.assertEqual(len(diamond), 13)
+        for px, py in ((0, 0), (9, 6), (0, 6), (9, 3), (-2, 3), (11, 8), (-3, 3)):
+            with self.subTest(centre=(px, py)):
+                xs, ys = diamond.place(px, py, 10, 7)
+                expected = {
+                    (x, y) for x in range(10) for y in range(7) if abs(x - px) + abs(y - py) <= 2
+                }
+                self.assertEqual(set(zip(xs.tolist(), ys.tolist())), expected)
+                self.assertEqual(len(xs), len(expected))
+        self.assertEqual(
+            sorted(zip(*(a.tolist() for a in Stencil.from_mask([[0, 1, 0], [0, 1, 1], [0, 0, 0]]).place(1, 3, 3, 4)))),
+            [(0, 3), (1, 3)],
+        )
+        self.assertEqual(len(Stencil([(0, 0), (1, 0), (0, 0)])), 2)
+
+    @number("6.2")
+    def test_stamp_matches_adding_each_square(self):
+        layers = [layer for layer in get_layers() if layer is not None]
+        for storage in Grid.STORAGE_CLASSES:
+            for style in Grid.DRAW_STYLE_OPTIONS:
+                with self.subTest(storage=storage, style=style):
+                    stamped = Grid(style, 11, 8, storage=storage)
+                    added = Grid(style, 11, 8)
+                    self.addCleanup(stamped.close)
+                    rng = random.Random(11)
+                    for _ in range(15):
+                        layer, px, py = rng.choice(layers), rng.randrange(-2, 13), rng.randrange(-2, 10)
+                        stamped.brush_size = added.brush_size = rng.randrange(Grid.MAX_BRUSH + 1)
+                        changed = stamped.stamp(layer, px, py)
+                        expected = [
+                            (x, y) for x, y in zip(*(a.tolist() for a in Grid.BRUSH_STENCILS[added.brush_size].place(
+                                px, py, added.x, added.y))) if added[x][y].add(layer)
+                        ]
+                        self.assertEqual(sorted(changed), sorted(expected))
+                    for x in range(11):
+                        for y in range(8):
+                            self.assertEqual(stamped[x][y].signature(), added[x][y].signature())
+
+
+class TestSupercover(unittest.TestCase):
+
+    @number("6.3")
+    def test_matches_every_square_touched(self):
+        rng = random.Random(1)
+        for _ in range(200):
+            x0, y0, x1, y1 = (rng.uniform(-3, 12) for _ in range(4))
+            with self.subTest(segment=(x0, y0, x1, y1)):
+                squares = supercover(x0, y0, x1, y1)
+                self.assertEqual(squares[0], (math.floor(x0), math.floor(y0)))
+                self.assertEqual(squares[-1], (math.floor(x1), math.floor(y1)))
+                expected = {
+                    (i, j)
+                    for i in range(math.floor(min(x0, x1)), math.floor(max(x0, x1)) + 1)
+                    for j in range(math.floor(min(y0, y1)), math.floor(max(y0, y1)) + 1)
+                    if touches(x0, y0, x1, y1, i, j)
+                }
+                self.assertEqual(set(squares), expected)
+
+    @number("6.4")
+    def test_corner_crossing_and_straight_lines(self):
+        self.assertEqual(supercover(0.5, 0.5, 2.5, 2.5), [(0, 0), (1, 0), (0, 1), (1, 1), (2, 1), (1, 2), (2, 2)])
+        self.assertEqual(supercover(0.5, 3.5, 4.25, 3.5), [(0, 3), (1, 3), (2, 3), (3, 3), (4, 3)])
+        self.assertEqual(supercover(2.5, 4.5, 2.5, 1.5), [(2, 4), (2, 3), (2, 2), (2, 1)])
+        self.assertEqual(supercover(1.2, 1.7, 1.9, 1.1), [(1, 1)])
+
+
+class TestStroke(unittest.TestCase):
+
+    @number("6.5")
+    def test_each_square_painted_once(self):
+        grid = Grid(Grid.DRAW_STYLE_ADD, 20, 20, storage=Grid.STORAGE_COMPACT)
+        stroke = Stroke(grid, get_layers()[0], Grid.BRUSH_STENCILS[2])
+        points = [(2.5, 2.5), (15.5, 3.5), (3.5, 4.5), (16.5, 17.5), (-4.0, 10.0)]
+        stroke.paint_segment(points[0], points[0])
+        for start, end in zip(points, points[1:]):
+            stroke.paint_segment(start, end)
+        painted = [step.affected_grid_square for step in stroke.action.steps]
+        self.assertEqual(len(set(painted)), len(painted))
+        for x in range(grid.x):
+            for y in range(grid.y):
+                self.assertEqual(len(grid[x][y].applied_layers()), int((x, y) in set(painted)))
+        stroke.action.undo_apply(grid)
+        self.assertTrue(all(not grid[x][y].applied_layers() for x in range(grid.x) for y in range(grid.y)))
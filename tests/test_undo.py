@@ -0,0 +1,118 @@
+import random
+import unittest
+from unittest import mock
+from ed_utils.decorators import number
+
+from action import PaintAction
+from grid import Grid
+from layer_util import get_layers
+from undo import UndoTracker
+
+
+def signatures(grid: Grid) -> list:
+    return [[grid[x][y].signature() for y in range(grid.y)] for x in range(grid.x)]
+
+
+def paint(grid: Grid, undo: UndoTracker, rng: random.Random, actions: int) -> list:
+    """Applies random stamps and specials as main.py does, returning the grid's signatures after each action."""
+    layers = [layer for layer in get_layers() if layer is not None]
+    states = []
+    for _ in range(actions):
+        if rng.random() < 0.15:
+            grid.special()
+            action = PaintAction([], is_special=True)
+        else:
+            layer = rng.choice(layers)
+            grid.brush_size = rng.randrange(Grid.MAX_BRUSH + 1)
+            action = PaintAction()
+            action.add_squares(grid.stamp(layer, rng.randrange(grid.x), rng.randrange(grid.y)), layer)
+        undo.add_action(action)
+        states.append(signatures(grid))
+    return states
+
+
+class TestUndo(unittest.TestCase):
+
+    def grids(self):
+        """One grid of every draw style on every storage."""
+        for storage in Grid.STORAGE_CLASSES:
+            for style in Grid.DRAW_STYLE_OPTIONS:
+                grid = Grid(style, 11, 9, storage=storage)
+                self.addCleanup(grid.close)
+                yield grid
+
+    @number("4.1")
+    def test_undo_and_redo_restore_exact_states(self):
+        for grid in self.grids():
+            with self.subTest(style=grid.draw_style, storage=grid.storage):
+                undo = UndoTracker(grid, checkpoint_interval=4)
+                states = [signatures(grid)] + paint(grid, undo, random.Random(1), 30)
+                for target in (27, 21, 20, 3, 0):
+                    undo.undo_to(target)
+                    self.assertEqual(signatures(grid), states[target])
+                while undo.redo(grid) is not None:
+                    self.assertEqual(signatures(grid), states[undo.current])
+                self.assertEqual(undo.current, 30)
+
+    @number("4.2")
+    def test_undo_after_eviction(self):
+        for grid in self.grids():
+            with self.subTest(style=grid.draw_style, storage=grid.storage):
+                undo = UndoTracker(grid, memory_budget=12000, checkpoint_interval=8)
+                states = [signatures(grid)] + paint(grid, undo, random.Random(2), 60)
+                self.assertGreater(undo.base, 0)
+                self.assertLessEqual(undo.memory, undo.memory_budget)
+                while undo.undo(grid) is not None:
+                    self.assertEqual(signatures(grid), states[undo.current])
+                self.assertEqual(signatures(grid), states[undo.base])
+                while undo.redo(grid) is not None:
+                    self.assertEqual(signatures(grid), states[undo.current])
+
+    @number("4.3")
+    def test_eviction_keeps_recent_actions(self):
+        grid = Grid(Grid.DRAW_STYLE_ADD, 11, 9)
+        undo = UndoTracker(grid, memory_budget=0, checkpoint_interval=1000)
+        states = [signatures(grid)] + paint(grid, undo, random.Random(3), 10)
+        self.assertEqual(undo.current - undo.base, 1) # nothing fits, but the last action can still be undone
+        undo.undo(grid)
+        self.assertEqual(signatures(grid), states[9])
+
+        grid = Grid(Grid.DRAW_STYLE_SET, 11, 9)
+        undo = UndoTracker(grid, checkpoint_interval=1000)
+        states = [signatures(grid)] + paint(grid, undo, random.Random(4), 40)
+        undo.memory_budget = undo.memory
+        paint(grid, undo, random.Random(5), 4)
+        self.assertTrue(0 < undo.base < 40, undo.base) # only the oldest actions go
+        self.assertLessEqual(undo.memory, undo.memory_budget)
+        undo.undo_to(undo.base)
+        self.assertEqual(signatures(grid), states[undo.base])
+
+    @number("4.4")
+    def test_dense_written_squares(self):
+        grid = Grid(Grid.DRAW_STYLE_SET, 30, 20)
+        self.assertEqual(len(grid.written_keys()), 0)
+        grid.brush_size = 1
+        changed = grid.stamp(get_layers()[0], 10, 10)
+        self.assertEqual(sorted(grid.written_keys().tolist()), sorted(x * grid.y + y for x, y in changed))
+
+    @number("4.5")
+    def test_short_undo_skips_the_checkpoint(self):
+        for grid in self.grids():
+            with self.subTest(style=grid.draw_style, storage=grid.storage):
+                undo = UndoTracker(grid, memory_budget=80000, checkpoint_interval=6)
+                states = [signatures(grid)] + paint(grid, undo, random.Random(6), 50)
+                self.assertTrue(set(undo.images) <= set(range(undo.base + 1, undo.current + 1)))
+                with mock.patch.object(undo, "restore", wraps=undo.restore) as restore:
+                    for n in (1, 3, UndoTracker.SHORT_UNDO):
+                        target = undo.current - n
+                        undone = undo.undo_many(n)
+                        self.assertEqual(len(undone), n)
+                        self.assertEqual(signatures(grid), states[target])
+                    specials = [action.is_special for action in undo.redoTracker]
+                    if grid.draw_style != Grid.DRAW_STYLE_SEQUENCE or not any(specials):
+                        restore.assert_not_called() # a SEQUENCE special can't be undone on its own
+                    undo.undo_to(undo.base)
+                    restore.assert_called()
+                self.assertEqual(signatures(grid), states[undo.base])
+                while undo.redo(grid) is not None:
+                    self.assertEqual(signatures(grid), states[undo.current])
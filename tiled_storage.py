@@ -0,0 +1,440 @@
+"""
+Memory-mapped tiled grid storage, for grids far larger than memory.
+
+Every square is one uint32 state word, kept in a file split into TILE x TILE tiles.
+A tile is memory-mapped when one of its squares is first read or written, and at most `max_tiles`
+tiles stay mapped: the least recently used tile is flushed and unmapped to make room for another.
+The file is created sparse, so tiles that are never written take no disk space.
+
+State word per draw style:
+- SET: bits 0-4 hold the layer index + 1 (0 for no layer), bit 31 is the square's special flag.
+  An odd number of grid-wide specials flips the meaning of bit 31 for every square at once.
+- SEQUENCE: bit i is set when the layer with index i is applied.
+  Grid-wide specials are applied to the written tiles when the storage is next read or changed.
+- ADD: the id of the square's layer stack in the storage's own table of interned stacks (see layer_stacks.py),
+  kept apart from the shared table so the ids stay valid when the file is reopened.
+  An odd number of grid-wide specials reverses every stack, so the stored id is of the reversed stack until then.
+The grid's layout (size, tile size and draw style) is saved next to the file (path + ".json") when it is created,
+and the stack table, the set of written tiles and the special count are added on close. Until then, every new stack,
+newly written tile and applied special count is appended to a log (path + ".log") before a word depends on it, so
+a file whose process crashed, leaving the log and the tiles it wrote, still reopens with every id and tile. Reopening
+the file for another layout is refused.
+"""
+
+from __future__ import annotations
+import json
+import os
+import tempfile
+from collections import OrderedDict
+import numpy as np
+from layer_store import *
+from layer_util import LAYERS, Layer
+from layer_stacks import StackTable, StackNode
+from grid_storage import group_by_key, layers_mask, mask_layers, mask_after_special, mask_after_specials
+
+SET_LAYER_MASK = 0x1F
+SET_SPECIAL_BIT = 1 << 31
+# The draw style of each store class, as Grid names it, for the saved layout.
+DRAW_STYLES = {SetLayerStore: "SET", AdditiveLayerStore: "ADD", SequenceLayerStore: "SEQUENCE"}
+
+
+class LoggedStackTable(StackTable):
+    """A StackTable that passes every stack it interns for the first time to log(node), once log is set."""
+
+    def __init__(self) -> None:
+        self.log = None
+        super().__init__()
+
+    def intern(self, layers: tuple[int, ...]) -> StackNode:
+        count = len(self.nodes)
+        node = super().intern(layers)
+        if len(self.nodes) > count and self.log is not None:
+            self.log(node)
+        return node
+
+
+class TiledStorage:
+
+    TILE = 64
+    MAX_TILES = 256
+
+    def __init__(self, store_class, grid_state, x: int, y: int, path: str | None = None,
+                 tile: int = TILE, max_tiles: int = MAX_TILES) -> None:
+        """
+        - path: the backing file. It is reopened if it exists, otherwise created.
+          Without a path a temporary file is used, and removed on close.
+        - tile: side length of a tile, in squares.
+        - max_tiles: how many tiles may be mapped at once.
+
+        RAISE: ValueError if the draw style isn't supported, or `path` holds a grid of another size, tile size or
+        draw style (or one with no saved layout)
+        Complexity: O(1), the file is only extended (sparsely), never written. Reopening also reads the saved
+        metadata and log (see replay_log).
+        """
+        if store_class not in (SetLayerStore, AdditiveLayerStore, SequenceLayerStore):
+            raise ValueError(f"Tiled storage doesn't support {store_class.__name__}.")
+        self.store_class = store_class
+        self.grid_state = grid_state
+        self.x = x
+        self.y = y
+        self.tile = tile
+        self.max_tiles = max_tiles
+        self.tiles_y = (y + tile - 1) // tile
+        self.tiles_x = (x + tile - 1) // tile
+        self.tile_bytes = tile * tile * 4
+
+        self.temporary = path is None
+        if self.temporary:
+            handle, path = tempfile.mkstemp(suffix=".tiles")
+            os.close(handle)
+        self.path = path
+        self.mapped = OrderedDict()
+        self.written = set()
+        self.stacks = LoggedStackTable()
+        self.log = None
+        # Grid-wide specials already applied to the SEQUENCE words.
+        self.specials_applied = 0
+        if os.path.exists(self.meta_path()):
+            with open(self.meta_path()) as f:
+                meta = json.load(f)
+            saved = {key: meta.get(key) for key in self.layout()}
+            if saved != self.layout():
+                raise ValueError(f"{path} holds a grid laid out as {saved}, not {self.layout()}.")
+            self.written = {tuple(t) for t in meta["written"]}
+            grid_state.specials = self.specials_applied = meta["specials"]
+            for stack in meta["stacks"]:
+                self.stacks.intern(tuple(stack)) # interned in id order, so every id is restored
+            if os.path.exists(self.log_path()):
+                self.replay_log()
+                self.save_meta()
+        elif os.path.exists(path) and os.path.getsize(path) and not self.temporary:
+            raise ValueError(f"{path} has no saved layout ({self.meta_path()}), so it can't be checked against the grid.")
+        elif not self.temporary:
+            self.save_meta()
+        if not self.temporary:
+            self.log = open(self.log_path(), "w")
+            self.stacks.log = lambda node: self.append_log({"stack": node.layers})
+        with open(path, "ab") as f:
+            f.truncate(max(os.path.getsize(path), self.tiles_x * self.tiles_y * self.tile_bytes))
+
+    def meta_path(self) -> str:
+        return self.path + ".json"
+
+    def layout(self) -> dict:
+        """What a reopened file must match: the grid size, tile size and draw style."""
+        return {"x": self.x, "y": self.y, "tile": self.tile, "draw_style": DRAW_STYLES[self.store_class]}
+
+    def log_path(self) -> str:
+        return self.path + ".log"
+
+    def append_log(self, entry: dict) -> None:
+        """Appends one JSON line to the log, flushed at once so it outlives the process. Temporary files have no log."""
+        if self.log is not None:
+            self.log.write(json.dumps(entry) + "\n")
+            self.log.flush()
+
+    def replay_log(self) -> None:
+        """
+        Adds what the log recorded after the saved metadata: stacks (in id order), written tiles and special counts.
+        Complexity: O(length of the log)
+        """
+        with open(self.log_path()) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    break # the last line, cut short by the crash
+                if "stack" in entry:
+                    self.stacks.intern(tuple(entry["stack"]))
+                elif "tile" in entry:
+                    self.written.add(tuple(entry["tile"]))
+                else:
+                    self.grid_state.specials = self.specials_applied = entry["specials"]
+
+    def save_meta(self) -> None:
+        with open(self.meta_path(), "w") as f:
+            json.dump({
+                **self.layout(),
+                "written": sorted(self.written),
+                "stacks": [node.layers for node in self.stacks.nodes],
+                "specials": self.grid_state.specials,
+            }, f)
+
+    # Tiles
+
+    def tile_of(self, x: int, y: int) -> tuple[int, int]:
+        return (x // self.tile, y // self.tile)
+
+    def get_tile(self, key: tuple[int, int]) -> np.ndarray:
+        """
+        Returns tile `key` as a TILE x TILE array mapped onto the file, mapping it if needed.
+        Complexity: O(1), plus flushing one tile if another has to be unmapped.
+        """
+        tile = self.mapped.get(key)
+        if tile is not None:
+            self.mapped.move_to_end(key)
+            return tile
+        if len(self.mapped) >= self.max_tiles:
+            _, evicted = self.mapped.popitem(last=False)
+            evicted.flush()
+        offset = (key[0] * self.tiles_y + key[1]) * self.tile_bytes
+        tile = np.memmap(self.path, dtype=np.uint32, mode="r+", offset=offset, shape=(self.tile, self.tile))
+        self.mapped[key] = tile
+        return tile
+
+    def read(self, x: int, y: int) -> int:
+        return int(self.get_tile(self.tile_of(x, y))[x % self.tile, y % self.tile])
+
+    def write(self, x: int, y: int, word: int) -> None:
+        key = self.tile_of(x, y)
+        self.mark_written(key)
+        self.get_tile(key)[x % self.tile, y % self.tile] = word
+
+    def mark_written(self, key: tuple[int, int]) -> None:
+        """Adds a tile to the written set, and to the log the first time, before any word is written to it."""
+        if key not in self.written:
+            self.written.add(key)
+            self.append_log({"tile": key})
+
+    def flush(self) -> None:
+        for tile in self.mapped.values():
+            tile.flush()
+
+    def close(self) -> None:
+        """
+        Flush and unmap every tile and save the stack table, which then holds everything the log did, so the log is
+        removed. A temporary file is removed instead.
+        """
+        self.sync()
+        self.flush()
+        self.mapped.clear()
+        if self.temporary:
+            os.remove(self.path)
+            return
+        self.save_meta()
+        if self.log is not None:
+            self.stacks.log = None
+            self.log.close()
+            self.log = None
+            os.remove(self.log_path())
+
+    # State words
+
+    def signature_of(self, word: int) -> tuple[tuple[int, ...], bool]:
+        if self.store_class is SetLayerStore:
+            index = word & SET_LAYER_MASK
+            return ((index - 1,) if index else ()), bool(word & SET_SPECIAL_BIT) != (self.grid_state.specials % 2 == 1)
+        if self.store_class is SequenceLayerStore:
+            return mask_layers(word), False
+        return self.node_of(word).layers, False
+
+    def node_of(self, word: int) -> StackNode:
+        """The ADD stack a square with this word holds, after grid-wide specials."""
+        node = self.stacks[word]
+        return node.reversed() if self.grid_state.specials % 2 == 1 else node
+
+    def word_of(self, node: StackNode) -> int:
+        """The ADD word to store for a square holding this stack, the inverse of node_of."""
+        return (node.reversed() if self.grid_state.specials % 2 == 1 else node).id
+
+    def word_for(self, signature: tuple[tuple[int, ...], bool]) -> int:
+        """The word to store for a square with this signature, the inverse of signature_of."""
+        layers, inverted = signature
+        if self.store_class is SetLayerStore:
+            special = SET_SPECIAL_BIT if inverted != (self.grid_state.specials % 2 == 1) else 0
+            return (layers[0] + 1 if layers else 0) | special
+        if self.store_class is SequenceLayerStore:
+            return layers_mask(layers)
+        return self.word_of(self.stacks.intern(layers))
+
+    # Storage interface
+
+    def __getitem__(self, index) -> TiledColumn:
+        if not 0 <= index < self.x:
+            raise IndexError(index)
+        return TiledColumn(self, index)
+
+    def sync(self) -> None:
+        """
+        Applies the grid-wide specials made since the last sync to the SEQUENCE words. SET and ADD words are
+        read through the special count instead, so they never need rewriting.
+        Complexity: O(1) if there are none, otherwise O(squares in written tiles) vectorised work, since tiles that
+        were never written hold empty squares, which special doesn't change. Within a tile, the specials are worked
+        out once per distinct word.
+        """
+        pending = self.grid_state.specials - self.specials_applied
+        if not pending:
+            return
+        if self.store_class is SequenceLayerStore:
+            for key in sorted(self.written):
+                tile = self.get_tile(key)
+                words, inverse = np.unique(tile, return_inverse=True)
+                new = np.array([mask_after_specials(int(word), pending) for word in words], dtype=np.uint32)
+                new = new[inverse].reshape(tile.shape)
+                changed = new != tile
+                tile[changed] = new[changed] # only touch the pages that change
+        self.specials_applied = self.grid_state.specials
+        self.append_log({"specials": self.specials_applied})
+
+    def written_squares(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Squares with a non-zero word, which are all in written tiles.
+        Complexity: O(TILE^2) vectorised work per written tile, each mapped in turn.
+        """
+        self.sync()
+        xs, ys = [np.zeros(0, dtype=np.intp)], [np.zeros(0, dtype=np.intp)]
+        for key in sorted(self.written):
+            tx, ty = np.nonzero(self.get_tile(key))
+            xs.append(key[0] * self.tile + tx)
+            ys.append(key[1] * self.tile + ty)
+        return np.concatenate(xs), np.concatenate(ys)
+
+    def by_tile(self, xs: np.ndarray, ys: np.ndarray):
+        """Yields (tile key, positions k in xs and ys of the squares in that tile), one distinct tile at a time."""
+        tile_keys = (xs // self.tile) * self.tiles_y + ys // self.tile
+        order = np.argsort(tile_keys, kind="stable")
+        unique, starts = np.unique(tile_keys[order], return_index=True)
+        ends = np.append(starts[1:], len(order))
+        for tile_key, start, end in zip(unique.tolist(), starts, ends):
+            yield (tile_key // self.tiles_y, tile_key % self.tiles_y), order[start:end]
+
+    def group_cells(self, xs: np.ndarray, ys: np.ndarray) -> dict:
+        """
+        Only the tiles holding the requested squares are mapped.
+        Complexity: O(len(xs) log len(xs)) vectorised work, plus one mapping per distinct tile.
+        """
+        self.sync()
+        words = np.zeros(len(xs), dtype=np.int64)
+        for key, inside in self.by_tile(xs, ys):
+            if key not in self.written:
+                continue # never written, so every square is empty
+            words[inside] = self.get_tile(key)[xs[inside] % self.tile, ys[inside] % self.tile]
+        return group_by_key(words, xs, ys, self.signature_of)
+
+    def set_signatures(self, signatures: list, ids: np.ndarray, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        """
+        Square (xs[k], ys[k]) gets the word of signatures[ids[k]], written directly one tile at a time. Tiles that
+        were never written hold empty squares, so they are only mapped if a word isn't empty.
+        Complexity: O(len(xs) log len(xs)) vectorised work, plus one mapping per distinct tile.
+        """
+        self.sync()
+        words = np.array([self.word_for(signature) for signature in signatures], dtype=np.uint32)[ids]
+        changed = np.zeros(len(xs), dtype=bool)
+        for key, inside in self.by_tile(xs, ys):
+            if key not in self.written and not words[inside].any():
+                continue
+            self.mark_written(key)
+            tile = self.get_tile(key)
+            tx, ty = xs[inside] % self.tile, ys[inside] % self.tile
+            differs = tile[tx, ty] != words[inside]
+            tile[tx[differs], ty[differs]] = words[inside][differs] # only touch the pages that change
+            changed[inside] = differs
+        self.grid_state.mark_dirty_many(xs[changed], ys[changed])
+        return changed
+
+
+class TiledColumn:
+    """grid[x] for tiled storage."""
+
+    def __init__(self, storage: TiledStorage, x: int) -> None:
+        self.storage = storage
+        self.x = x
+
+    def __len__(self) -> int:
+        return self.storage.y
+
+    def __getitem__(self, index) -> TiledCell:
+        if not 0 <= index < self.storage.y:
+            raise IndexError(index)
+        return TiledCell(self.storage, self.x, index)
+
+
+class TiledCell(LayerStore):
+    """
+    A LayerStore view of one square of TiledStorage, following the rules of the storage's draw style.
+    Views are created on access and only touch the tile holding their square.
+    """
+
+    def __init__(self, storage: TiledStorage, x: int, y: int) -> None:
+        self.storage = storage
+        self.watch(storage.grid_state, x, y)
+
+    def _word(self) -> int:
+        self.storage.sync()
+        return self.storage.read(*self._position)
+
+    def _set_word(self, word: int) -> None:
+        self.storage.write(*self._position, word)
+        self._changed()
+
+    def add(self, layer: Layer) -> bool:
+        word = self._word()
+        style = self.storage.store_class
+        if style is SetLayerStore:
+            if word & SET_LAYER_MASK == layer.index + 1:
+                return False
+            self._set_word(word & ~SET_LAYER_MASK | (layer.index + 1))
+        elif style is SequenceLayerStore:
+            if word >> layer.index & 1:
+                return False
+            self._set_word(word | 1 << layer.index)
+        else:
+            node = self.storage.node_of(word)
+            if len(node) >= AdditiveLayerStore.MAX_LAYERS:
+                return False
+            self._set_word(self.storage.word_of(node.push(layer.index)))
+        return True
+
+    def erase(self, layer: Layer) -> bool:
+        word = self._word()
+        style = self.storage.store_class
+        if style is SetLayerStore:
+            if not word & SET_LAYER_MASK:
+                return False
+            self._set_word(word & ~SET_LAYER_MASK)
+        elif style is SequenceLayerStore:
+            if not word >> layer.index & 1:
+                return False
+            self._set_word(word & ~(1 << layer.index))
+        else:
+            node = self.storage.node_of(word)
+            if not len(node):
+                return False
+            self._set_word(self.storage.word_of(node.erase_first())) # the first layer added goes first
+        return True
+
+    def special(self):
+        word = self._word()
+        style = self.storage.store_class
+        if style is SetLayerStore:
+            self._set_word(word ^ SET_SPECIAL_BIT)
+        elif style is SequenceLayerStore:
+            if mask_after_special(word) != word:
+                self._set_word(mask_after_special(word))
+        else:
+            node = self.storage.node_of(word)
+            if len(node) > 1:
+                self._set_word(self.storage.word_of(node.reversed()))
+
+    def set_signature(self, signature: tuple[tuple[int, ...], bool]) -> bool:
+        """Writes the signature's word directly (see TiledStorage.word_for). Complexity: O(number of layers)"""
+        word = self.storage.word_for(signature)
+        if self._word() == word:
+            return False
+        self._set_word(word)
+        return True
+
+    def applied_layers(self) -> list[Layer]:
+        return [LAYERS[i] for i in self.signature()[0]]
+
+    def is_inverted(self) -> bool:
+        return self.signature()[1]
+
+    def signature(self) -> tuple[tuple[int, ...], bool]:
+        return self.storage.signature_of(self._word())
+
+    def get_color(self, start, timestamp, x, y) -> tuple[int, int, int]:
+        color = self.compiled().apply(start, timestamp, x, y)
+        if self.is_inverted():
+            color = (255-color[0], 255-color[1], 255-color[2])
+        return tuple(color)
@@ -1,38 +1,158 @@
 from __future__ import annotations
+import numpy as np
 from action import PaintAction
-from grid import Grid
-from data_structures.stack_adt import *
-from action import PaintAction
+from grid import Grid, GridSnapshot
+from grid_storage import layers_mask, mask_after_specials, mask_layers
+from layer_deque import LayerDeque
 
 class UndoTracker:
-    def __init__(self):
+    """
+    Undo history, limited by memory rather than by a number of actions.
+
+    Actions are numbered from 1 as they are added (add_action returns the number), and the grid state after
+    action i is "state i". When the history outgrows memory_budget, the oldest actions are dropped, ring-buffer style,
+though the most recent action is always kept.
+
+    Given the grid, the tracker also keeps a checkpoint (Grid.snapshot) of state 0 and of every
+    checkpoint_interval-th state, and an image of the squares each paint action touched, as they were after it.
+    Undo then restores the earlier state exactly. Up to SHORT_UNDO actions are undone one at a time: each one's
+    squares get their value before it, the image of the latest action before it that touched them, or else the nearest
+    checkpoint. Longer jumps rewrite every square the undone actions touched once, using its value at the nearest
+    checkpoint before the target state, brought forward by at most checkpoint_interval recorded actions.
+    Without the grid, undo applies each action's undo_apply instead.
+    """
+
+    DEFAULT_MEMORY_BUDGET = 64 * 2**20
+    CHECKPOINT_INTERVAL = 32
+    SHORT_UNDO = 8
+
+    def __init__(self, grid: Grid | None = None, memory_budget: int = DEFAULT_MEMORY_BUDGET,
+                 checkpoint_interval: int = CHECKPOINT_INTERVAL):
         """
-        Initialising undoTracker and redoTracker as stacks as this ADT operates on a LIFO basis, so undoing an action (pop from
-        first stack) and then pushing onto the second stack so that if redo is called, then pop action from second stack.
+        Initialising undoTracker and redoTracker as growable deques used as stacks, as undo operates on a LIFO basis:
+        undoing an action pops it from the first and pushes it onto the second, so that redo pops it back.
+        The undo deque is also served from the front when the oldest actions are dropped.
 
-        INPUT: None
+        INPUT: grid (the Grid the actions are applied to, or None), memory_budget (bytes), checkpoint_interval (integer)
         RAISE: None
         OUTPUT: None
 
-        Complexity: best = worst = O(1) since intialising is always constant
+        Complexity: O(1) without the grid, otherwise the checkpoint of state 0 (see Grid.snapshot), which scales with
+        the squares written so far rather than with the grid.
         """
-        self.undoTracker = ArrayStack(100)
-        self.redoTracker = ArrayStack(100)
+        self.undoTracker = LayerDeque()
+        self.redoTracker = LayerDeque()
+        self.grid = grid
+        self.memory_budget = memory_budget
+        self.checkpoint_interval = checkpoint_interval
+        self.base = 0 # number of the oldest state that can be restored
+        self.memory = 0
+        self.checkpoints = {}
+        self.images = {} # state n -> GridSnapshot of the squares paint action n touched, in state n
+        if grid is not None:
+            self.checkpoint(0)
 
-    def add_action(self, action: PaintAction) -> None:
-        """
-        Adds an action to the undo tracker.
+    @property
+    def current(self) -> int:
+        """Number of the current state (the last action applied)."""
+        return self.base + len(self.undoTracker)
 
-        If your collection is already full,
-        feel free to exit early and not add the action.
+    def checkpoint(self, state: int) -> None:
+        snapshot = self.checkpoints[state] = self.grid.snapshot()
+        self.memory += snapshot.nbytes()
+
+    def drop_checkpoint(self, state: int) -> None:
+        self.memory -= self.checkpoints.pop(state).nbytes()
+
+    def take_image(self, action: PaintAction) -> None:
+        """Records the squares the current action touched, with their signatures now. Complexity: O(m log m)"""
+        keys = np.unique(action.keys(self.grid.y))
+        ids = np.empty(len(keys), dtype=np.int64)
+        signatures = []
+        for signature, (xs, ys) in self.grid.grid.group_cells(keys // self.grid.y, keys % self.grid.y).items():
+            ids[np.searchsorted(keys, np.asarray(xs, dtype=np.int64) * self.grid.y + ys)] = len(signatures)
+            signatures.append(signature)
+        image = self.images[self.current] = GridSnapshot(None, keys, ids, signatures)
+        self.memory += image.nbytes()
+
+    def drop_image(self, state: int) -> None:
+        image = self.images.pop(state, None)
+        if image is not None:
+            self.memory -= image.nbytes()
+
+    def add_action(self, action: PaintAction) -> int:
+        """
+        Adds an action to the undo tracker, after it has been applied to the grid.
+        Every action that was undone (and could have been redone) is forgotten.
 
         INPUTS: Action
         RAISE: None
-        OUTPUTS: None
+        OUTPUTS: the number of the action
+
+        Complexity: O(1) amortised, plus a snapshot when a checkpoint is taken (O(w log w) for the w squares written,
+        see Grid.snapshot) and O(k) to forget k undone actions.
+        """
+        while not self.redoTracker.is_empty():
+            self.memory -= self.redoTracker.pop().nbytes()
+        for state in [state for state in self.checkpoints if state > self.current]:
+            self.drop_checkpoint(state)
+        for state in [state for state in self.images if state > self.current]:
+            self.drop_image(state)
+        self.undoTracker.append(action)
+        self.memory += action.nbytes()
+        if self.grid is not None and not action.is_special:
+            self.take_image(action)
+        if self.grid is not None and self.current % self.checkpoint_interval == 0:
+            self.checkpoint(self.current)
+        self.evict()
+        return self.current
+
+    def evict(self) -> None:
+        """
+        Drops the oldest actions until the history fits in memory_budget, keeping at least the most recent one.
+        With checkpoints, actions are dropped up to the next checkpoint, which becomes the oldest state that can be
+        restored. When there is no checkpoint between the oldest and the current state, one is taken of the oldest
+        state that leaves the rest of the history within budget (see checkpoint_past), so only the oldest actions go.
+
+        Complexity: O(number of actions dropped), plus checkpoint_past if there is no checkpoint to drop to.
+        """
+        while self.memory > self.memory_budget and len(self.undoTracker) > 1:
+            if self.grid is None:
+                self.memory -= self.undoTracker.serve().nbytes()
+                self.base += 1
+                continue
+            later = [state for state in self.checkpoints if self.base < state < self.current]
+            if not later:
+                later = [self.checkpoint_past(self.fitting_state())]
+            oldest = min(later)
+            for _ in range(oldest - self.base):
+                self.memory -= self.undoTracker.serve().nbytes()
+            for state in range(self.base + 1, oldest + 1): # lookups stop at a checkpoint, so these aren't needed
+                self.drop_image(state)
+            self.drop_checkpoint(self.base)
+            self.base = oldest
+
+    def fitting_state(self) -> int:
+        """The oldest state after base such that dropping the actions before it brings the history within budget."""
+        excess = self.memory - self.memory_budget
+        state = self.base
+        while excess > 0 and state < self.current - 1:
+            excess -= self.undoTracker[state - self.base].nbytes() # action state + 1
+            state += 1
+        return state
 
-        Complexity: best = worst = O(1), since pushing onto a stack is always constant
+    def checkpoint_past(self, state: int) -> int:
         """
-        self.undoTracker.push(action)
+        Takes a checkpoint of a state before the current one: the grid is undone to it exactly (see undo_to),
+        recorded, then redone back to the current state. Returns the state.
+
+        Complexity: undo_to and redoing the actions after `state`, plus the snapshot (see Grid.snapshot).
+        """
+        undone = self.undo_to(state)
+        self.checkpoint(state)
+        for _ in undone:
+            self.redo(self.grid)
+        return state
 
     def undo(self, grid: Grid) -> PaintAction|None:
         """
@@ -45,15 +165,181 @@ class UndoTracker:
         RAISE: None
         OUTPUTS: None or PaintAction (action)
 
-        Complexity: checking if the stack is empty is always O(1), and popping is also O(1), measured against the grid. However, if
-        the Draw Style is sequential and special() is called, then the worst-case complexity is O(len(self.layerstore)).
+        Complexity: please refer to undo_to, with one action undone.
         """
-        if self.undoTracker.is_empty():
-            return None
-        else:
+        undone = self.undo_many(1, grid)
+        return undone[0] if undone else None
+
+    def undo_many(self, n: int, grid: Grid | None = None) -> list[PaintAction]:
+        """
+        Undo the last n actions (or as many as there are) in one go.
+
+        INPUTS: n (integer), grid (defaults to the tracker's grid)
+        RAISE: None
+        OUTPUTS: list of the actions undone, most recent first
+
+        Complexity: please refer to undo_to.
+        """
+        return self.undo_to(max(self.base, self.current - n), grid)
+
+    def undo_to(self, action_id: int, grid: Grid | None = None) -> list[PaintAction]:
+        """
+        Undo every action after `action_id`, so that action is the last one applied (0 undoes everything kept).
+
+        Up to SHORT_UNDO actions are undone one at a time, each setting its squares back to their value before it
+        (see values_at). Longer jumps are coalesced: each square touched by the undone actions is rewritten once, with
+        its value in state action_id. That value is found on a scratch grid holding just those squares, loaded from the
+        nearest checkpoint at or before action_id and brought forward by the actions in between.
+
+        INPUTS: action_id (integer), grid (defaults to the tracker's grid)
+        RAISE: ValueError if action_id is older than the history kept, or in the future
+        OUTPUTS: list of the actions undone, most recent first
+
+        Complexity: for a short undo, O(k * m log m) for the m squares of each undone action and at most
+        k = checkpoint_interval images looked up, plus rewriting them. Otherwise O(m + c + k*s) for m squares touched
+        by the undone actions, c the cost of rewriting them on the grid, and at most k actions of s steps brought
+        forward. Undoing a special of the SEQUENCE style touches every square written now or in state action_id, so
+        it always takes the longer path. SET and ADD specials are their own inverse, so they are undone in O(1).
+        """
+        grid = self.grid if grid is None else grid
+        if not self.base <= action_id <= self.current:
+            raise ValueError(f"Can only undo to an action between {self.base} and {self.current}, not {action_id}.")
+        if self.grid is not None and self.current - action_id <= self.SHORT_UNDO and not (
+                grid.draw_style == Grid.DRAW_STYLE_SEQUENCE
+                and any(self.undoTracker[n - 1 - self.base].is_special for n in range(action_id + 1, self.current + 1))):
+            return self.undo_each(grid, action_id)
+        undone = []
+        while self.current > action_id:
             action = self.undoTracker.pop()
-            action.undo_apply(grid)
-            return action
+            self.redoTracker.append(action) # so it can be redone
+            undone.append(action)
+        if not undone:
+            return undone
+        if self.grid is None:
+            for action in undone:
+                action.undo_apply(grid)
+        elif all(action.is_special for action in undone) and grid.draw_style != Grid.DRAW_STYLE_SEQUENCE:
+            for action in undone:
+                grid.special()
+        else:
+            self.restore(grid, action_id, undone)
+        return undone
+
+    def undo_each(self, grid: Grid, action_id: int) -> list[PaintAction]:
+        """Undoes the actions after action_id one at a time, most recent first (see undo_to)."""
+        undone = []
+        while self.current > action_id:
+            action = self.undoTracker[len(self.undoTracker) - 1]
+            if action.is_special:
+                grid.special()
+            else:
+                keys = self.images[self.current].keys
+                signatures, ids = self.values_at(self.current - 1, keys)
+                grid.set_signatures(signatures, ids, keys // grid.y, keys % grid.y)
+            self.redoTracker.append(self.undoTracker.pop())
+            undone.append(action)
+        return undone
+
+    def values_at(self, state: int, keys: np.ndarray) -> tuple[list, np.ndarray]:
+        """
+        The signature of each square key in `state`, as a table of signatures and an index into it per key.
+        Each square takes its value from the image of the latest paint action up to `state` that touched it, or from
+        the nearest checkpoint at or before `state`, with the specials made since then applied.
+
+        Complexity: O(k * n log n) for n keys and at most k = checkpoint_interval images looked up.
+        """
+        start = max(checkpoint for checkpoint in self.checkpoints if checkpoint <= state)
+        signatures, index = [], {}
+        ids = np.empty(len(keys), dtype=np.int64)
+        remaining = np.arange(len(keys))
+        specials = 0
+
+        def take(found: np.ndarray, found_ids: np.ndarray, table: list) -> None:
+            """Squares keys[found] have signatures table[found_ids] before the specials since."""
+            distinct = np.unique(found_ids)
+            lookup = np.empty(len(distinct), dtype=np.int64)
+            for k, i in enumerate(distinct.tolist()):
+                signature = self.after_specials(table[i], specials)
+                if signature not in index:
+                    index[signature] = len(signatures)
+                    signatures.append(signature)
+                lookup[k] = index[signature]
+            ids[found] = lookup[np.searchsorted(distinct, found_ids)]
+
+        for n in range(state, start, -1):
+            if not len(remaining):
+                break
+            if self.undoTracker[n - 1 - self.base].is_special:
+                specials += 1
+                continue
+            image = self.images[n]
+            image_ids = image.signature_ids(keys[remaining])
+            inside = image_ids < len(image.signatures)
+            take(remaining[inside], image_ids[inside], image.signatures)
+            remaining = remaining[~inside]
+        if len(remaining):
+            checkpoint = self.checkpoints[start]
+            take(remaining, checkpoint.signature_ids(keys[remaining]), checkpoint.signatures + [checkpoint.default])
+        return signatures, ids
+
+    def after_specials(self, signature: tuple[tuple[int, ...], bool], count: int) -> tuple[tuple[int, ...], bool]:
+        """The signature of a square after `count` grid-wide specials, as the grid's draw style applies them."""
+        layers, inverted = signature
+        if not count:
+            return signature
+        if self.grid.draw_style == Grid.DRAW_STYLE_SET:
+            return layers, inverted != (count % 2 == 1)
+        if self.grid.draw_style == Grid.DRAW_STYLE_ADD:
+            return (layers[::-1] if count % 2 == 1 else layers), inverted
+        return mask_layers(mask_after_specials(layers_mask(layers), count)), inverted
+
+    def restore(self, grid: Grid, state: int, undone: list[PaintAction]) -> None:
+        """Rewrites the squares touched by the undone actions with their value in `state`."""
+        start = max(checkpoint for checkpoint in self.checkpoints if checkpoint <= state)
+        checkpoint = self.checkpoints[start]
+        specials = [action for action in undone if action.is_special]
+        if specials and grid.draw_style != Grid.DRAW_STYLE_SEQUENCE:
+            # Applying a special to every square is its own inverse, so a square no undone paint action touched
+            # is back to its value in `state` once the specials are applied again.
+            for _ in specials:
+                grid.special()
+            undone = [action for action in undone if not action.is_special]
+            specials = []
+        if specials and checkpoint.default != ((), False):
+            keys = np.arange(grid.x * grid.y) # most squares held layers at the checkpoint
+        elif specials:
+            # Squares that are empty both now and in `state` are unchanged: every other one is written now, or
+            # held layers at the checkpoint, or was painted between the checkpoint and `state`.
+            painted = [self.undoTracker[n - self.base].keys(grid.y) for n in range(start, state)]
+            keys = np.unique(np.concatenate([grid.written_keys(), checkpoint.keys] + painted))
+        else:
+            keys = np.unique(np.concatenate([np.zeros(0, dtype=np.int64)] + [action.keys(grid.y) for action in undone]))
+        if not len(keys):
+            return
+
+        # Square keys[i] of the grid is square (i, 0) of the scratch grid.
+        scratch = Grid(grid.draw_style, len(keys), 1, storage=Grid.STORAGE_COMPACT)
+        positions = np.arange(len(keys))
+        zeros = np.zeros(len(keys), dtype=np.intp)
+        scratch.set_signatures(checkpoint.signatures + [checkpoint.default], checkpoint.signature_ids(keys),
+                               positions, zeros)
+        for n in range(start, state):
+            action = self.undoTracker[n - self.base]
+            if action.is_special:
+                scratch.special()
+                continue
+            action_keys = action.keys(grid.y)
+            found = np.minimum(np.searchsorted(keys, action_keys), len(keys) - 1)
+            inside = keys[found] == action_keys
+            PaintAction.from_squares(found[inside], np.zeros(np.count_nonzero(inside), dtype=np.intp),
+                                     action.squares()[2][inside]).redo_apply(scratch)
+
+        signatures = []
+        ids = np.empty(len(keys), dtype=np.intp)
+        for signature, (xs, _) in scratch.grid.group_cells(positions, zeros).items():
+            ids[xs] = len(signatures)
+            signatures.append(signature)
+        grid.set_signatures(signatures, ids, keys // grid.y, keys % grid.y)
 
     def redo(self, grid: Grid) -> PaintAction|None:
         """
@@ -66,12 +352,13 @@ class UndoTracker:
         RAISE: None
         OUTPUTS: PaintAction (action) or None
 
-        Complexity: checking if the stack is empty is always O(1), and popping is also O(1). However, if
-        the Draw Style is sequential and special() is called, then the worst-case complexity is O(len(self.layerstore)).
+        Complexity: checking if the deque is empty is always O(1), and popping is also O(1), plus applying the action
+        (in bulk, see action.py). Redoing a special action is also O(1), since Grid.special only counts the special.
         """
         if self.redoTracker.is_empty():
             return None
         else:
             action = self.redoTracker.pop()
             action.redo_apply(grid)
+            self.undoTracker.append(action) # so it can be undone again
             return action